@@ -2,15 +2,45 @@ import socket
 import threading
 import sys
 import os
-import struct
+import time
+from collections import OrderedDict
+from framing import (FrameReader, FrameTooLarge, ProtocolError, Inflater, encode_frame, encode_v2, decode_v2,
+                     tag_frame, split_tag, TAG_HELLO, OP_DONE, OP_THROTTLE, OP_FILE_OFFER, OP_FILE_CHUNK, OP_FILE_ACK, OP_FILE_END,
+                     OP_FILE_CANCEL, FILE_CHUNK_SIZE, FILE_WINDOW,
+                     PROTOCOL_HELLO, OP_PROMPT, OP_OK, OP_ERROR, OP_NOTICE, OP_SERVER, OP_CHAT, OP_HISTORY,
+                     OP_CURSOR, OP_SESSION, OP_PONG, OP_BYE, OP_TEXT, OP_INPUT, OP_SAY, OP_COMMAND, OP_PING)
 
 Server_IP = "127.0.0.1"
 Server_Port = 20000
-Max_data = 1024
+MAX_FRAME_BYTES = 10 * 1024 * 1024  # 10MB
+RECONNECT_ATTEMPTS = 5  # Số lần thử kết nối lại khi mất kết nối
+RECONNECT_DELAY = 2  # Giây chờ giữa các lần thử
+SYNC_MAX_ROOMS = 20  # Số phòng nhớ id tin cuối (khớp giới hạn của server)
+KEEPALIVE_INTERVAL = 60  # Giây giữa các frame PING để server không ngắt khi người dùng chỉ đọc
+V1_PING = "/ping"  # Keepalive khi server chỉ hỗ trợ v1 (dạng lệnh, không trùng tin chat)
+NEGOTIATE_TIMEOUT = 10  # Giây chờ server trả lời lúc chọn phiên bản giao thức
+COMPRESSION = "stream"  # Xin server nén frame: "stream", "frame" hoặc None (không nén)
+DOWNLOAD_DIR = "downloads"  # Thư mục lưu file nhận được trong chat riêng
+FILE_ACK_TIMEOUT = 30  # Giây chờ người nhận xác nhận chunk trước khi bỏ lượt gửi
 
 client_socket = None
+frame_reader = None  # FrameReader của kết nối hiện tại (tạo lại mỗi lần kết nối)
+backlog = []  # Frame đã đọc lúc chọn giao thức nhưng chưa xử lý
+protocol = 1  # 2 khi server xác nhận GIAO THỨC:2, server cũ giữ 1
+tagging = False  # v1: đã gửi MÃ:BẬT, frame MÃ:<mã>:... là trả lời gắn mã
 running = True
 authenticated = False
+my_name = None  # Username server báo trong OP_SESSION (v2), để hiện "Bạn" trong lịch sử
+history_cursor = None  # id tin cũ nhất đã hiện trong phòng hiện tại (0 = hết lịch sử)
+current_room = "public"  # 'public', '#<kênh>' hoặc '@<người chat riêng>', theo frame CON TRỎ
+last_seen = OrderedDict()  # phòng -> id tin mới nhất đã hiện, gửi lại khi kết nối lại
+resume_token = None  # Token server cấp sau khi đăng nhập, dùng để khôi phục phiên không cần mật khẩu
+resuming = False
+send_lock = threading.Lock()  # Thread nhập, keepalive và thread gửi file cùng ghi một socket
+uploads = {}  # mã lượt gửi -> Upload đang gửi
+downloads = {}  # (người gửi, mã lượt gửi) -> Download đang chờ đồng ý hoặc đang nhận
+download_lock = threading.Lock()  # Thread nhận (chunk) và thread nhập (/receive, /reject) cùng sửa downloads
+next_transfer_id = 0
 
 def clear_screen():
     """Xóa màn hình console"""
@@ -19,44 +49,62 @@ def clear_screen():
 def print_separator():
     """In dòng phân cách"""
     print("=" * 60)
-def send_message(sock, msg):
-    """Gửi tin nhắn với header chứa độ dài (4 bytes)"""
+
+def prompt():
+    print("> ", end='', flush=True)
+
+def send_frame(sock, frame):
+    """Gửi một frame đã đóng sẵn (header + nội dung)"""
     try:
-        msg_bytes = msg.encode('utf-8')
-        msg_length = len(msg_bytes)
-        sock.sendall(struct.pack('!I', msg_length) + msg_bytes)
+        with send_lock:
+            sock.sendall(frame)
         return True
     except Exception as e:
         print(f"\n[LỖI] Gửi tin thất bại: {e}")
         return False
 
-def recv_message(sock):
-    """Nhận tin nhắn với header chứa độ dài (4 bytes)"""
+def send_message(sock, msg):
+    """Gửi tin nhắn với header chứa độ dài (4 bytes)"""
+    return send_frame(sock, encode_frame(msg))
+
+def input_frame(msg):
+    """Dòng nhập ở bước xác thực và frame điều khiển (ĐỒNG BỘ, TIẾP TỤC)"""
+    if protocol == 2:
+        return encode_v2(OP_INPUT, msg)
+    return encode_frame(msg)
+
+def line_frame(line):
+    """Dòng người dùng gõ sau khi đăng nhập: v2 tách sẵn lệnh / tin chat, server không phải đoán"""
+    if protocol == 1 or not authenticated:
+        return input_frame(line)
+    if line.startswith("/"):
+        name, _, args = line.strip().partition(" ")
+        return encode_v2(OP_COMMAND, name, args.strip())
+    return encode_v2(OP_SAY, line)
+
+def send_input(sock, msg):
+    return send_frame(sock, input_frame(msg))
+
+def send_line(sock, line, request_id=None):
+    """Gửi một dòng; có request_id thì mọi trả lời của server cho dòng này mang lại mã đó, kết thúc bằng OP_DONE.
+    v1 phải gửi TAG_HELLO trước (server chỉ nhận nó trước khi xác thực) nên lần gắn mã đầu tiên tự gửi kèm."""
+    global tagging
+    frame = line_frame(line)
+    if request_id is not None:
+        if protocol == 1 and not tagging:
+            send_frame(sock, encode_frame(TAG_HELLO))
+            tagging = True
+        frame = tag_frame(protocol, request_id, frame)
+    return send_frame(sock, frame)
+
+def recv_frame(sock):
+    """Nhận frame tiếp theo (bytes, không gồm header), None nếu mất kết nối hoặc frame lỗi"""
+    if backlog:
+        return backlog.pop(0)
     try:
-        raw_msglen = b''
-        while len(raw_msglen) < 4:
-            chunk = sock.recv(4 - len(raw_msglen))
-            if not chunk:
-                return None  
-            raw_msglen += chunk
-        
-        msg_length = struct.unpack('!I', raw_msglen)[0]
-        if msg_length > 10 * 1024 * 1024:  # 10MB
-            print(f"\n[CẢNH BÁO] Tin nhắn quá lớn: {msg_length} bytes")
-            return None
-        msg_data = b''
-        while len(msg_data) < msg_length:
-            chunk = sock.recv(min(msg_length - len(msg_data), Max_data))
-            if not chunk:
-                return None
-            msg_data += chunk
-        
-        return msg_data.decode('utf-8')
-    except struct.error:
-        print("\n[LỖI] Lỗi đọc header tin nhắn")
-        return None
-    except UnicodeDecodeError:
-        print("\n[LỖI] Lỗi decode UTF-8")
+        return frame_reader.next_frame(sock)
+    except FrameTooLarge as e:
+        print(f"\n[CẢNH BÁO] {e}")
         return None
     except OSError: 
         return None
@@ -64,75 +112,485 @@ def recv_message(sock):
         print(f"\n[LỖI] Lỗi nhận tin: {e}")
         return None
 
+V1_PREFIXES = [  # Tiền tố dòng văn bản của server v1 -> opcode
+    ("XÁC THỰC:", OP_PROMPT), ("DANGNHAP:", OP_PROMPT), ("DANGKY:", OP_PROMPT),
+    ("OK:", OP_OK), ("LỖI:", OP_ERROR), ("PHIÊN:", OP_SESSION), ("CON TRỎ:", OP_CURSOR),
+    ("LỊCH SỬ:", OP_HISTORY), ("[THÔNG BÁO] ", OP_NOTICE), ("[MÁY CHỦ] ", OP_SERVER), ("XONG:", OP_DONE),
+    ("CHẬM LẠI:", OP_THROTTLE),
+]
+
+def parse_v1(message):
+    """Dòng văn bản v1 -> (opcode, trường, dòng) giống decode_v2 để dùng chung bảng xử lý"""
+    if message == "PONG":
+        return OP_PONG, [], []
+    if message == "Tạm biệt!":
+        return OP_BYE, [message], []
+    for prefix, opcode in V1_PREFIXES:
+        if message.startswith(prefix):
+            content = message[len(prefix):]
+            if opcode == OP_PROMPT:
+                return opcode, [prefix[:-1], content], []
+            if opcode == OP_SESSION:
+                return opcode, [content, ""], []
+            if opcode == OP_DONE and content.isdigit():
+                return opcode, [int(content)], []
+            if opcode == OP_THROTTLE:
+                # CHẬM LẠI:<loại>:<số ms nên chờ>
+                kind, wait_ms = content.rsplit(":", 1)
+                return opcode, [kind, int(wait_ms)], []
+            if opcode == OP_CURSOR:
+                # CON TRỎ:<phòng>:<id cũ nhất đã gửi>:<id mới nhất của phòng>
+                room, cursor, newest = content.rsplit(":", 2)
+                return opcode, [room, int(cursor), int(newest)], []
+            if opcode == OP_HISTORY:
+                # Cả khối lịch sử trong một frame, mỗi dòng một tin đã format sẵn
+                lines = content.split("\n")
+                return opcode, [current_room, lines[0].strip("= ")], lines[1:-1]
+            return opcode, [content], []
+    msg_id = 0
+    if message.startswith("#") and " [" in message:
+        # Tin chat kèm id: "#<id> [người gửi] tin"
+        tag, rest = message[1:].split(" ", 1)
+        if tag.isdigit():
+            msg_id, message = int(tag), rest
+    if message.startswith("[") and "] " in message:
+        sender, content = message[1:].split("] ", 1)
+        return OP_CHAT, [msg_id, "", current_room, sender, content], []
+    return OP_TEXT, [message], []
+
+def parse_frame(frame):
+    """frame -> (mã yêu cầu hoặc None, opcode, trường, dòng)"""
+    request_id, frame = split_tag(protocol, frame, tagging)
+    if protocol == 2:
+        return (request_id, *decode_v2(frame))
+    return (request_id, *parse_v1(frame.decode('utf-8')))
+
+def remember(room, msg_id):
+    """Ghi nhớ id tin mới nhất đã hiện trong phòng (giữ tối đa SYNC_MAX_ROOMS phòng gần nhất)"""
+    if msg_id > last_seen.get(room, 0):
+        last_seen[room] = msg_id
+    last_seen.move_to_end(room)
+    while len(last_seen) > SYNC_MAX_ROOMS:
+        last_seen.popitem(last=False)
+
+def negotiate(sock):
+    """Đề nghị giao thức v2. Server mới trả lại GIAO THỨC:2 ngay sau lời chào XÁC THỰC;
+    server cũ coi đó là câu trả lời sai và hỏi lại XÁC THỰC, khi đó giữ v1."""
+    global protocol
+    send_message(sock, PROTOCOL_HELLO)
+    sock.settimeout(NEGOTIATE_TIMEOUT)
+    try:
+        first = frame_reader.next_frame(sock)
+        while first is not None and first.startswith("HÀNG CHỜ:".encode('utf-8')):
+            # Server đầy: chờ tới lượt (server tự báo lỗi nếu chờ quá lâu), lời chào tới khi được vào
+            print(f"\n[HỆ THỐNG] Server đang đầy, vị trí chờ của bạn: {first.decode('utf-8').split(':', 1)[1]}")
+            sock.settimeout(None)
+            first = frame_reader.next_frame(sock)
+        sock.settimeout(NEGOTIATE_TIMEOUT)
+        if first is None or not first.startswith("XÁC THỰC:".encode('utf-8')):
+            backlog.append(first)  # Ví dụ LỖI:Server đã đầy
+            return
+        second = frame_reader.next_frame(sock)
+        if second == PROTOCOL_HELLO.encode('utf-8'):
+            protocol = 2  # Server hỏi lại XÁC THỰC bằng frame v2
+        else:
+            backlog.append(second)
+    finally:
+        sock.settimeout(None)
+
+def connect():
+    """Mở kết nối, chọn phiên bản giao thức và chế độ nén, báo server các id tin đã thấy để chỉ nhận lịch sử mới (đồng bộ delta).
+    Nếu đã có resume token thì xin khôi phục phiên cũ luôn, không qua bước đăng nhập."""
+    global client_socket, frame_reader, resuming, protocol, tagging
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect((Server_IP, Server_Port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    frame_reader = FrameReader(MAX_FRAME_BYTES)
+    backlog.clear()
+    protocol = 1
+    tagging = False
+    negotiate(sock)
+    if protocol == 2 and COMPRESSION:
+        frame_reader.inflater = Inflater(COMPRESSION)  # Sẵn sàng trước khi xin, frame nén có thể tới ngay sau
+        send_input(sock, f"NÉN:{COMPRESSION}")
+    sync = ",".join(f"{room}={msg_id}" for room, msg_id in last_seen.items())
+    send_input(sock, f"ĐỒNG BỘ:{sync}")
+    if resume_token:
+        resuming = True
+        send_input(sock, f"TIẾP TỤC:{resume_token}")
+    client_socket = sock
+
+def reconnect():
+    """Thử kết nối lại sau khi mất kết nối (khôi phục phiên bằng resume token nếu có)"""
+    global authenticated
+    authenticated = False
+    cancel_transfers("Mất kết nối")
+    for attempt in range(1, RECONNECT_ATTEMPTS + 1):
+        print(f"\n[HỆ THỐNG] Đang kết nối lại ({attempt}/{RECONNECT_ATTEMPTS})...")
+        time.sleep(RECONNECT_DELAY)
+        if not running:
+            return False
+        try:
+            connect()
+            print("✓ Đã kết nối lại.")
+            return True
+        except OSError:
+            continue
+    return False
+
+# === GỬI / NHẬN FILE (chat riêng, v2) ===
+
+class Upload:
+    def __init__(self, transfer_id, path, size):
+        self.transfer_id = transfer_id
+        self.path = path
+        self.size = size
+        self.window = threading.Semaphore(FILE_WINDOW)  # Mỗi chunk chưa được xác nhận giữ một chỗ
+        self.cancelled = None  # Lý do hủy
+
+class Download:
+    def __init__(self, sender, transfer_id, name, size):
+        self.sender = sender
+        self.transfer_id = transfer_id
+        self.name = name
+        self.size = size
+        self.path = None  # Chọn khi người dùng /receive
+        self.file = None
+        self.buffered = []  # (seq, data) tới trước khi đồng ý; chưa xác nhận nên người gửi dừng sau FILE_WINDOW chunk
+        self.received = 0
+        self.ended = False  # Đã nhận OP_FILE_END
+
+def download_path(name):
+    """Đường dẫn lưu file trong DOWNLOAD_DIR, thêm số nếu trùng tên"""
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    base, ext = os.path.splitext(os.path.basename(name))
+    path, n = os.path.join(DOWNLOAD_DIR, base + ext), 1
+    while os.path.exists(path):
+        path = os.path.join(DOWNLOAD_DIR, f"{base} ({n}){ext}")
+        n += 1
+    return path
+
+def start_upload(path):
+    """/send <đường dẫn>: gửi file cho người đang chat riêng ở thread riêng, chat vẫn dùng được"""
+    global next_transfer_id
+    if protocol != 2:
+        print("[HỆ THỐNG] Server không hỗ trợ gửi file")
+        return
+    if not authenticated or not current_room.startswith("@"):
+        print("[HỆ THỐNG] Chỉ gửi file được trong phòng chat riêng")
+        return
+    path = os.path.expanduser(path.strip().strip('"'))
+    if not os.path.isfile(path):
+        print(f"[HỆ THỐNG] Không tìm thấy file: {path}")
+        return
+    next_transfer_id += 1
+    upload = Upload(next_transfer_id, path, os.path.getsize(path))
+    uploads[upload.transfer_id] = upload
+    threading.Thread(target=upload_file, args=(client_socket, upload), daemon=True).start()
+
+def upload_file(sock, upload):
+    """Thread gửi file: tối đa FILE_WINDOW chunk chưa được xác nhận, nên không chiếm hết đường truyền của tin chat"""
+    name = os.path.basename(upload.path)
+    try:
+        with open(upload.path, 'rb') as f:
+            if not send_frame(sock, encode_v2(OP_FILE_OFFER, upload.transfer_id, "", name, upload.size)):
+                return
+            print(f"\n[FILE] Đang gửi {name} ({upload.size} bytes) tới {current_room[1:]}...")
+            seq = 0
+            while True:
+                if not upload.window.acquire(timeout=FILE_ACK_TIMEOUT):
+                    upload.cancelled = upload.cancelled or "Người nhận không phản hồi"
+                    send_frame(sock, encode_v2(OP_FILE_CANCEL, upload.transfer_id, "", upload.cancelled))
+                if upload.cancelled:
+                    print(f"\n[FILE] Đã hủy gửi {name}: {upload.cancelled}")
+                    return
+                data = f.read(FILE_CHUNK_SIZE)
+                if not data:
+                    break
+                if not send_frame(sock, encode_v2(OP_FILE_CHUNK, upload.transfer_id, seq, data)):
+                    return
+                seq += 1
+            send_frame(sock, encode_v2(OP_FILE_END, upload.transfer_id))
+            print(f"\n[FILE] Đã gửi xong {name}")
+    except OSError as e:
+        print(f"\n[FILE] Lỗi đọc {name}: {e}")
+        send_frame(sock, encode_v2(OP_FILE_CANCEL, upload.transfer_id, "", "Lỗi đọc file"))
+    finally:
+        uploads.pop(upload.transfer_id, None)
+        prompt()
+
+def cancel_transfers(reason):
+    """Mất kết nối: server đã hủy các lượt gửi, dọn phía client"""
+    for upload in list(uploads.values()):
+        upload.cancelled = reason
+        upload.window.release()
+    with download_lock:
+        for key in list(downloads):
+            drop_download(key, reason)
+
+def drop_download(key, reason):
+    download = downloads.pop(key, None)
+    if download:
+        if download.file:
+            download.file.close()
+            os.remove(download.path)
+        print(f"\n[FILE] Bỏ file {download.name} từ {download.sender}: {reason}")
+
+def reject_download(key, reason):
+    """Báo người gửi hủy lượt gửi rồi bỏ phần đã nhận"""
+    download = downloads.get(key)
+    if download:
+        send_frame(client_socket, encode_v2(OP_FILE_CANCEL, download.transfer_id, download.sender, reason))
+        drop_download(key, reason)
+
+def finish_download(key):
+    """Người gửi báo xong: chỉ giữ file khi số byte nhận được đúng kích thước đã báo"""
+    download = downloads.pop(key)
+    download.file.close()
+    if download.received != download.size:
+        os.remove(download.path)
+        print(f"\n[FILE] Bỏ file {download.name} từ {download.sender}: nhận {download.received}/{download.size} bytes")
+    else:
+        print(f"\n[FILE] Đã nhận {download.name} từ {download.sender}, lưu tại {download.path}")
+
+def waiting_download():
+    """Lời mời nhận file cũ nhất chưa trả lời"""
+    return next((key for key, d in downloads.items() if d.file is None), None)
+
+def accept_download():
+    """/receive: nhận file cũ nhất đang chờ, ghi phần đã tới rồi xác nhận để người gửi tiếp tục"""
+    with download_lock:
+        key = waiting_download()
+        if key is None:
+            print("[HỆ THỐNG] Không có file nào đang chờ nhận")
+            return
+        download = downloads[key]
+        download.path = download_path(download.name)
+        try:
+            download.file = open(download.path, 'wb')
+            for _, data in download.buffered:
+                download.file.write(data)
+        except OSError as e:
+            reject_download(key, f"Người nhận không ghi được file: {e}")
+            return
+        acks, download.buffered = [seq for seq, _ in download.buffered], []
+        print(f"[FILE] Đang nhận {download.name} từ {download.sender} -> {download.path}")
+        if download.ended:
+            finish_download(key)
+            return
+    for seq in acks:
+        send_frame(client_socket, encode_v2(OP_FILE_ACK, download.transfer_id, seq))
+
+def refuse_download():
+    """/reject: từ chối file cũ nhất đang chờ"""
+    with download_lock:
+        key = waiting_download()
+        if key is None:
+            print("[HỆ THỐNG] Không có file nào đang chờ nhận")
+            return
+        reject_download(key, "Người nhận từ chối")
+
+def keepalive():
+    """Thread gửi PING định kỳ khi đã đăng nhập"""
+    while running:
+        time.sleep(KEEPALIVE_INTERVAL)
+        if running and authenticated:
+            send_frame(client_socket, encode_v2(OP_PING) if protocol == 2 else encode_frame(V1_PING))
+
+# === XỬ LÝ FRAME TỪ SERVER ===
+# Mỗi opcode một hàm (trường, dòng); trả về True để dừng thread nhận.
+
+def on_prompt(fields, rows):
+    kind, content = fields
+    if kind == "XÁC THỰC" and resuming:
+        return  # Đang chờ server khôi phục phiên, chưa cần đăng nhập
+    print(f"\n{content}")
+    prompt()
+
+def on_ok(fields, rows):
+    global resuming, authenticated
+    resuming = False
+    content = fields[0]
+    print(f"\n✓ {content}")
+    if "Chào mừng" in content:
+        authenticated = True
+        print_separator()
+
+def on_error(fields, rows):
+    global resuming, resume_token
+    if resuming:
+        resuming = False
+        resume_token = None
+    print(f"\n✗ LỖI: {fields[0]}")
+
+def on_notice(fields, rows):
+    print(f"\n[THÔNG BÁO] {fields[0]}")
+    prompt()
+
+def on_server(fields, rows):
+    print(f"\n {fields[0]}")
+    prompt()
+
+def on_chat(fields, rows):
+    msg_id, _, room, sender, content = fields
+    if msg_id:
+        remember(room, msg_id)
+    print(f"\n {sender}: {content}")
+    prompt()
+
+def on_history(fields, rows):
+    _, title = fields
+    print(f"\n=== {title} ===")
+    for row in rows:
+        if isinstance(row, str):
+            print(row)  # Server v1: dòng đã format sẵn
+        else:
+            _, ts, sender, content = row
+            print(f"[{ts}] {'Bạn' if sender == my_name else sender}: {content}")
+    print("\n=== HẾT ===")
+
+def on_cursor(fields, rows):
+    global current_room, history_cursor
+    room, cursor, newest = fields
+    current_room, history_cursor = room, cursor
+    if newest:
+        remember(room, newest)
+
+def on_session(fields, rows):
+    global resume_token, my_name
+    resume_token = fields[0]
+    my_name = fields[1] or my_name
+
+def on_pong(fields, rows):
+    pass
+
+def on_bye(fields, rows):
+    global running
+    print(f"\n{fields[0]}")
+    running = False
+    return True
+
+def on_text(fields, rows):
+    print(f"\n{fields[0]}")
+    if authenticated:
+        prompt()
+
+def on_done(fields, rows):
+    pass  # Client tương tác gửi từng dòng, không cần ghép trả lời theo mã
+
+def on_throttle(fields, rows):
+    global resuming
+    kind, wait_ms = fields
+    if kind == "auth" and resuming:
+        resuming = False  # Server hỏi lại XÁC THỰC ngay sau, để người dùng tự đăng nhập
+    reason = {"public": "Bạn gửi tin nhắn quá nhanh", "private": "Bạn gửi tin nhắn riêng quá nhanh",
+              "command": "Bạn gửi lệnh quá nhanh", "auth": "Bạn thử đăng nhập quá nhiều lần"}.get(kind, f"Vượt giới hạn {kind}")
+    print(f"\n[HỆ THỐNG] {reason}, yêu cầu vừa gửi bị bỏ qua. Thử lại sau {wait_ms / 1000:.1f}s")
+    if authenticated:
+        prompt()
+
+def on_file_offer(fields, rows):
+    """Không tự nhận: người dùng gõ /receive hoặc /reject"""
+    transfer_id, sender, name, size = fields
+    with download_lock:
+        downloads[(sender, transfer_id)] = Download(sender, transfer_id, name, size)
+    print(f"\n[FILE] {sender} muốn gửi {name} ({size} bytes). Gõ /receive để nhận hoặc /reject để từ chối")
+    prompt()
+
+def on_file_chunk(fields, rows):
+    transfer_id, seq, data = fields
+    key = (current_room[1:], transfer_id)
+    with download_lock:
+        download = downloads.get(key)
+        if download is None:
+            return
+        if download.received + len(data) > download.size:
+            reject_download(key, "Dữ liệu vượt kích thước đã báo")
+            prompt()
+            return
+        download.received += len(data)
+        if download.file is None:
+            download.buffered.append((seq, data))
+            return
+        download.file.write(data)
+    send_frame(client_socket, encode_v2(OP_FILE_ACK, transfer_id, seq))
+
+def on_file_ack(fields, rows):
+    upload = uploads.get(fields[0])
+    if upload:
+        upload.window.release()
+
+def on_file_end(fields, rows):
+    transfer_id, = fields
+    key = (current_room[1:], transfer_id)
+    with download_lock:
+        download = downloads.get(key)
+        if download is None:
+            return
+        download.ended = True
+        if download.file is None:
+            return  # Chưa trả lời: /receive sẽ lưu luôn
+        finish_download(key)
+    prompt()
+
+def on_file_cancel(fields, rows):
+    transfer_id, sender, reason = fields
+    if sender == my_name:
+        upload = uploads.get(transfer_id)
+        if upload:
+            upload.cancelled = reason
+            upload.window.release()
+    else:
+        with download_lock:
+            drop_download((sender, transfer_id), reason)
+        prompt()
+
+HANDLERS = {
+    OP_PROMPT: on_prompt,
+    OP_OK: on_ok,
+    OP_ERROR: on_error,
+    OP_NOTICE: on_notice,
+    OP_SERVER: on_server,
+    OP_CHAT: on_chat,
+    OP_HISTORY: on_history,
+    OP_CURSOR: on_cursor,
+    OP_SESSION: on_session,
+    OP_PONG: on_pong,
+    OP_BYE: on_bye,
+    OP_TEXT: on_text,
+    OP_DONE: on_done,
+    OP_THROTTLE: on_throttle,
+    OP_FILE_OFFER: on_file_offer,
+    OP_FILE_CHUNK: on_file_chunk,
+    OP_FILE_ACK: on_file_ack,
+    OP_FILE_END: on_file_end,
+    OP_FILE_CANCEL: on_file_cancel,
+}
+
 def receive_messages():
     """Thread nhận tin nhắn từ server"""
-    global running, authenticated
+    global running
     
     while running:
         try:
-            message = recv_message(client_socket)
+            frame = recv_frame(client_socket)
             
-            if message is None:
+            if frame is None:
+                if not running:
+                    break
                 print("\n[HỆ THỐNG] Mất kết nối với server")
+                if reconnect():
+                    continue
                 running = False
                 break
-            if message.startswith("XÁC THỰC:"):
-                content = message.split(":", 1)[1]
-                print(f"\n{content}")
-                print("> ", end='', flush=True)
-            
-            elif message.startswith("DANGNHAP:") or message.startswith("DANGKY:"):
-                msg_type, content = message.split(":", 1)
-                print(f"\n{content}")
-                print("> ", end='', flush=True)
-            
-            elif message.startswith("OK:"):
-                content = message.split(":", 1)[1]
-                print(f"\n✓ {content}")
-                
-                if "Chào mừng" in content:
-                    authenticated = True
-                    print_separator()
-            
-            elif message.startswith("LỖI:"):
-                content = message.split(":", 1)[1]
-                print(f"\n✗ LỖI: {content}")
-            
-            elif message.startswith("LỊCH SỬ:"):
-                content = message.split(":", 1)[1]
-                if "===" in content:
-                    print(f"\n{content}")
-                else:
-                    print(content)
-            
-            elif message.startswith("[THÔNG BÁO]"):
-                print(f"\n{message}")
-                print("> ", end='', flush=True)
-            
-            elif message.startswith("[MÁY CHỦ]"):
-                content = message.split("] ", 1)[1]
-                print(f"\n {content}")
-                print("> ", end='', flush=True)
-            
-            elif message.startswith("["):
-                try:
-                    sender = message[1:message.index("]")]
-                    content = message[message.index("]") + 2:]
-                    print(f"\n {sender}: {content}")
-                    print("> ", end='', flush=True)
-                except:
-                    print(f"\n{message}")
-                    print("> ", end='', flush=True)
-            
-            elif message == "Tạm biệt!":
-                print(f"\n{message}")
-                running = False
+            try:
+                _, opcode, fields, rows = parse_frame(frame)
+            except (ProtocolError, UnicodeDecodeError, ValueError) as e:
+                print(f"\n[LỖI] Frame không hợp lệ: {e}")
+                continue
+            handler = HANDLERS.get(opcode)
+            if handler and handler(fields, rows):
                 break
-            
-            else:
-                print(f"\n{message}")
-                if authenticated:
-                    print("> ", end='', flush=True)
         
         except ConnectionResetError:
             print("\n[HỆ THỐNG] Server đã đóng kết nối")
@@ -152,10 +610,23 @@ def send_messages():
             message = input()
             if not running:
                 break
+            if message.strip() in ['/history more', '/his more'] and history_cursor is not None:
+                if history_cursor == 0:
+                    print("[HỆ THỐNG] Không còn tin nhắn cũ hơn")
+                    continue
+                message = f"/history before {history_cursor}"
+            if message.strip().startswith('/send '):
+                start_upload(message.strip()[len('/send '):])
+                continue
+            if message.strip() == '/receive':
+                accept_download()
+                continue
+            if message.strip() == '/reject':
+                refuse_download()
+                continue
             if message.strip():
-                if not send_message(client_socket, message):
-                    running = False
-                    break
+                if not send_line(client_socket, message):
+                    continue  # Thread nhận lo việc kết nối lại hoặc thoát
                 if message.strip() == '/exit':
                     running = False
                     break
@@ -180,12 +651,12 @@ def main():
     print_separator()
     
     try:
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((Server_IP, Server_Port))
+        connect()
         print("\n✓ Đã kết nối thành công!")
         print("\nĐang chờ server...")
         receive_thread = threading.Thread(target=receive_messages, daemon=True)
         receive_thread.start()
+        threading.Thread(target=keepalive, daemon=True).start()
         send_messages()
         
     except ConnectionRefusedError:
@@ -1,34 +1,111 @@
 import socket
 import threading
+import asyncio
+import argparse
 import time
 import hashlib
 import sqlite3
 import logging
 import os
 import re
-import struct
+import queue
+import heapq
+import secrets
+import contextvars
+import signal
+import subprocess
+import sys
+import math
+import abc
+import ipaddress
+import concurrent.futures
+from collections import Counter, deque, OrderedDict
+from contextlib import contextmanager
+from cluster import Broker, Bus, socket_path
+from framing import (FrameReader, FrameTooLarge, ProtocolError, Deflater, encode_frame, encode_v2, decode_v2, pack_row,
+                     tag_frame, split_tag, TAG_HELLO, OP_DONE, OP_THROTTLE, OP_FILE_OFFER, OP_FILE_CHUNK, OP_FILE_ACK, OP_FILE_END,
+                     OP_FILE_CANCEL, FILE_WINDOW, FILE_FRAME_BYTES,
+                     COMPRESSION_MODES,
+                     PROTOCOL_HELLO, OP_PROMPT, OP_OK, OP_ERROR, OP_NOTICE, OP_SERVER, OP_CHAT, OP_HISTORY,
+                     OP_CURSOR, OP_SESSION, OP_PONG, OP_BYE, OP_TEXT, OP_INPUT, OP_SAY, OP_COMMAND, OP_PING)
 
 # === CẤU HÌNH GIỚI HẠN ===
-MAX_CLIENTS = 5
+MAX_CLIENTS = 5  # Số kết nối (đã đăng nhập + đang xác thực) mỗi process; cluster: mỗi worker
+MAX_HANDSHAKES = 20  # Số kết nối đang xác thực cùng lúc (một phần của MAX_CLIENTS)
+ADMISSION_QUEUE = 100  # Số kết nối được xếp hàng chờ khi server đầy, quá nữa thì từ chối ngay
+ADMISSION_TIMEOUT = 120  # Giây chờ tối đa trong hàng đợi
+RATE_LIMITS = {  # Loại -> (số lần liên tiếp tối đa, số lần hồi lại mỗi giây) cho mỗi phiên; None = không giới hạn
+    "public": (10, 2.0),   # Tin chat phòng chung / kênh
+    "private": (20, 5.0),  # Tin chat riêng
+    "command": (10, 2.0),  # Lệnh (/list, /msg, /history, ...)
+    "auth": (5, 0.2),      # Lần thử đăng nhập / đăng ký / khôi phục phiên
+}
+RATE_LIMIT_LOOPBACK = False  # Có giới hạn cả client từ 127.0.0.0/8, ::1 không (test.py, bench.py chạy cùng máy, chung một IP)
+RATE_IP_FACTOR = 4  # Budget mỗi IP = budget mỗi phiên x hệ số này (vài người chung NAT vẫn chat được)
+RATE_IP_TABLE = 10000  # Số IP theo dõi tối đa (LRU); cluster: mỗi worker đếm riêng
+RATE_STRIKES = 20  # Bị chặn chừng này lần trong RATE_STRIKE_WINDOW giây thì ngắt kết nối
+RATE_STRIKE_WINDOW = 60
+USER_CACHE_SIZE = 10000  # Số tài khoản giữ mật khẩu đã băm trong RAM (LRU)
+USER_CACHE_MISSING = 10000  # Số tên không tồn tại được nhớ (LRU riêng: dò tên ngẫu nhiên không đẩy tài khoản thật ra)
+USER_CACHE_MISSING_TTL = 60  # Giây nhớ một tên không tồn tại
+AUTH_ACCOUNT_FREE = 3  # Số lần đăng nhập sai vào một tài khoản trước khi tài khoản bị khóa tạm
+AUTH_IP_FREE = 10  # Số lần sai từ một IP (mọi tài khoản) trước khi IP bị khóa tạm
+AUTH_BACKOFF_BASE = 1.0  # Giây khóa lần đầu, nhân đôi sau mỗi lần sai tiếp theo
+AUTH_BACKOFF_MAX = 300
+AUTH_FAILURE_WINDOW = 900  # Không sai thêm trong chừng này giây thì đếm lại từ đầu
+AUTH_GUARD_TABLE = 10000  # Số tài khoản / IP theo dõi lần sai tối đa (LRU); cluster: mỗi worker đếm riêng
 MAX_MESSAGE_LENGTH = 500
 MAX_USERNAME_LENGTH = 20
 MIN_USERNAME_LENGTH = 3
 MAX_PASSWORD_LENGTH = 50
 MIN_PASSWORD_LENGTH = 6
 USERNAME_PATTERN = re.compile(r'^[a-zA-Z0-9_]+$')
+MAX_CHANNEL_LENGTH = 20  # Tên kênh (/join) cùng quy tắc ký tự với username
+MAX_CHANNELS = 100  # Số kênh có người (ngoài phòng chung) tồn tại cùng lúc
 REQUEST_TIMEOUT = 60
 SOCKET_BACKLOG = 10
 AUTH_TIMEOUT = 60 
 CHAT_TIMEOUT = 600
+IDLE_TICK = 1.0  # Độ phân giải (giây) của timer wheel theo dõi kết nối không hoạt động
+IDLE_WHEEL_SLOTS = 64
+RESUME_GRACE = 60  # Giây giữ phiên sau khi mất kết nối để client dùng token khôi phục
+RESUME_TOKEN_BYTES = 24
+SERVER_MODE = "thread"  # "thread" (mỗi kết nối 1 luồng) hoặc "async" (1 event loop)
+MAX_CLIENTS_ASYNC = 20000  # Giới hạn mặc định khi chạy chế độ async
+ASYNC_SESSION_THREADS = 32  # Chế độ async: số luồng chạy client_session (SQLite, chờ ghi DB, bus.call) ngoài event loop
+OUTBOX_MAX_FRAMES = 1000  # Số frame chờ gửi tối đa mỗi kết nối
+OUTBOX_HIGH_WATER = 256 * 1024  # Số byte chờ gửi tối đa mỗi kết nối
+OUTBOX_POLICY = "drop"  # Khi vượt ngưỡng: "drop" (bỏ frame mới) hoặc "disconnect" (ngắt client chậm)
+SEND_IOV_MAX = 1024  # Số frame tối đa trong một lần sendmsg (giới hạn IOV_MAX của hệ điều hành)
 
-Client_list = [] # conn, addr, username, room_type, room_target
-Max_data = 1024
+RECV_BUFFER_SIZE = 4096  # Buffer đọc mỗi kết nối (đủ cho vài frame tối đa, nhỏ để chạy được hàng chục nghìn kết nối)
+MAX_FRAME_BYTES = max(MAX_MESSAGE_LENGTH * 2, FILE_FRAME_BYTES)  # Frame lớn nhất là một chunk file; tin chat vẫn tối đa MAX_MESSAGE_LENGTH ký tự
+FILE_MAX_BYTES = 100 * 1024 * 1024  # Kích thước file tối đa mỗi lượt gửi
+COMPRESSION = True  # Cho phép client xin nén frame gửi đi (NÉN:frame hoặc NÉN:stream)
+COMPRESS_THRESHOLD = None  # Ngưỡng byte bắt đầu nén; None = mặc định theo chế độ (framing.COMPRESS_MIN_BYTES)
+WORKERS = 1  # >1: chạy cluster gồm chừng ấy process cùng nghe Local_Port (SO_REUSEPORT, chỉ Linux/BSD)
 Local_IP = "127.0.0.1"
 Local_Port = 20000  
-lock = threading.Lock()
-pending_requests = {}
+lock = threading.RLock()
+outbox_stats = {"dropped": 0, "disconnects": 0}
 
 DB_FILE = "chat_server.db"
+SCHEMA_VERSION = 2  # Lưu trong PRAGMA user_version
+DB_POOL_SIZE = 4  # Số kết nối SQLite mở sẵn
+DB_BUSY_TIMEOUT = 5000  # ms chờ khi DB đang bị khóa ghi
+DB_SYNCHRONOUS = "NORMAL"  # Với WAL: an toàn khi server crash, chỉ fsync lúc checkpoint
+DB_STATEMENT_CACHE = 64  # Số câu lệnh đã biên dịch giữ lại trên mỗi kết nối
+DB_BATCH_SIZE = 200  # Ghi ngay khi hàng đợi tin nhắn đủ số này
+DB_FLUSH_INTERVAL = 0.05  # Hoặc khi tin cũ nhất đã chờ quá số giây này
+DB_WRITE_RETRIES = 3  # Số lần thử lại một lô ghi lỗi (DB bận...) trước khi bỏ, chờ 0.1s, 0.2s, 0.4s
+HISTORY_LIMIT = 50  # Số tin mỗi trang /history (cũng là số tin cache giữ cho mỗi phòng)
+HISTORY_REPLAY = 20  # Số tin gửi lại khi vào phòng, xem thêm bằng /history more
+MAX_MESSAGE_ID = (1 << 63) - 1
+SYNC_MAX_ROOMS = 20  # Số phòng tối đa trong frame ĐỒNG BỘ của client
+HISTORY_CACHE_PAIRS = 1000  # Số cuộc chat riêng giữ trong cache (LRU)
+HISTORY_CACHE_CHANNELS = 200  # Số kênh giữ trong cache (LRU, phòng chung luôn có)
+HISTORY_CACHE_BYTES = 32 * 1024 * 1024  # Giới hạn bộ nhớ cache lịch sử
+HISTORY_WARM_PAIRS = 100  # Số cuộc chat riêng gần nhất nạp sẵn lúc khởi động
 LOG_FILE = "server_log.txt"
 
 logging.basicConfig(
@@ -39,62 +116,1201 @@ logging.basicConfig(
         logging.StreamHandler()
     ]
 )
+V2_REPLIES = {  # Tiền tố dòng trả lời v1 -> opcode v2
+    "XÁC THỰC": OP_PROMPT, "DANGNHAP": OP_PROMPT, "DANGKY": OP_PROMPT,
+    "OK": OP_OK, "LỖI": OP_ERROR,
+}
+
 def send_message(conn, msg):
-    """Gửi tin nhắn với header chứa độ dài (4 bytes)"""
+    """Gửi tin nhắn với header chứa độ dài (4 bytes).
+    Client v2 nhận frame opcode ứng với tiền tố (XÁC THỰC/DANGNHAP/DANGKY, OK, LỖI), còn lại là OP_TEXT."""
+    if conn.protocol == 2:
+        head, sep, rest = msg.partition(":")
+        opcode = V2_REPLIES.get(head) if sep else None
+        if opcode == OP_PROMPT:
+            return send_frame(conn, encode_v2(OP_PROMPT, head, rest))
+        if opcode:
+            return send_frame(conn, encode_v2(opcode, rest))
+        return send_frame(conn, encode_v2(OP_TEXT, msg))
+    return send_frame(conn, encode_frame(msg))
+
+def send_typed(conn, opcode, *values, text):
+    """Frame có kiểu: client v2 nhận opcode kèm các trường, client v1 nhận dòng văn bản tương đương"""
+    if conn.protocol == 2:
+        return send_frame(conn, encode_v2(opcode, *values))
+    return send_message(conn, text)
+
+def send_bytes(conn, msg_bytes):
+    """Gửi payload đã mã hóa UTF-8 sẵn (dùng cho dữ liệu cache)"""
+    return send_frame(conn, encode_frame(msg_bytes))
+
+current_request = contextvars.ContextVar("current_request", default=None)  # (conn, mã yêu cầu) đang xử lý
+
+def send_frame(conn, frame):
+    """Xếp một frame đã đóng sẵn (header + nội dung) vào hàng đợi gửi.
+    Cùng một đối tượng bytes được dùng lại cho mọi người nhận khi broadcast.
+    Frame gửi cho chính kết nối đang xử lý một yêu cầu có mã thì được gắn mã đó.
+    Trả về False nếu không gửi được hoặc frame bị bỏ vì hàng đợi đầy."""
+    if conn.closing or conn.closed:
+        return False  # Client vừa ngắt: bình thường, không phải lỗi
     try:
-        msg_bytes = msg.encode('utf-8')
-        msg_length = len(msg_bytes)
-        conn.sendall(struct.pack('!I', msg_length) + msg_bytes)
-        return True
-    except (BrokenPipeError, ConnectionResetError, OSError) as e:
+        request = current_request.get()
+        if request is not None and request[0] is conn:
+            frame = tag_frame(conn.protocol, request[1], frame)
+        return conn.sendall(frame)
+    except (BrokenPipeError, ConnectionResetError) as e:
+        logging.debug(f"[SEND] Kết nối đã đóng: {e}")
+        return False
+    except OSError as e:
         logging.error(f"[SEND ERROR] {e}")
         return False
     except Exception as e:
         logging.error(f"[SEND ERROR] {e}")
         return False
 
-def recv_message(conn):
-    """Nhận tin nhắn với header chứa độ dài (4 bytes)"""
+@contextmanager
+def request_scope(conn, request_id):
+    """Xử lý một frame có mã yêu cầu: các trả lời cho kết nối này được gắn mã,
+    xong thì gửi XONG:<mã> (v2: OP_DONE) để client biết không còn trả lời nào nữa"""
+    if request_id is None:
+        yield
+        return
+    token = current_request.set((conn, request_id))
     try:
-        raw_msglen = b''
-        while len(raw_msglen) < 4:
-            chunk = conn.recv(4 - len(raw_msglen))
-            if not chunk:
-                return None 
-            raw_msglen += chunk
-        
-        msg_length = struct.unpack('!I', raw_msglen)[0]
-        if msg_length > MAX_MESSAGE_LENGTH * 2:
-            logging.warning(f"[RECV] Tin nhắn quá lớn: {msg_length} bytes")
-            return None
-        msg_data = b''
-        while len(msg_data) < msg_length:
-            chunk = conn.recv(min(msg_length - len(msg_data), Max_data))
-            if not chunk:
-                return None
-            msg_data += chunk
-        
-        return msg_data.decode('utf-8')
-    except struct.error:
-        logging.error("[RECV] Lỗi unpack header")
-        return None
+        yield
+    finally:
+        current_request.reset(token)
+        if not (conn.closing or conn.closed):
+            send_typed(conn, OP_DONE, request_id, text=f"XONG:{request_id}")
+
+def decode_client_frame(conn, frame):
+    """Frame client -> (mã yêu cầu hoặc None, tin). Tin là str (v1, hoặc OP_INPUT của v2)
+    hoặc tuple (opcode, *trường) với các opcode v2 khác"""
+    request_id, frame = split_tag(conn.protocol, frame, conn.tagging)
+    if conn.protocol == 1:
+        return request_id, frame.decode('utf-8')
+    opcode, values, _ = decode_v2(frame)
+    if opcode == OP_INPUT:
+        return request_id, values[0]
+    return request_id, (opcode, *values)
+
+def recv_message(conn, frames, sock):
+    """Nhận frame tiếp theo qua FrameReader của kết nối: (mã yêu cầu, tin); tin None = mất kết nối hoặc frame lỗi"""
+    try:
+        frame = frames.next_frame(sock)
+        return decode_client_frame(conn, frame) if frame is not None else (None, None)
+    except FrameTooLarge as e:
+        logging.warning(f"[RECV] {e}")
+        return None, None
     except UnicodeDecodeError:
         logging.error("[RECV] Lỗi decode UTF-8")
-        return None
+        return None, None
+    except ProtocolError as e:
+        logging.error(f"[RECV] Frame lỗi: {e}")
+        return None, None
     except Exception as e:
         logging.error(f"[RECV ERROR] {e}")
-        return None
+        return None, None
+
+async def recv_message_async(conn, reader, frames):
+    """Phiên bản asyncio của recv_message: đọc theo khối từ StreamReader rồi giải frame trong buffer"""
+    try:
+        while True:
+            frame = frames.pop()
+            if frame is not None:
+                return decode_client_frame(conn, frame)
+            data = await reader.read(RECV_BUFFER_SIZE)
+            if not data:
+                return None, None
+            frames.feed(data)
+    except FrameTooLarge as e:
+        logging.warning(f"[RECV] {e}")
+        return None, None
+    except UnicodeDecodeError:
+        logging.error("[RECV] Lỗi decode UTF-8")
+        return None, None
+    except ProtocolError as e:
+        logging.error(f"[RECV] Frame lỗi: {e}")
+        return None, None
+    except Exception as e:
+        logging.error(f"[RECV ERROR] {e}")
+        return None, None
+
+class Outbox(abc.ABC):
+    """Hàng đợi gửi có giới hạn của một kết nối.
+    send_message chỉ xếp frame vào đây; writer riêng (thread hoặc task) ghi xuống socket,
+    nên client nhận chậm không làm nghẽn luồng đang broadcast."""
+    def __init__(self, addr):
+        self.addr = addr
+        self.frames = deque()
+        self.queued_bytes = 0
+        self.peak_frames = 0
+        self.dropped = 0
+        self.closing = False
+        self.closed = False
+        self.qlock = threading.Lock()
+        self.idle_timeout = None
+        self.last_active = time.monotonic()
+        self.timed_out = False
+        self.protocol = 1  # 2 sau khi client gửi GIAO THỨC:2 và server xác nhận
+        self.deflater = None  # Deflater khi client xin nén
+        self.tagging = False  # v1: client đã gửi MÃ:BẬT, từ đó MÃ:<mã>:... là frame gắn mã yêu cầu
+        self.admission = None  # Chỗ đang giữ trong Admission: "handshake" hoặc "session"
+        self.rate = RateState()  # Budget lúc xác thực; đăng nhập xong dùng budget của Session
+
+    def sendall(self, data):
+        with self.qlock:
+            if self.closing or self.closed:
+                raise ConnectionResetError("Kết nối đã đóng")
+            overflow = (len(self.frames) >= OUTBOX_MAX_FRAMES or
+                        self.queued_bytes + len(data) > OUTBOX_HIGH_WATER)
+            if not overflow:
+                self.frames.append(data)
+                self.queued_bytes += len(data)
+                self.peak_frames = max(self.peak_frames, len(self.frames))
+        if overflow:
+            self._overflow()
+            return False
+        self._wake()
+        return True
+
+    def _overflow(self):
+        if OUTBOX_POLICY == "disconnect":
+            with lock:
+                outbox_stats["disconnects"] += 1
+            logging.warning(f"[HÀNG ĐỢI] Ngắt client nhận chậm {self.addr} ({len(self.frames)} frame, {self.queued_bytes} bytes)")
+            self.abort()
+            raise ConnectionResetError("Client nhận quá chậm")
+        with lock:
+            outbox_stats["dropped"] += 1
+        if self.dropped == 0:
+            logging.warning(f"[HÀNG ĐỢI] Bắt đầu bỏ frame của client nhận chậm {self.addr}")
+        self.dropped += 1
+
+    def take_all(self):
+        """Lấy hết frame đang chờ (chỉ writer gọi). Nén ở đây, ngoài luồng broadcast,
+        theo đúng thứ tự gửi và chỉ với frame thực sự được gửi (chế độ stream cần cả hai điều này)."""
+        with self.qlock:
+            batch = list(self.frames)
+            self.frames.clear()
+            self.queued_bytes = 0
+        if self.deflater and batch:
+            batch = [self.deflater.pack(frame) for frame in batch]
+        return batch
+
+    def depth(self):
+        return len(self.frames), self.queued_bytes
+
+    def settimeout(self, timeout):
+        """Đóng kết nối nếu không nhận được frame nào trong timeout giây (None = không giới hạn)"""
+        self.idle_timeout = timeout
+        self.touch()
+        idle_tracker.watch(self)
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def expire(self):
+        """Gọi bởi IdleTracker: ngắt ngay, luồng/task đọc sẽ nhận None"""
+        self.timed_out = True
+        self.abort()
+
+    def close(self):
+        """Đóng sau khi đã gửi hết các frame còn trong hàng đợi"""
+        self.closing = True
+        self._wake()
+
+    def abort(self):
+        """Đóng ngay, bỏ các frame chưa gửi"""
+        with self.qlock:
+            self.closed = True
+            self.frames.clear()
+            self.queued_bytes = 0
+        self._wake()
+
+    @abc.abstractmethod
+    def _wake(self):
+        """Báo writer có frame mới hoặc kết nối sắp đóng (gọi được từ mọi luồng)"""
+
+class SocketConn(Outbox):
+    """Chế độ thread: writer là một luồng riêng cho mỗi socket"""
+    def __init__(self, sock, addr):
+        super().__init__(addr)
+        self.sock = sock
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Frame nhỏ gửi ngay, không chờ Nagle
+        self.cond = threading.Condition()
+        threading.Thread(target=self._writer, daemon=True).start()
+
+    def _wake(self):
+        with self.cond:
+            self.cond.notify()
+
+    def abort(self):
+        # shutdown trước khi writer kịp close(): close() không đánh thức recv đang chặn ở luồng đọc
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        super().abort()
+
+    def _writer(self):
+        try:
+            while not self.closed:
+                batch = self.take_all()
+                if batch:
+                    self._send_batch(batch)
+                    continue
+                if self.closing:
+                    break
+                with self.cond:
+                    if not self.frames and not self.closing and not self.closed:
+                        self.cond.wait()
+        except (BrokenPipeError, ConnectionResetError) as e:
+            logging.debug(f"[SEND] Kết nối đã đóng: {e}")  # Client ngắt giữa chừng: bình thường
+        except OSError as e:
+            if not self.closed:
+                logging.error(f"[SEND ERROR] {e}")
+        finally:
+            self.closed = True
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+
+    def _send_batch(self, batch):
+        """Gửi các frame đang chờ bằng sendmsg (scatter/gather): một syscall cho cả lô, không nối bytes"""
+        if not hasattr(self.sock, "sendmsg"):  # Windows
+            self.sock.sendall(b''.join(batch))
+            return
+        i = 0
+        while i < len(batch):
+            sent = self.sock.sendmsg(batch[i:i + SEND_IOV_MAX])
+            while sent:
+                size = len(batch[i])
+                if sent < size:
+                    batch[i] = memoryview(batch[i])[sent:]
+                    break
+                sent -= size
+                i += 1
+
+class AsyncConn(Outbox):
+    """Chế độ async: writer là một task trên event loop.
+    Các luồng khác (dọn dẹp, console) đánh thức writer qua call_soon_threadsafe."""
+    def __init__(self, writer, loop):
+        super().__init__(writer.get_extra_info('peername'))
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.ready = asyncio.Event()
+        self.task = loop.create_task(self._writer_loop())
+
+    def _call(self, func, *args):
+        if threading.get_ident() == self.loop_thread:
+            func(*args)
+        else:
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def _wake(self):
+        self._call(self.ready.set)
+
+    def abort(self):
+        super().abort()
+        self._call(self.writer.transport.abort)
+
+    async def _writer_loop(self):
+        try:
+            while not self.closed:
+                batch = self.take_all()
+                if batch:
+                    self.writer.writelines(batch)  # Transport gom thành một lần gửi (sendmsg nếu có)
+                    await self.writer.drain()
+                    continue
+                if self.closing:
+                    break
+                await self.ready.wait()
+                self.ready.clear()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            self.writer.close()
+
+class RemoteConn:
+    """Kết nối của user đang ở worker khác (cluster): frame gửi tới được chuyển qua broker
+    cho worker giữ kết nối thật, worker đó xếp vào Outbox của client."""
+    closing = closed = timed_out = False
+    deflater = None
+
+    def __init__(self, username, protocol):
+        self.username = username
+        self.protocol = protocol
+
+    def sendall(self, data):
+        """True chỉ có nghĩa đã chuyển cho broker: Outbox ở worker kia vẫn có thể bỏ frame.
+        Chunk file không dùng đường này mà đi bằng "file_chunk" để worker kia báo hủy được (apply_file_chunk)."""
+        bus.to_user(self.username, "frame", self.username, bytes(data))
+        return True
+
+    def depth(self):
+        return 0, 0
+
+class IdleTracker:
+    """Phát hiện kết nối không hoạt động cho cả hai chế độ bằng một hashed timer wheel.
+    Nhận frame chỉ cập nhật conn.last_active (không khóa); mỗi tick một ô của wheel được xét:
+    kết nối quá hạn thì bị ngắt, còn lại được xếp vào ô ứng với hạn mới."""
+    def __init__(self, tick=IDLE_TICK, slots=IDLE_WHEEL_SLOTS):
+        self.tick = tick
+        self.wheel = [set() for _ in range(slots)]
+        self.pos = 0  # Ô sẽ xét ở tick tiếp theo
+        self.slot_of = {}  # conn -> ô đang chứa
+        self.lock = threading.Lock()
+        self.expired = 0
+
+    def watch(self, conn):
+        with self.lock:
+            self._schedule(conn, time.monotonic())
+
+    def _schedule(self, conn, now):
+        old = self.slot_of.pop(conn, None)
+        if old is not None:
+            self.wheel[old].discard(conn)
+        if conn.idle_timeout is None or conn.closed:
+            return
+        ticks = int((conn.last_active + conn.idle_timeout - now) / self.tick) + 1
+        slot = (self.pos + min(max(ticks, 1), len(self.wheel)) - 1) % len(self.wheel)
+        self.wheel[slot].add(conn)
+        self.slot_of[conn] = slot
+
+    def run(self):
+        next_tick = time.monotonic() + self.tick
+        while True:
+            time.sleep(max(0, next_tick - time.monotonic()))
+            next_tick += self.tick
+            now = time.monotonic()
+            expired = []
+            with self.lock:
+                due = self.wheel[self.pos]
+                self.wheel[self.pos] = set()
+                self.pos = (self.pos + 1) % len(self.wheel)
+                for conn in due:
+                    del self.slot_of[conn]
+                    if conn.idle_timeout is not None and not conn.closed and conn.last_active + conn.idle_timeout <= now:
+                        expired.append(conn)
+                    else:
+                        self._schedule(conn, now)
+                self.expired += len(expired)
+            for conn in expired:
+                conn.expire()
+
+    def __len__(self):
+        with self.lock:
+            return len(self.slot_of)
+
+idle_tracker = IdleTracker()
+
+class Admission:
+    """Cấp chỗ cho kết nối mới, kiểm tra và giữ chỗ trong cùng một lần khóa nên không thể vượt MAX_CLIENTS.
+    Kết nối được vào giữ một chỗ "handshake" (tối đa MAX_HANDSHAKES) trong lúc xác thực, đăng nhập xong
+    chỗ đó thành chỗ "session"; tổng hai loại không vượt MAX_CLIENTS. Khi hết chỗ, kết nối xếp hàng
+    (tối đa ADMISSION_QUEUE, nhận HÀNG CHỜ:<vị trí>) và được đánh thức theo thứ tự khi có chỗ trống."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handshakes = 0
+        self.sessions = 0
+        self.waiting = OrderedDict()  # conn -> hàm đánh thức, theo thứ tự tới
+        self.stats = {"admitted": 0, "queued": 0, "rejected": 0, "abandoned": 0}
+
+    def enter(self, conn, wake):
+        """0: vào ngay; n > 0: vị trí trong hàng đợi, wake() được gọi khi tới lượt; None: hàng đợi cũng đầy.
+        Vị trí chỉ được gửi khi đang giữ khóa và kết nối còn trong hàng, nên không frame HÀNG CHỜ nào
+        tới sau lời chào XÁC THỰC."""
+        with self.lock:
+            if not self.waiting and self._has_room():
+                self._admit(conn)
+                return 0
+            if len(self.waiting) >= ADMISSION_QUEUE:
+                self.stats["rejected"] += 1
+                return None
+            self.waiting[conn] = wake
+            self.stats["queued"] += 1
+            send_message(conn, f"HÀNG CHỜ:{len(self.waiting)}")
+            return len(self.waiting)
+
+    def login(self, conn):
+        """Xác thực xong: chỗ xác thực thành chỗ phiên (đã giữ từ lúc vào)"""
+        with self.lock:
+            if conn.admission == "handshake":
+                self.handshakes -= 1
+                self.sessions += 1
+                conn.admission = "session"
+        self._admit_waiting()  # Có thể đang chờ vì đủ MAX_HANDSHAKES
+
+    def leave(self, conn):
+        """Kết nối đóng hoặc thôi chờ: trả chỗ (hoặc rời hàng đợi) rồi cho người kế tiếp vào"""
+        with self.lock:
+            if self.waiting.pop(conn, None) is not None:
+                self.stats["abandoned"] += 1
+            elif conn.admission == "handshake":
+                self.handshakes -= 1
+            elif conn.admission == "session":
+                self.sessions -= 1
+            conn.admission = None
+        self._admit_waiting()
+
+    def _has_room(self):
+        return self.handshakes < MAX_HANDSHAKES and self.handshakes + self.sessions < MAX_CLIENTS
+
+    def _admit(self, conn):
+        conn.admission = "handshake"
+        self.handshakes += 1
+        self.stats["admitted"] += 1
+
+    def _admit_waiting(self):
+        woken = []
+        with self.lock:
+            while self.waiting and self._has_room():
+                conn, wake = self.waiting.popitem(last=False)
+                self._admit(conn)
+                woken.append(wake)
+            if woken:
+                for position, conn in enumerate(self.waiting, 1):
+                    send_message(conn, f"HÀNG CHỜ:{position}")  # Chỉ xếp vào Outbox, không chặn
+        for wake in woken:
+            wake()
+
+admission = Admission()
+
+class TokenBucket:
+    """Cho phép tối đa burst lần liên tiếp, hồi lại rate lần mỗi giây"""
+    __slots__ = ("burst", "rate", "tokens", "stamp")
+
+    def __init__(self, burst, rate, now):
+        self.burst = burst
+        self.rate = rate
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now):
+        """0 nếu còn lượt (đã trừ một lượt), ngược lại số giây phải chờ tới lượt kế tiếp"""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+class RateState:
+    """Budget của một kết nối hoặc phiên: loại -> TokenBucket, và các lần bị chặn gần đây"""
+    __slots__ = ("buckets", "strikes")
+
+    def __init__(self):
+        self.buckets = {}
+        self.strikes = deque()
+
+class RateLimitExceeded(Exception):
+    """Client vẫn gửi dồn sau RATE_STRIKES lần bị chặn: ngắt kết nối"""
+
+class RateLimiter:
+    """Token bucket theo phiên và theo IP cho từng loại trong RATE_LIMITS.
+    Yêu cầu chỉ được xử lý khi cả bucket của phiên lẫn bucket của IP còn lượt; một bot mở nhiều
+    kết nối vẫn chỉ có budget của một IP (x RATE_IP_FACTOR). Bucket tạo lúc dùng lần đầu,
+    bucket IP giữ trong bảng LRU tối đa RATE_IP_TABLE mục."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ips = OrderedDict()  # (ip, loại) -> TokenBucket
+        self.stats = Counter()  # loại -> số lần bị chặn
+        self.disconnects = 0
+
+    def check(self, state, ip, kind):
+        """0 nếu được phép, ngược lại số giây client nên chờ"""
+        limit = RATE_LIMITS.get(kind)
+        if not limit:
+            return 0
+        burst, rate = limit
+        now = time.monotonic()
+        with self.lock:
+            bucket = state.buckets.get(kind)
+            if bucket is None:
+                bucket = state.buckets[kind] = TokenBucket(burst, rate, now)
+            wait = bucket.take(now)
+            if not wait:
+                key = (ip, kind)
+                ip_bucket = self.ips.pop(key, None) or TokenBucket(burst * RATE_IP_FACTOR, rate * RATE_IP_FACTOR, now)
+                self.ips[key] = ip_bucket
+                if len(self.ips) > RATE_IP_TABLE:
+                    self.ips.popitem(last=False)
+                wait = ip_bucket.take(now)
+                if wait:
+                    bucket.tokens += 1  # Không xử lý thì không tính vào budget của phiên
+            if wait:
+                self.stats[kind] += 1
+            return wait
+
+    def strike(self, state):
+        """Ghi nhận một lần bị chặn; True nếu đã quá RATE_STRIKES lần trong RATE_STRIKE_WINDOW giây"""
+        now = time.monotonic()
+        with self.lock:
+            state.strikes.append(now)
+            while state.strikes[0] <= now - RATE_STRIKE_WINDOW:
+                state.strikes.popleft()
+            if len(state.strikes) < RATE_STRIKES:
+                return False
+            self.disconnects += 1
+            return True
+
+rate_limiter = RateLimiter()
+
+def throttle(conn, state, kind, wait):
+    """Báo client CHẬM LẠI (yêu cầu bị bỏ qua, thử lại sau wait giây).
+    Raise RateLimitExceeded khi client vẫn gửi dồn sau nhiều lần bị chặn."""
+    wait_ms = math.ceil(wait * 1000)
+    send_typed(conn, OP_THROTTLE, kind, wait_ms, text=f"CHẬM LẠI:{kind}:{wait_ms}")
+    if rate_limiter.strike(state):
+        raise RateLimitExceeded(kind)
+
+def is_loopback(ip):
+    try:
+        return ipaddress.ip_address(ip).is_loopback
+    except ValueError:
+        return False
+
+def rate_limited(conn, state, kind):
+    """True nếu yêu cầu loại kind vượt budget (đã báo client, bên gọi bỏ qua yêu cầu)"""
+    if not RATE_LIMIT_LOOPBACK and is_loopback(conn.addr[0]):
+        return False
+    wait = rate_limiter.check(state, conn.addr[0], kind)
+    if wait:
+        throttle(conn, state, kind, wait)
+    return bool(wait)
+
+class Session:
+    """Một client đã đăng nhập"""
+    def __init__(self, conn, addr, username):
+        self.conn = conn
+        self.addr = addr
+        self.username = username
+        self.room_type = "public"  # "public" (phòng chung hoặc kênh) hoặc "private"
+        self.room_target = None  # public: tên kênh (None = phòng chung), private: người chat riêng cùng
+        self.history_cursor = 0  # id tin cũ nhất đã gửi trong phòng hiện tại (0 = hết lịch sử)
+        self.delta = False  # Client gửi ĐỒNG BỘ: nhận tin chat kèm id, lịch sử vào phòng chỉ gồm tin mới
+        self.last_seen = {}  # room_key -> id tin mới nhất client đã nhận
+        self.resume_token = None
+        self.detached_at = None  # Thời điểm mất kết nối (None = đang kết nối)
+        self.rate = RateState()  # Giữ qua khôi phục phiên, kết nối lại không được budget mới
+        self.shard = None  # Cluster: worker đang giữ kết nối (None = worker này, còn lại là bản sao)
+
+class SessionRegistry:
+    """Danh bạ phiên theo username kèm tập thành viên từng phòng.
+    Tra cứu và chuyển phòng là O(1), broadcast chỉ duyệt thành viên của kênh gửi tới.
+    Trong cluster, danh bạ gồm cả bản sao phiên của các worker khác: mọi thay đổi được phát qua bus
+    và áp dụng bằng các hàm replica_*; `channels` chỉ giữ phiên của worker này để broadcast cục bộ."""
+    def __init__(self):
+        self.sessions = {}       # username -> Session
+        self.channels = {None: {}}  # kênh (None = phòng chung) -> {username: Session đang kết nối ở kênh}
+        self.private_pairs = {}  # username -> người chat riêng cùng
+        self.tokens = {}         # resume token -> username
+
+    def __len__(self):
+        with lock:
+            return len(self.sessions)
+
+    def get(self, username):
+        with lock:
+            return self.sessions.get(username)
+
+    def add(self, conn, addr, username):
+        """Thêm phiên vào phòng chung; trả về None nếu username đã online (ở bất kỳ worker nào)"""
+        if bus and not bus.call("claim", username, conn.protocol):
+            return None
+        with lock:
+            old = self.sessions.get(username)
+            if old and old.shard is None:
+                return None
+            if old:
+                self._drop(old)  # Bản sao cũ chưa kịp nhận thông báo rời đi
+            session = Session(conn, addr, username)
+            self.sessions[username] = session
+            self.channels[None][username] = session
+            return session
+
+    def remove(self, username):
+        with lock:
+            session = self.sessions.get(username)
+            if session and session.shard is None:
+                self._drop(session)
+                self._publish("remove", username)
+                return session
+            return None
+
+    def _drop(self, session):
+        del self.sessions[session.username]
+        self._leave_room(session)
+        self.tokens.pop(session.resume_token, None)
+
+    def issue_token(self, session):
+        """Cấp resume token mới (token cũ hết hiệu lực)"""
+        with lock:
+            self.tokens.pop(session.resume_token, None)
+            session.resume_token = secrets.token_urlsafe(RESUME_TOKEN_BYTES)
+            self.tokens[session.resume_token] = session.username
+            self._publish("token", session.username, session.resume_token)
+            return session.resume_token
+
+    def detach(self, username, conn):
+        """Mất kết nối: giữ phiên và phòng trong RESUME_GRACE giây, ngừng nhận tin của kênh"""
+        with lock:
+            session = self.sessions.get(username)
+            if not session or session.conn is not conn:
+                return None
+            session.detached_at = time.time()
+            self._leave_channel(session)
+            self._publish("detach", username)
+            return session
+
+    def resume(self, token, conn, addr):
+        """Gắn kết nối mới vào phiên đang tạm ngắt; trả về None nếu token sai hoặc đã hết hạn.
+        Phiên đang tạm ngắt ở worker khác được chuyển về worker này (handoff qua broker)."""
+        with lock:
+            session = self.sessions.get(self.tokens.get(token))
+            if not session or session.detached_at is None:
+                return None
+            remote = session.shard is not None
+            if not remote:
+                self._attach(session, conn, addr)
+                self._publish("attach", session.username)
+                return session
+        state = bus.call("handoff", session.username, token, user=session.username)
+        if not state:
+            return None
+        with lock:
+            if self.sessions.get(session.username) is not session:
+                return None
+            session.shard = None
+            session.history_cursor, session.delta, session.last_seen = state
+            self._attach(session, conn, addr)
+            return session
+
+    def _attach(self, session, conn, addr):
+        session.conn, session.addr, session.detached_at = conn, addr, None
+        if session.room_type == "public":
+            self.channels.setdefault(session.room_target, {})[session.username] = session
+
+    def detached(self, older_than):
+        """Phiên tạm ngắt quá hạn của worker này"""
+        with lock:
+            return [s.username for s in self.sessions.values()
+                    if s.shard is None and s.detached_at is not None and s.detached_at < older_than]
+
+    def set_room(self, username, room_type, room_target=None):
+        with lock:
+            session = self._set_room(username, room_type, room_target)
+            if session:
+                self._publish("room", username, room_type, room_target)
+            return session
+
+    def _set_room(self, username, room_type, room_target):
+        session = self.sessions.get(username)
+        if not session:
+            return None
+        self._leave_room(session)
+        session.room_type, session.room_target = room_type, room_target
+        if room_type == "public":
+            if session.detached_at is None and session.shard is None:
+                self.channels.setdefault(room_target, {})[username] = session
+        else:
+            self.private_pairs[username] = room_target
+        return session
+
+    def _leave_room(self, session):
+        self._leave_channel(session)
+        self.private_pairs.pop(session.username, None)
+
+    def _leave_channel(self, session):
+        if session.room_type != "public":
+            return
+        members = self.channels.get(session.room_target)
+        if members is not None:
+            members.pop(session.username, None)
+            if not members and session.room_target is not None:
+                del self.channels[session.room_target]
+
+    def members(self, channel, exclude=None):
+        """Thành viên có kết nối ở worker này của kênh (None = phòng chung)"""
+        with lock:
+            return [s for u, s in self.channels.get(channel, {}).items() if u != exclude]
+
+    def rooms(self):
+        """Số người ở từng kênh trên toàn server (kể cả phiên tạm ngắt và phiên ở worker khác)"""
+        with lock:
+            counts = Counter(s.room_target for s in self.sessions.values() if s.room_type == "public")
+        counts.setdefault(None, 0)
+        return counts
+
+    def channel_shards(self, channel):
+        """Cluster: một thành viên của kênh ở mỗi worker khác, dùng làm đích gọi tới worker đó"""
+        with lock:
+            return {s.shard: s.username for s in self.sessions.values()
+                    if s.shard is not None and s.room_type == "public" and s.room_target == channel}
+
+    def pairs(self):
+        with lock:
+            return {tuple(sorted(pair)) for pair in self.private_pairs.items()}
+
+    def all(self):
+        with lock:
+            return list(self.sessions.values())
+
+    def local(self):
+        """Phiên có kết nối ở worker này"""
+        with lock:
+            return [s for s in self.sessions.values() if s.shard is None]
+
+    def _publish(self, *msg):
+        if bus:
+            bus.publish(*msg)
+
+    # --- Áp dụng thay đổi từ worker khác (luồng bus, không phát lại) ---
+
+    def replica_add(self, shard, username, protocol):
+        with lock:
+            old = self.sessions.get(username)
+            if old:
+                self._drop(old)
+            session = Session(RemoteConn(username, protocol), None, username)
+            session.shard = shard
+            self.sessions[username] = session
+
+    def replica(self, shard, username):
+        """Bản sao phiên username do worker shard giữ, None nếu không có"""
+        session = self.sessions.get(username)
+        return session if session and session.shard == shard else None
+
+    def replica_remove(self, shard, username):
+        with lock:
+            session = self.replica(shard, username)
+            if session:
+                self._drop(session)
+            return session
+
+    def replica_token(self, shard, username, token):
+        with lock:
+            session = self.replica(shard, username)
+            if session:
+                self.tokens.pop(session.resume_token, None)
+                session.resume_token = token
+                self.tokens[token] = username
+
+    def replica_detach(self, shard, username, detached):
+        with lock:
+            session = self.replica(shard, username)
+            if session:
+                session.detached_at = time.time() if detached else None
+
+    def replica_room(self, username, room_type, room_target):
+        with lock:
+            return self._set_room(username, room_type, room_target)
+
+    def hand_off(self, username, token, shard):
+        """Chuyển phiên tạm ngắt của worker này sang worker shard; trả về trạng thái cần giữ lại"""
+        with lock:
+            session = self.sessions.get(username)
+            if not session or session.shard is not None or session.detached_at is None or session.resume_token != token:
+                return None
+            session.shard, session.conn, session.detached_at = shard, RemoteConn(username, session.conn.protocol), None
+            return session.history_cursor, session.delta, session.last_seen
+
+    def replica_moved(self, shard, username):
+        with lock:
+            session = self.sessions.get(username)
+            if session and session.shard is not None:
+                session.shard, session.detached_at = shard, None
+
+registry = SessionRegistry()
+bus = None  # cluster.Bus của worker này khi chạy cluster, None khi chạy một process
+
+class DBPool:
+    """Pool kết nối SQLite mở một lần lúc khởi động, mọi truy cập DB đều đi qua đây.
+    Kết nối sống lâu nên sqlite3 giữ lại được các câu lệnh đã biên dịch (prepared statement);
+    WAL cho phép đọc song song với ghi, busy_timeout thay cho lỗi 'database is locked'."""
+    def __init__(self, path, size):
+        self.path = path
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(self._open())
+
+    def _open(self):
+        db = sqlite3.connect(self.path, timeout=DB_BUSY_TIMEOUT / 1000, check_same_thread=False,
+                             cached_statements=DB_STATEMENT_CACHE)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        db.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT}")
+        return db
+
+    @contextmanager
+    def connection(self):
+        db = self.idle.get()
+        try:
+            yield db
+        finally:
+            if db.in_transaction:
+                db.rollback()
+            self.idle.put(db)
+
+class MessageLog:
+    """Ghi tin nhắn kiểu write-behind: save_msg chỉ xếp hàng, một luồng ghi gom các tin
+    thành một transaction (executemany) khi đủ DB_BATCH_SIZE tin hoặc sau DB_FLUSH_INTERVAL giây."""
+    def __init__(self, pool):
+        self.pool = pool
+        self.pending = []  # (private_to, params)
+        self.first_at = 0
+        self.queued = 0    # Tổng số tin đã xếp hàng
+        self.written = 0   # Tổng số tin đã xử lý xong (ghi hoặc lỗi)
+        self.flush_requested = False
+        self.stopping = False
+        self.cond = threading.Condition()
+        self.stats = {"batches": 0, "messages": 0, "errors": 0, "max_batch": 0,
+                      "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0}
+        # id do server cấp ngay khi xếp hàng để cache/lịch sử dùng được trước khi ghi xuống DB
+        with pool.connection() as db:
+            self.last_id = {
+                "public": db.execute("SELECT COALESCE(MAX(id), 0) FROM public_messages").fetchone()[0],
+                "private": db.execute("SELECT COALESCE(MAX(id), 0) FROM private_messages").fetchone()[0],
+            }
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def append(self, private_to, params):
+        """Xếp hàng một tin, trả về id cấp cho tin đó.
+        Trong cluster mỗi worker cấp id trong dải riêng (id % WORKERS == shard) nên các worker cùng ghi
+        một DB không trùng id mà không phải hỏi ai; observe() đẩy bộ đếm qua id của worker khác
+        để tin mới luôn có id lớn hơn các tin worker này đã thấy."""
+        kind = "private" if private_to else "public"
+        with self.cond:
+            msg_id = self.last_id[kind] + 1
+            if bus:
+                msg_id += (bus.shard - msg_id) % WORKERS
+            self.last_id[kind] = msg_id
+            if not self.pending:
+                self.first_at = time.monotonic()
+            self.pending.append((private_to, (msg_id,) + params))
+            self.queued += 1
+            if len(self.pending) >= DB_BATCH_SIZE:
+                self.cond.notify_all()
+            return msg_id
+
+    def observe(self, kind, msg_id):
+        """Cluster: ghi nhận id tin worker khác vừa cấp"""
+        with self.cond:
+            if msg_id > self.last_id[kind]:
+                self.last_id[kind] = msg_id
+
+    def flush(self):
+        """Chờ tới khi mọi tin đã xếp hàng tính tới lúc gọi được ghi xuống DB"""
+        with self.cond:
+            target = self.queued
+            if self.written >= target:
+                return
+            self.flush_requested = True
+            self.cond.notify_all()
+            while self.written < target:
+                self.cond.wait()
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.flush()
+
+    def _due(self):
+        if not self.pending:
+            return False
+        return (self.stopping or self.flush_requested or len(self.pending) >= DB_BATCH_SIZE or
+                time.monotonic() - self.first_at >= DB_FLUSH_INTERVAL)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self._due():
+                    timeout = None
+                    if self.pending:
+                        timeout = max(0, DB_FLUSH_INTERVAL - (time.monotonic() - self.first_at))
+                    self.cond.wait(timeout)
+                batch, self.pending = self.pending, []
+                self.flush_requested = False
+                target = self.queued
+            self._write(batch)
+            with self.cond:
+                self.written = target
+                self.cond.notify_all()
+
+    def _write(self, batch):
+        public_rows = [params for private_to, params in batch if not private_to]
+        private_rows = [params for private_to, params in batch if private_to]
+        start = time.perf_counter()
+        for attempt in range(DB_WRITE_RETRIES + 1):
+            try:
+                with self.pool.connection() as db:
+                    if public_rows:
+                        db.executemany("INSERT INTO public_messages (id, username, message, timestamp, channel) VALUES (?, ?, ?, ?, ?)", public_rows)
+                    if private_rows:
+                        db.executemany("INSERT INTO private_messages (id, sender, receiver, message, timestamp, conversation) VALUES (?, ?, ?, ?, ?, ?)", private_rows)
+                    db.commit()
+                break
+            except Exception as e:
+                if attempt < DB_WRITE_RETRIES:
+                    logging.warning(f"[DB] Ghi {len(batch)} tin nhắn thất bại, thử lại: {e}")
+                    time.sleep(0.1 * 2 ** attempt)
+                    continue
+                self.stats["errors"] += 1
+                logging.error(f"[DB ERROR] Ghi {len(batch)} tin nhắn thất bại, bỏ khỏi cache lịch sử: {e}")
+                # Cache đã nhận các tin này lúc xếp hàng: bỏ đi để lịch sử khớp với DB
+                public = [(params[0], params[4] or None) for params in public_rows]
+                private = [(params[0], params[5]) for params in private_rows]
+                history_cache.discard(public, private)
+                if bus:
+                    bus.publish("history_discard", public, private)
+                return
+        elapsed = (time.perf_counter() - start) * 1000
+        stats = self.stats
+        stats["batches"] += 1
+        stats["messages"] += len(batch)
+        stats["max_batch"] = max(stats["max_batch"], len(batch))
+        stats["last_ms"] = elapsed
+        stats["max_ms"] = max(stats["max_ms"], elapsed)
+        stats["total_ms"] += elapsed
+
+class HistoryCache:
+    """Lịch sử gần nhất trong RAM: ring buffer phòng chung + LRU các kênh và các cuộc chat riêng.
+    Mỗi dòng lưu sẵn dạng đã format và mã hóa UTF-8 kèm id, cùng dòng v2 đã pack sẵn,
+    phát lại chỉ là nối bytes. save_msg cập nhật cache trước khi tin được ghi xuống DB.
+    Cache miss nạp DB ngoài self.lock: một lần đọc chậm không chặn người đọc khác và save_msg."""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.loading = {}  # ("private", conversation) / ("channel", tên) -> (Event, dòng tới trong lúc nạp)
+        self.public_gap = False  # Đã bỏ tin ghi lỗi khỏi phòng chung: cache không còn chắc giữ toàn bộ lịch sử
+        self.public = deque(maxlen=HISTORY_LIMIT)  # (id, dòng, dòng v2)
+        self.channels = OrderedDict()  # tên kênh -> deque như phòng chung
+        self.private = OrderedDict()  # conversation -> deque[(id, sender, dòng "Bạn", dòng tên người gửi, dòng v2)]
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def public_row(msg_id, uname, txt, ts):
+        return (msg_id, f"[{ts}] {uname}: {txt}".encode('utf-8'), pack_row(msg_id, ts, uname, txt))
+
+    @staticmethod
+    def private_row(msg_id, sender, txt, ts):
+        return (msg_id, sender, f"[{ts}] Bạn: {txt}".encode('utf-8'), f"[{ts}] {sender}: {txt}".encode('utf-8'),
+                pack_row(msg_id, ts, sender, txt))
+
+    @staticmethod
+    def line(row, viewer, protocol):
+        """Dòng gửi cho viewer: v2 dùng chung một dòng có tên người gửi, v1 dòng chat riêng tùy góc nhìn"""
+        if protocol == 2:
+            return row[-1]
+        if len(row) == 3:
+            return row[1]
+        return row[2] if row[1] == viewer else row[3]
+
+    @staticmethod
+    def _row_size(row):
+        return sum(len(part) for part in row if isinstance(part, bytes))
+
+    def _push(self, rows, row):
+        if len(rows) == rows.maxlen:
+            self.size -= self._row_size(rows[0])
+        rows.append(row)
+        self.size += self._row_size(row)
+        if len(rows) > 1 and rows[-2][0] > row[0]:
+            # Cluster: tin của worker khác có thể tới sau tin có id lớn hơn, giữ cache theo thứ tự id
+            ordered = sorted(rows, key=lambda r: r[0])
+            rows.clear()
+            rows.extend(ordered)
+
+    def _evict(self):
+        while len(self.channels) > HISTORY_CACHE_CHANNELS:
+            _, rows = self.channels.popitem(last=False)
+            self.size -= sum(self._row_size(row) for row in rows)
+        while (self.private or self.channels) and (len(self.private) > HISTORY_CACHE_PAIRS or self.size > HISTORY_CACHE_BYTES):
+            _, rows = (self.private or self.channels).popitem(last=False)
+            self.size -= sum(self._row_size(row) for row in rows)
+
+    def add_public(self, msg_id, uname, txt, ts, channel=None):
+        """Phòng chung luôn cập nhật; kênh chỉ cập nhật khi đã có trong cache (như chat riêng)"""
+        with self.lock:
+            rows = self.public if channel is None else self.channels.get(channel)
+            if rows is not None:
+                self._push(rows, self.public_row(msg_id, uname, txt, ts))
+                self._evict()
+            elif ("channel", channel) in self.loading:
+                self.loading[("channel", channel)][1].append(self.public_row(msg_id, uname, txt, ts))
+
+    def add_private(self, msg_id, sender, receiver, txt, ts):
+        """Chỉ cập nhật cuộc chat đã có trong cache; chưa có thì lần đọc sau sẽ nạp từ DB"""
+        with self.lock:
+            key = conversation_key(sender, receiver)
+            rows = self.private.get(key)
+            if rows is not None:
+                self._push(rows, self.private_row(msg_id, sender, txt, ts))
+                self._evict()
+            elif ("private", key) in self.loading:
+                self.loading[("private", key)][1].append(self.private_row(msg_id, sender, txt, ts))
+
+    def rows(self, viewer, room_type, partner, protocol=1):
+        """Các dòng (id, bytes) trong cache theo góc nhìn viewer, cũ -> mới, và cờ cache đã đầy.
+        Cache chưa đầy nghĩa là nó đang giữ toàn bộ lịch sử của phòng."""
+        if room_type == "private" and is_remote(partner) and conversation_key(viewer, partner) not in self.private:
+            # Cluster: tin người kia gửi có thể còn trong hàng đợi ghi của worker khác, nhờ ghi trước khi đọc DB.
+            # Gọi ngoài self.lock để worker kia không phải chờ cache của worker này.
+            bus.call("flush", user=partner)
+        elif room_type == "public" and partner and bus and partner not in self.channels:
+            for member in registry.channel_shards(partner).values():
+                bus.call("flush", user=member)
+        if room_type == "private":
+            rows = self._load("private", conversation_key(viewer, partner),
+                              lambda: [self.private_row(msg_id, sender, txt, ts)
+                                       for msg_id, sender, _, txt, ts in get_history(viewer, partner, HISTORY_LIMIT)])
+        elif partner:
+            rows = self._load("channel", partner,
+                              lambda: [self.public_row(*msg) for msg in get_history(limit=HISTORY_LIMIT, channel=partner)])
+        else:
+            with self.lock:
+                self.hits += 1
+            rows = self.public
+        with self.lock:
+            view = [(row[0], self.line(row, viewer, protocol)) for row in rows]
+            return view, len(rows) == rows.maxlen or (rows is self.public and self.public_gap)
+
+    def discard(self, public, private):
+        """Bỏ các tin ghi DB thất bại: public = [(id, kênh hoặc None)], private = [(id, conversation)].
+        Kênh / chat riêng bị bỏ khỏi cache để lần đọc sau nạp lại từ DB; phòng chung không nạp lại
+        nên chỉ xóa các dòng đó và đánh dấu có thể còn tin cũ hơn trong DB."""
+        ids = {"channel": {msg_id for msg_id, _ in public}, "private": {msg_id for msg_id, _ in private}}  # Hai dãy id riêng
+        with self.lock:
+            entries = ([("channel", channel) for _, channel in public if channel] +
+                       [("private", key) for _, key in private])
+            for kind, name in set(entries):
+                rows = self._table(kind).pop(name, None)
+                if rows is not None:
+                    self.size -= sum(self._row_size(row) for row in rows)
+            if any(channel is None for _, channel in public):
+                kept = [row for row in self.public if row[0] not in ids["channel"]]
+                if len(kept) < len(self.public):
+                    self.size -= sum(self._row_size(row) for row in self.public if row[0] in ids["channel"])
+                    self.public.clear()
+                    self.public.extend(kept)
+                    self.public_gap = True
+            for (kind, _), (_, arrived) in self.loading.items():
+                arrived[:] = [row for row in arrived if row[0] not in ids[kind]]
+
+    def _table(self, kind):
+        return self.private if kind == "private" else self.channels
+
+    def _load(self, kind, name, load):
+        """Dòng của một kênh / cuộc chat riêng; chưa có thì nạp bằng load() ngoài self.lock rồi mới đưa vào cache.
+        Tin tới trong lúc nạp được add_* giữ lại và gộp vào (bỏ trùng id với dữ liệu DB);
+        người đọc khác cùng phòng chờ lần nạp đang chạy thay vì nạp lại."""
+        key = (kind, name)
+        table = self._table(kind)
+        while True:
+            with self.lock:
+                rows = table.get(name)
+                if rows is not None:
+                    self.hits += 1
+                    table.move_to_end(name)
+                    return rows
+                pending = self.loading.get(key)
+                if pending is None:
+                    self.misses += 1
+                    pending = self.loading[key] = (threading.Event(), [])
+                    break
+            pending[0].wait()  # Nạp xong (hoặc lỗi) thì kiểm lại từ đầu
+        try:
+            loaded = load()
+            with self.lock:
+                rows = self._install(table, name, loaded, pending[1])
+        finally:
+            with self.lock:
+                del self.loading[key]
+            pending[0].set()
+        return rows
+
+    def _install(self, table, name, loaded, arrived):
+        """Đưa các dòng vừa nạp vào cache; gọi khi giữ self.lock"""
+        rows = deque(maxlen=HISTORY_LIMIT)
+        ids = {row[0] for row in loaded}
+        for row in loaded + [row for row in arrived if row[0] not in ids]:
+            self._push(rows, row)
+        table[name] = rows
+        self._evict()
+        return rows
+
+    def warm_up(self):
+        """Nạp lịch sử phòng chung và các cuộc chat riêng gần đây nhất từ DB"""
+        public = get_history(limit=HISTORY_LIMIT)
+        with db_pool.connection() as db:
+            recent = db.execute("SELECT conversation FROM private_messages ORDER BY id DESC LIMIT ?",
+                                (HISTORY_WARM_PAIRS * HISTORY_LIMIT,)).fetchall()
+        keys = list(dict.fromkeys(key for (key,) in recent if key))[:HISTORY_WARM_PAIRS]
+        private = [(key, [self.private_row(msg_id, sender, txt, ts)
+                          for msg_id, sender, _, txt, ts in get_history(*key.split("|"), HISTORY_LIMIT)])
+                   for key in reversed(keys)]
+        with self.lock:
+            for msg_id, uname, txt, ts in public:
+                self._push(self.public, self.public_row(msg_id, uname, txt, ts))
+            for key, loaded in private:
+                self._install(self.private, key, loaded, [])
+        return len(self.public), len(self.private)
+
+db_pool = None
+message_log = None
+history_cache = HistoryCache()
+
+def conversation_key(user1, user2):
+    """Khóa chuẩn hóa của một cuộc chat riêng: cặp username đã sắp xếp"""
+    return "|".join(sorted((user1, user2)))
+
+def migrate_schema(db):
+    """Nâng cấp DB cũ lên SCHEMA_VERSION, từng bước theo PRAGMA user_version"""
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version < 1:
+        # v1: cột conversation + index (conversation, id) cho lịch sử chat riêng
+        logging.info(f"[DB] Nâng cấp schema v{version} -> v1 (index hội thoại chat riêng)")
+        columns = [row[1] for row in db.execute("PRAGMA table_info(private_messages)")]
+        if "conversation" not in columns:
+            db.execute("ALTER TABLE private_messages ADD COLUMN conversation TEXT")
+        db.execute("UPDATE private_messages SET conversation = CASE WHEN sender < receiver "
+                   "THEN sender || '|' || receiver ELSE receiver || '|' || sender END WHERE conversation IS NULL")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_private_conversation ON private_messages (conversation, id)")
+        db.execute("PRAGMA user_version = 1")
+        db.commit()
+    if version < 2:
+        # v2: cột channel (kênh /join, '' = phòng chung) + index (channel, id) cho lịch sử từng kênh
+        logging.info(f"[DB] Nâng cấp schema v{max(version, 1)} -> v2 (kênh chat)")
+        columns = [row[1] for row in db.execute("PRAGMA table_info(public_messages)")]
+        if "channel" not in columns:
+            db.execute("ALTER TABLE public_messages ADD COLUMN channel TEXT NOT NULL DEFAULT ''")
+        db.execute("CREATE INDEX IF NOT EXISTS idx_public_channel ON public_messages (channel, id)")
+        db.execute("PRAGMA user_version = 2")
+        db.commit()
 
 def db_init():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password_hash TEXT, created_at TEXT)")
-    c.execute("CREATE TABLE IF NOT EXISTS public_messages (id INTEGER PRIMARY KEY, username TEXT, message TEXT, timestamp TEXT)")
-    c.execute("CREATE TABLE IF NOT EXISTS private_messages (id INTEGER PRIMARY KEY, sender TEXT, receiver TEXT, message TEXT, timestamp TEXT)")
-    conn.commit()
-    c.execute("SELECT COUNT(*) FROM users")
-    count = c.fetchone()[0]
-    conn.close()
+    global db_pool, message_log
+    db_pool = DBPool(DB_FILE, DB_POOL_SIZE)
+    with db_pool.connection() as db:
+        c = db.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password_hash TEXT, created_at TEXT)")
+        c.execute("CREATE TABLE IF NOT EXISTS public_messages (id INTEGER PRIMARY KEY, username TEXT, message TEXT, timestamp TEXT, channel TEXT NOT NULL DEFAULT '')")
+        c.execute("CREATE TABLE IF NOT EXISTS private_messages (id INTEGER PRIMARY KEY, sender TEXT, receiver TEXT, message TEXT, timestamp TEXT, conversation TEXT)")
+        db.commit()
+        migrate_schema(db)
+        c.execute("SELECT COUNT(*) FROM users")
+        count = c.fetchone()[0]
+    message_log = MessageLog(db_pool)
     return count
 
 def hash_pwd(pwd):
@@ -113,6 +1329,15 @@ def validate_username(username):
         return False, "Tên tài khoản không được sử dụng từ khóa hệ thống"
     return True, ""
 
+def validate_channel(name):
+    if not name:
+        return False, "Tên kênh không được để trống"
+    if len(name) > MAX_CHANNEL_LENGTH:
+        return False, f"Tên kênh không được vượt quá {MAX_CHANNEL_LENGTH} ký tự"
+    if not USERNAME_PATTERN.match(name):
+        return False, "Tên kênh chỉ được chứa chữ, số và dấu gạch dưới"
+    return True, ""
+
 def validate_password(password):
     if not password:
         return False, "Mật khẩu không được để trống"
@@ -132,183 +1357,1195 @@ def validate_message(msg):
         return False, "Tin nhắn chứa ký tự không hợp lệ"
     return True, ""
 
+class AuthGuard:
+    """Đăng nhập không chạm SQLite khi có thể.
+    Cache bản ghi user: username -> mật khẩu đã băm (LRU USER_CACHE_SIZE), và các tên không tồn tại
+    (LRU USER_CACHE_MISSING, nhớ USER_CACHE_MISSING_TTL giây). DANGKY và /changepass cập nhật cache qua update().
+    Backoff theo tài khoản và theo IP: từ lần sai thứ AUTH_ACCOUNT_FREE (AUTH_IP_FREE) bị khóa AUTH_BACKOFF_BASE giây,
+    mỗi lần sai tiếp nhân đôi (tối đa AUTH_BACKOFF_MAX). Trong lúc khóa, yêu cầu bị từ chối trước khi tra DB."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = OrderedDict()  # username -> password_hash
+        self.missing = OrderedDict()  # username -> thời điểm tra DB không thấy
+        self.generation = 0  # Tăng mỗi lần cache đổi, kết quả DB đọc trước đó không được ghi đè lên
+        self.failures = OrderedDict()  # ("user", tên) / ("ip", địa chỉ) -> [số lần sai, lần sai cuối, khóa tới]
+        self.hits = 0
+        self.misses = 0
+        self.blocked_attempts = 0
+
+    def lookup(self, username):
+        """Mật khẩu đã băm của username, None nếu tài khoản không tồn tại"""
+        now = time.monotonic()
+        with self.lock:
+            if username in self.users:
+                self.users.move_to_end(username)
+                self.hits += 1
+                return self.users[username]
+            missing_at = self.missing.get(username)
+            if missing_at is not None and now - missing_at < USER_CACHE_MISSING_TTL:
+                self.hits += 1
+                return None
+            self.misses += 1
+            generation = self.generation
+        with db_pool.connection() as db:
+            row = db.execute("SELECT password_hash FROM users WHERE username=?", (username,)).fetchone()
+        with self.lock:
+            if generation == self.generation:
+                if row:
+                    self._store(username, row[0])
+                else:
+                    self.missing[username] = now
+                    self.missing.move_to_end(username)
+                    if len(self.missing) > USER_CACHE_MISSING:
+                        self.missing.popitem(last=False)
+        return row[0] if row else None
+
+    def exists(self, username):
+        """True nếu chắc chắn tài khoản đã có (chỉ xem cache, không tra DB)"""
+        with self.lock:
+            return username in self.users
+
+    def _store(self, username, password_hash):
+        self.missing.pop(username, None)
+        self.users[username] = password_hash
+        self.users.move_to_end(username)
+        if len(self.users) > USER_CACHE_SIZE:
+            self.users.popitem(last=False)
+
+    def forget(self, username):
+        with self.lock:
+            self.generation += 1
+            self.users.pop(username, None)
+            self.missing.pop(username, None)
+
+    def update(self, username, password_hash):
+        """Tài khoản vừa tạo hoặc đổi mật khẩu; cluster: các worker khác bỏ mục cũ và tra lại DB khi cần.
+        Lần sai trước đó (kể cả lúc tên chưa tồn tại) không còn tính cho tài khoản này."""
+        with self.lock:
+            self.generation += 1
+            self._store(username, password_hash)
+            self.failures.pop(("user", username), None)
+        if bus:
+            bus.publish("user_changed", username)
+
+    def blocked(self, username, ip):
+        """Số giây còn bị khóa (tài khoản hoặc IP), 0 nếu được thử"""
+        now = time.monotonic()
+        with self.lock:
+            wait = max((entry[2] - now for entry in map(self.failures.get, (("user", username), ("ip", ip))) if entry),
+                       default=0)
+            if wait > 0:
+                self.blocked_attempts += 1
+                return wait
+            return 0
+
+    def failed(self, username, ip):
+        """Ghi nhận một lần sai; trả về số giây tài khoản/IP vừa bị khóa (0 = chưa khóa)"""
+        now = time.monotonic()
+        lock_for = 0
+        with self.lock:
+            for key, free in ((("user", username), AUTH_ACCOUNT_FREE), (("ip", ip), AUTH_IP_FREE)):
+                entry = self.failures.pop(key, None)
+                if entry is None or now - entry[1] > AUTH_FAILURE_WINDOW:
+                    entry = [0, now, 0]
+                entry[0] += 1
+                entry[1] = now
+                if entry[0] >= free:
+                    delay = min(AUTH_BACKOFF_BASE * 2 ** (entry[0] - free), AUTH_BACKOFF_MAX)
+                    entry[2] = now + delay
+                    lock_for = max(lock_for, delay)
+                self.failures[key] = entry
+            while len(self.failures) > AUTH_GUARD_TABLE:
+                self.failures.popitem(last=False)
+        return lock_for
+
+    def succeeded(self, username):
+        with self.lock:
+            self.failures.pop(("user", username), None)
+
+    def locked(self):
+        """(số tài khoản, số IP) đang bị khóa"""
+        now = time.monotonic()
+        with self.lock:
+            kinds = Counter(key[0] for key, entry in self.failures.items() if entry[2] > now)
+        return kinds["user"], kinds["ip"]
+
+auth_guard = AuthGuard()
+
 def get_client_count():
+    """Số phiên đang kết nối ở process này (phiên tạm ngắt không giữ chỗ trong MAX_CLIENTS)"""
+    return sum(1 for s in registry.local() if s.detached_at is None)
+
+class PendingRequests:
+    """Yêu cầu chat riêng đang chờ, khóa (người gửi, người nhận) -> thời điểm gửi.
+    Heap theo thời điểm hết hạn + luồng riêng chờ đúng tới hạn gần nhất, nên yêu cầu hết hạn
+    đúng REQUEST_TIMEOUT mà không phải quét cả bảng. Dùng chung `lock` toàn cục để các lệnh
+    kiểm tra yêu cầu cùng trạng thái phòng trong một khối `with lock`.
+    Trong cluster mỗi worker giữ một bản sao (thay đổi phát qua bus); worker nào cũng tự xét hết hạn
+    nhưng chỉ báo cho user có kết nối ở worker đó."""
+    def __init__(self):
+        self.requests = {}     # (sender, receiver) -> thời điểm gửi
+        self.by_receiver = {}  # receiver -> {sender}
+        self.by_sender = {}    # sender -> {receiver}
+        self.heap = []         # (hạn, thời điểm gửi, sender, receiver); mục đã xử lý bỏ qua khi lấy ra
+        self.cond = threading.Condition(lock)
+
+    def __len__(self):
+        with lock:
+            return len(self.requests)
+
+    def __contains__(self, key):
+        with lock:
+            return key in self.requests
+
+    def items(self):
+        with lock:
+            return list(self.requests.items())
+
+    def add(self, sender, receiver, now=None, publish=True):
+        with self.cond:
+            now = now or time.time()
+            if publish and bus:
+                bus.publish("pending_add", sender, receiver, now)
+            self.requests[(sender, receiver)] = now
+            self.by_receiver.setdefault(receiver, set()).add(sender)
+            self.by_sender.setdefault(sender, set()).add(receiver)
+            heapq.heappush(self.heap, (now + REQUEST_TIMEOUT, now, sender, receiver))
+            self.cond.notify()
+
+    def pop(self, sender, receiver, publish=True):
+        """Xóa yêu cầu; trả về False nếu không có (hoặc đã hết hạn)"""
+        with lock:
+            if self.requests.pop((sender, receiver), None) is None:
+                return False
+            self._unindex(sender, receiver)
+            if publish and bus:
+                bus.publish("pending_pop", sender, receiver)
+            return True
+
+    def discard_user(self, username, publish=True):
+        """Bỏ mọi yêu cầu của/tới một user đã rời server"""
+        with lock:
+            for receiver in list(self.by_sender.get(username, ())):
+                self.pop(username, receiver, publish=False)
+            for sender in list(self.by_receiver.get(username, ())):
+                self.pop(sender, username, publish=False)
+            if publish and bus:
+                bus.publish("pending_discard", username)
+
+    def _unindex(self, sender, receiver):
+        for index, key, value in ((self.by_receiver, receiver, sender), (self.by_sender, sender, receiver)):
+            members = index.get(key)
+            if members:
+                members.discard(value)
+                if not members:
+                    del index[key]
+
+    def _pop_due(self, now):
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            _, sent_at, sender, receiver = heapq.heappop(self.heap)
+            if self.requests.get((sender, receiver)) == sent_at:
+                del self.requests[(sender, receiver)]
+                self._unindex(sender, receiver)
+                expired.append((sender, receiver))
+        return expired
+
+    def run(self):
+        """Luồng hết hạn: ngủ tới hạn gần nhất (hoặc tới khi có yêu cầu mới sớm hơn)"""
+        while True:
+            with self.cond:
+                expired = self._pop_due(time.time())
+                while not expired:
+                    self.cond.wait(self.heap[0][0] - time.time() if self.heap else None)
+                    expired = self._pop_due(time.time())
+            notify_expired(expired)
+
+pending_requests = PendingRequests()
+
+def is_remote(username):
+    """Cluster: user đang có kết nối ở worker khác"""
+    session = registry.get(username)
+    return session is not None and session.shard is not None
+
+def notify_expired(expired):
+    for sender, receiver in expired:
+        if not is_remote(sender):  # Worker giữ kết nối của người gửi báo, các worker khác bỏ qua
+            notify_result = notify(sender, f"Yêu cầu chat với {receiver} đã hết hạn ({REQUEST_TIMEOUT}s)")
+            if notify_result:
+                logging.info(f"[HẾT HẠN] {sender} -> {receiver} (đã thông báo người gửi)")
+            else:
+                logging.info(f"[HẾT HẠN] {sender} -> {receiver} (người gửi offline)")
+        if not is_remote(receiver):
+            notify_result = notify(receiver, f"Yêu cầu chat từ {sender} đã hết hạn ({REQUEST_TIMEOUT}s)")
+            if not notify_result:
+                logging.info(f"[HẾT HẠN] Không thể thông báo cho {receiver} (offline)")
+
+class FileTransfer:
+    def __init__(self, sender, receiver, transfer_id, name, size):
+        self.sender = sender
+        self.receiver = receiver
+        self.transfer_id = transfer_id
+        self.name = name
+        self.size = size
+        self.sent = 0       # Số byte đã chuyển tiếp
+        self.next_seq = 0
+        self.in_flight = 0  # Số chunk đã chuyển tiếp mà người nhận chưa xác nhận
+
+class FileTransfers:
+    """Các lượt gửi file đang chạy trong phòng chat riêng, khóa (người gửi, mã lượt gửi).
+    Server chỉ chuyển tiếp từng chunk sang kết nối người nhận, không giữ nội dung file;
+    người gửi vượt quá FILE_WINDOW chunk chưa được xác nhận thì lượt gửi bị hủy."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {}  # (sender, transfer_id) -> FileTransfer
+
+    def __len__(self):
+        with self.lock:
+            return len(self.active)
+
+    def add(self, transfer):
+        with self.lock:
+            key = (transfer.sender, transfer.transfer_id)
+            if key in self.active:
+                return False
+            self.active[key] = transfer
+            return True
+
+    def get(self, sender, transfer_id):
+        with self.lock:
+            return self.active.get((sender, transfer_id))
+
+    def pop(self, sender, transfer_id):
+        with self.lock:
+            return self.active.pop((sender, transfer_id), None)
+
+    def take_chunk(self, transfer, seq, size):
+        """Ghi nhận một chunk sắp chuyển tiếp; False nếu người gửi vi phạm thứ tự, cửa sổ hoặc kích thước"""
+        with self.lock:
+            if seq != transfer.next_seq or transfer.in_flight >= FILE_WINDOW or transfer.sent + size > transfer.size:
+                return False
+            transfer.next_seq += 1
+            transfer.in_flight += 1
+            transfer.sent += size
+            return True
+
+    def ack(self, transfer):
+        with self.lock:
+            transfer.in_flight = max(0, transfer.in_flight - 1)
+
+    def drop_user(self, username):
+        """Gỡ mọi lượt gửi có username tham gia (đổi phòng, ngắt kết nối)"""
+        with self.lock:
+            dropped = [t for t in self.active.values() if username in (t.sender, t.receiver)]
+            for t in dropped:
+                del self.active[(t.sender, t.transfer_id)]
+            return dropped
+
+file_transfers = FileTransfers()
+
+def save_msg(username, msg, private_to=None, channel=None):
+    """Xếp tin nhắn vào hàng đợi ghi, không chờ DB. Trả về (id, thời gian); (None, None) nếu lỗi.
+    Tin không phải chat riêng thuộc kênh channel (None = phòng chung)."""
+    try:
+        ts = time.strftime('%Y-%m-%d %H:%M:%S')
+        with history_cache.lock:  # Giữ thứ tự id trong cache trùng thứ tự cấp id
+            if private_to:
+                msg_id = message_log.append(private_to, (username, private_to, msg, ts, conversation_key(username, private_to)))
+                history_cache.add_private(msg_id, username, private_to, msg, ts)
+            else:
+                msg_id = message_log.append(None, (username, msg, ts, channel or ""))
+                history_cache.add_public(msg_id, username, msg, ts, channel)  # Worker khác thêm khi nhận broadcast
+        if private_to and bus:
+            bus.publish("private_cache", msg_id, username, private_to, msg, ts)
+        return msg_id, ts
+    except Exception as e:
+        logging.error(f"[DB ERROR] save_msg: {e}")
+        return None, None
+
+def get_history(user1=None, user2=None, limit=HISTORY_LIMIT, before_id=None, channel=None):
+    """Một trang lịch sử từ DB theo keyset: limit tin mới nhất có id < before_id.
+    Không có user1/user2: lịch sử của kênh channel (None = phòng chung)."""
+    before = before_id if before_id is not None else MAX_MESSAGE_ID
+    try:
+        message_log.flush()
+        with db_pool.connection() as db:
+            if user1 and user2:
+                msgs = db.execute("SELECT id, sender, receiver, message, timestamp FROM private_messages WHERE conversation=? AND id<? ORDER BY id DESC LIMIT ?",
+                                  (conversation_key(user1, user2), before, limit)).fetchall()
+            else:
+                msgs = db.execute("SELECT id, username, message, timestamp FROM public_messages WHERE channel=? AND id<? ORDER BY id DESC LIMIT ?",
+                                  (channel or "", before, limit)).fetchall()
+        return list(reversed(msgs))
+    except Exception as e:
+        logging.error(f"[DB ERROR] get_history: {e}")
+        return []
+
+def room_key(room_type, target):
+    """Tên phòng theo góc nhìn client: 'public', '#<kênh>' hoặc '@<người chat riêng>'"""
+    if room_type == "public":
+        return f"#{target}" if target else "public"
+    return f"@{target}"
+
+def room_name(channel):
+    """Tên kênh để hiển thị trong thông báo"""
+    return f"kênh #{channel}" if channel else "phòng chung"
+
+def parse_sync(frame):
+    """Đọc frame ĐỒNG BỘ:public=<id>,#<kênh>=<id>,@<tên>=<id>,... thành dict room_key -> id"""
+    last_seen = {}
+    for item in frame.split(":", 1)[1].split(",")[:SYNC_MAX_ROOMS]:
+        key, _, value = item.strip().partition("=")
+        if value.isdigit() and (key == "public" or (key.startswith("@") and validate_username(key[1:])[0])
+                                or (key.startswith("#") and validate_channel(key[1:])[0])):
+            last_seen[key] = int(value)
+    return last_seen
+
+def send_history(conn, username, room_type, target, limit=HISTORY_REPLAY, before_id=None, since_id=None):
+    """Gửi một trang lịch sử trong một frame LỊCH SỬ (mỗi dòng một tin), sau đó frame
+    CON TRỎ:<phòng>:<id cũ nhất đã gửi>:<id mới nhất của phòng> để client gõ /history more
+    (id cũ nhất = 0 nghĩa là không còn tin cũ hơn).
+    Trang mới nhất lấy từ cache, các trang cũ hơn đọc DB theo keyset id < before_id.
+    Có since_id: chỉ gửi các tin sau id đó nếu cache còn đủ, nếu không gửi trang mới nhất kèm dấu hiệu bỏ sót.
+    Client v2 nhận một frame OP_HISTORY (các dòng có id, thời gian, người gửi) và OP_CURSOR."""
+    try:
+        cached, full = history_cache.rows(username, room_type, target, conn.protocol)
+        newest = cached[-1][0] if cached else 0
+        if room_type == "private":
+            title = 'CHAT với ' + target
+        else:
+            title = f'KÊNH #{target}' if target else 'PHÒNG CHUNG'
+        if before_id is not None:
+            if room_type == "private":
+                rows = []
+                for msg_id, sender, _, txt, ts in get_history(username, target, limit, before_id):
+                    row = HistoryCache.private_row(msg_id, sender, txt, ts)
+                    rows.append((msg_id, HistoryCache.line(row, username, conn.protocol)))
+            else:
+                rows = [(m[0], HistoryCache.line(HistoryCache.public_row(*m), username, conn.protocol))
+                        for m in get_history(limit=limit, before_id=before_id, channel=target)]
+            has_more = len(rows) == limit
+            title += " (cũ hơn)"
+        elif since_id is not None and since_id <= newest and (not full or cached[0][0] <= since_id):
+            rows = [row for row in cached if row[0] > since_id]
+            has_more = full or len(rows) < len(cached)
+            title += " (tin mới)"
+        else:
+            rows = cached[-limit:]
+            has_more = full or len(cached) > limit
+            if since_id is not None:
+                title += " (có tin cũ hơn chưa xem, gõ /history more)"
+        if rows:
+            cursor = rows[0][0] if has_more else 0
+        else:
+            cursor = since_id + 1 if since_id and before_id is None else 0
+        key = room_key(room_type, target)
+        session = registry.get(username)
+        if session:
+            session.history_cursor = cursor
+            if session.delta:
+                session.last_seen[key] = max(session.last_seen.get(key, 0), newest)
+        if rows and conn.protocol == 2:
+            send_frame(conn, encode_v2(OP_HISTORY, key, title, rows=[line for _, line in rows]))
+        elif rows:
+            header = f"LỊCH SỬ:=== {title} ===\n".encode('utf-8')
+            send_bytes(conn, header + b"\n".join(line for _, line in rows) + "\n=== HẾT ===".encode('utf-8'))
+        elif before_id is not None:
+            send_message(conn, "Không còn tin nhắn cũ hơn")
+        send_typed(conn, OP_CURSOR, key, cursor, newest, text=f"CON TRỎ:{key}:{cursor}:{newest}")
+    except Exception as e:
+        logging.error(f"[ERROR] send_history: {e}")
+
+def send_room_history(conn, username, room_type, target):
+    """Lịch sử khi vào phòng; client đồng bộ delta chỉ nhận các tin sau id đã thấy"""
+    session = registry.get(username)
+    if session and session.shard is not None:
+        bus.to_user(username, "history", username, room_type, target)  # Con trỏ lịch sử thuộc phiên thật
+        return
+    since_id = None
+    if session and session.delta:
+        since_id = session.last_seen.get(room_key(room_type, target))
+    send_history(conn, username, room_type, target, since_id=since_id)
+
+class ChatFrame:
+    """Một tin chat mã hóa một lần, dùng chung cho mọi người nhận.
+    Bản kèm id ('#<id> [người gửi] tin') cho client đồng bộ delta và frame v2 (OP_CHAT, hoặc OP_SERVER
+    với tin của MÁY CHỦ) chỉ được tạo khi có người cần."""
+    def __init__(self, sender, msg, msg_id=None, ts=None, room="public"):
+        self.sender = sender
+        self.msg = msg
+        self.msg_id = msg_id
+        self.ts = ts
+        self.room = room  # room_key theo góc nhìn người nhận
+        self.plain = encode_frame(f"[{sender}] {msg}")
+        self._tagged = None
+        self._v2 = None
+
+    def tagged(self):
+        if self._tagged is None:
+            self._tagged = encode_frame(f"#{self.msg_id} [{self.sender}] {self.msg}")
+        return self._tagged
+
+    def v2(self):
+        if self._v2 is None:
+            if self.sender == "MÁY CHỦ":
+                self._v2 = encode_v2(OP_SERVER, self.msg)
+            else:
+                self._v2 = encode_v2(OP_CHAT, self.msg_id or 0, self.ts or "", self.room, self.sender, self.msg)
+        return self._v2
+
+def send_chat(session, chat):
+    """Gửi một tin chat; client đồng bộ delta nhận bản kèm id để nhớ id đã thấy"""
+    if session.shard is not None:
+        # Worker giữ kết nối chọn dạng frame và cập nhật last_seen của phiên thật
+        bus.to_user(session.username, "chat", session.username, chat.sender, chat.msg, chat.msg_id, chat.ts, chat.room)
+        return True
+    if session.detached_at is not None:
+        return False  # Tin đã lưu DB, gửi bù khi client khôi phục phiên
+    if session.delta and chat.msg_id:
+        session.last_seen[chat.room] = chat.msg_id
+    if session.conn.protocol == 2:
+        return send_frame(session.conn, chat.v2())
+    if session.delta and chat.msg_id:
+        return send_frame(session.conn, chat.tagged())
+    return send_frame(session.conn, chat.plain)
+
+def notify(username, msg):
+    session = registry.get(username)
+    if session and session.detached_at is None:
+        return send_typed(session.conn, OP_NOTICE, msg, text=f"[THÔNG BÁO] {msg}")
+    return False
+
+def broadcast_public(sender, msg, exclude_sender=True, msg_id=None, ts=None, channel=None):
+    if bus:
+        bus.publish("public", sender, msg, exclude_sender, msg_id, ts, channel)
+    fan_out_public(sender, msg, exclude_sender, msg_id, ts, channel)
+
+def fan_out_public(sender, msg, exclude_sender=True, msg_id=None, ts=None, channel=None):
+    """Gửi tin của kênh (None = phòng chung) cho các thành viên có kết nối ở worker này"""
+    targets = registry.members(channel, exclude=sender if exclude_sender else None)
+    chat = ChatFrame(sender, msg, msg_id, ts, room_key("public", channel))
+    
+    for session in targets:
+        send_chat(session, chat)
+
+def cleanup_user(username, room_type, room_target):
+    if room_type == "public":
+        broadcast_public("MÁY CHỦ", f"{username} đã rời {room_name(room_target)}", False, channel=room_target)
+    elif room_type == "private" and room_target:
+        notify(room_target, f"{username} đã ngắt kết nối")
+        partner_conn = None
+        partner_username = None
+        with lock:
+            partner = registry.get(room_target)
+            if partner and partner.room_type == "private" and partner.room_target == username:
+                registry.set_room(room_target, "public")
+                partner_conn = partner.conn
+                partner_username = partner.username
+        if partner_conn and partner_username:
+            try:
+                send_message(partner_conn, "OK:Đã quay lại phòng chung (người kia ngắt kết nối).")
+                send_room_history(partner_conn, partner_username, "public", None)
+                broadcast_public("MÁY CHỦ", f"{partner_username} đã tham gia phòng chung", False)
+            except Exception as e:
+                logging.error(f"[ERROR] cleanup_user notify: {e}")
+    
+    registry.remove(username)
+    pending_requests.discard_user(username)
+    cancel_transfers(username, f"{username} đã ngắt kết nối")
+    logging.info(f"[NGẮT KẾT NỐI] {username}")
+
+def end_detached(username):
+    """Kết thúc phiên tạm ngắt (hết hạn hoặc đăng nhập lại bằng mật khẩu): lúc này mới báo rời phòng"""
+    if is_remote(username):
+        return bus.call("end_detached", username, user=username) is not False  # None: không worker nào còn giữ
+    with lock:
+        session = registry.get(username)
+        if not session or session.detached_at is None:
+            return False
+        registry.remove(username)
+    cleanup_user(username, session.room_type, session.room_target)
+    return True
+
+def expire_detached_sessions():
+    expired = [u for u in registry.detached(time.time() - RESUME_GRACE) if end_detached(u)]
+    return len(expired)
+
+def get_user_conn(username):
+    session = registry.get(username)
+    return session.conn if session else None
+
+def get_current_state(username):
+    with lock:
+        session = registry.get(username)
+        if session:
+            return session.room_type, session.room_target
+    return None, None
+
+def update_user_state(username, new_room_type, new_room_target):
+    with lock:
+        session = registry.get(username)
+        if not session:
+            return False
+        rt, tg = session.room_type, session.room_target
+        registry.set_room(username, new_room_type, new_room_target)
+    logging.info(f"[CẬP NHẬT] {username}: {rt}/{tg} -> {new_room_type}/{new_room_target}")
+    return True
+# === LỆNH TRONG PHÒNG CHAT ===
+# Mỗi lệnh là một hàm (session, args); trả về True để kết thúc phiên.
+# Client v1 gửi dòng văn bản, được parse_command đưa về cùng dạng với frame v2 trước khi tra bảng COMMANDS.
+
+def cmd_help(session, args):
+    help_lines = [
+        "=== LỆNH ===",
+        "/list, /ls - Danh sách online",
+        f"/msg <tên> <tin> - Yêu cầu chat riêng (hết hạn sau {REQUEST_TIMEOUT}s)",
+        "/accept <tên> - Chấp nhận",
+        "/decline <tên> - Từ chối",
+        "/back - Về phòng chung",
+        "/join <kênh> - Vào kênh (tạo mới nếu chưa có)",
+        "/leave - Rời kênh, về phòng chung",
+        "/rooms - Danh sách kênh",
+        "/history, /his - Xem lịch sử",
+        "/history more - Xem tin cũ hơn",
+        "/send <đường dẫn> - Gửi file trong phòng chat riêng",
+        "/receive, /reject - Nhận hoặc từ chối file được gửi tới",
+        "/changepass <cũ> <mới> - Đổi pass",
+        "/exit - Thoát",
+        "",
+        "=== GIỚI HẠN ===",
+        f"- Tin nhắn: tối đa {MAX_MESSAGE_LENGTH} ký tự",
+        f"- Username: {MIN_USERNAME_LENGTH}-{MAX_USERNAME_LENGTH} ký tự (chữ, số, _)",
+        f"- Password: {MIN_PASSWORD_LENGTH}-{MAX_PASSWORD_LENGTH} ký tự",
+        f"- Yêu cầu chat: tự động hủy sau {REQUEST_TIMEOUT} giây",
+        f"- Kênh: tên tối đa {MAX_CHANNEL_LENGTH} ký tự (chữ, số, _), tối đa {MAX_CHANNELS} kênh",
+        f"- File: tối đa {FILE_MAX_BYTES // (1024 * 1024)}MB, cả hai bên cần client mới"
+    ]
+    send_message(session.conn, "\n".join(help_lines))
+
+def room_label(session):
+    if session.room_type == "private":
+        return f"riêng-{session.room_target}"
+    return f"#{session.room_target}" if session.room_target else "chung"
+
+def cmd_list(session, args):
+    """Người đang kết nối tính vào giới hạn MAX_CLIENTS (mỗi worker); phiên tạm ngắt chờ khôi phục liệt kê riêng"""
+    others = [s for s in registry.all() if s.username != session.username]
+    users = [f"{s.username} ({room_label(s)})" for s in others if s.detached_at is None]
+    away = [s.username for s in others if s.detached_at is not None]
+    text = f"Online ({len(users)}/{MAX_CLIENTS * WORKERS}): {', '.join(users) if users else 'Không có'}"
+    if away:
+        text += f" | Tạm ngắt ({len(away)}): {', '.join(away)}"
+    send_message(session.conn, text)
+
+def cmd_msg(session, args):
+    conn, username = session.conn, session.username
+    parts = args.split(' ', 1)
+    if len(parts) < 2:
+        send_message(conn, "Cách dùng: /msg <tên> <tin>")
+        return
+    target, message = parts[0], parts[1]
+    
+    valid, error_msg = validate_message(message)
+    if not valid:
+        send_message(conn, f"Lỗi: {error_msg}")
+        return
+    
+    valid, error_msg = validate_username(target)
+    if not valid:
+        send_message(conn, f"Lỗi: Tên người nhận không hợp lệ")
+        return
+    
+    with lock:
+        target_session = registry.get(target)
+        target_exists = target_session is not None and target_session.detached_at is None
+        target_in_private = target_exists and target_session.room_type == "private"
+        if target == username:
+            send_message(conn, "Không thể gửi yêu cầu chat riêng cho chính mình")
+            return
+        if not target_exists:
+            send_message(conn, f"Lỗi: {target} không online")
+            return
+        if target_in_private:
+            send_message(conn, f"Lỗi: {target} đang chat riêng")
+            return
+        pending_requests.add(username, target)
+    
+    notify(target, f"{username} muốn chat riêng: '{message[:50]}...'\nGõ /accept {username} hoặc /decline {username} (hết hạn sau {REQUEST_TIMEOUT}s)")
+    send_message(conn, f"Đã gửi yêu cầu tới {target} (hết hạn sau {REQUEST_TIMEOUT}s)")
+    logging.info(f"[YÊU CẦU] {username} -> {target}")
+
+def cmd_accept(session, args):
+    conn, username = session.conn, session.username
+    requester = args
+    
+    valid, _ = validate_username(requester)
+    if not valid:
+        send_message(conn, f"Tên không hợp lệ")
+        return
+    
+    requester_conn = None
+    requester_room_type = requester_channel = None
+    accepter_room_type = accepter_channel = None
+    
     with lock:
-        return len(Client_list)
+        if not pending_requests.pop(requester, username):
+            send_message(conn, f"Không có yêu cầu từ {requester} (có thể đã hết hạn)")
+            return
+        
+        requester_session = registry.get(requester)
+        if not requester_session or requester_session.detached_at is not None:
+            send_message(conn, f"Lỗi: {requester} đã offline")
+            return
+        requester_conn = requester_session.conn
+        requester_room_type, requester_channel = requester_session.room_type, requester_session.room_target
+        accepter_room_type, accepter_channel = session.room_type, session.room_target
+        
+        registry.set_room(username, "private", requester)
+        registry.set_room(requester, "private", username)
+    
+    logging.info(f"[ACCEPT] {username} chấp nhận {requester}")
+    
+    if accepter_room_type == "public":
+        broadcast_public("MÁY CHỦ", f"{username} đã rời {room_name(accepter_channel)}", True, channel=accepter_channel)
+    
+    if requester_room_type == "public":
+        broadcast_public("MÁY CHỦ", f"{requester} đã rời {room_name(requester_channel)}", True, channel=requester_channel)
+    
+    if requester_conn:
+        send_message(requester_conn, f"OK:Đã vào chat riêng với {username}. Gõ /back về phòng chung.")
+        send_room_history(requester_conn, requester, "private", username)
+    
+    send_message(conn, f"OK:Đã vào chat riêng với {requester}. Gõ /back về phòng chung.")
+    send_room_history(conn, username, "private", requester)
+    
+    logging.info(f"[CHAT RIÊNG] {username} <-> {requester}")
 
-def cleanup_expired_requests():
-    current_time = time.time()
-    expired = []
+def cmd_decline(session, args):
+    conn, username = session.conn, session.username
+    requester = args
+    
+    valid, _ = validate_username(requester)
+    if not valid:
+        send_message(conn, f"Tên không hợp lệ")
+        return
+    
+    if not pending_requests.pop(requester, username):
+        send_message(conn, f"Không có yêu cầu từ {requester} (có thể đã hết hạn)")
+        return
+    send_message(conn, f"Đã từ chối {requester}")
+    notify(requester, f"{username} đã từ chối")
+    logging.info(f"[TỪ CHỐI] {username} từ chối {requester}")
+
+def cmd_back(session, args):
+    conn, username = session.conn, session.username
+    room_type, room_target = get_current_state(username)
+    if room_type == "public" and room_target:
+        return cmd_leave(session, args)
+    if room_type == "public":
+        send_message(conn, "Bạn đang ở phòng chung")
+        return
+    
+    partner_conn = None
+    partner_username = None
     
     with lock:
-        for (sender, receiver), timestamp in list(pending_requests.items()):
-            if current_time - timestamp > REQUEST_TIMEOUT:
-                expired.append((sender, receiver))
-        
-        for sender, receiver in expired:
-            del pending_requests[(sender, receiver)]
+        partner = registry.get(room_target)
+        if partner and partner.room_type == "private" and partner.room_target == username:
+            registry.set_room(room_target, "public")
+            partner_conn = partner.conn
+            partner_username = partner.username
+        registry.set_room(username, "public")
+    cancel_transfers(username, f"{username} đã rời phòng chat riêng")
     
-    for sender, receiver in expired:
-        notify_result = notify(sender, f"Yêu cầu chat với {receiver} đã hết hạn ({REQUEST_TIMEOUT}s)")
-        if notify_result:
-            logging.info(f"[HẾT HẠN] {sender} -> {receiver} (đã thông báo người gửi)")
-        else:
-            logging.info(f"[HẾT HẠN] {sender} -> {receiver} (người gửi offline)")
-        notify_result = notify(receiver, f"Yêu cầu chat từ {sender} đã hết hạn ({REQUEST_TIMEOUT}s)")
-        if not notify_result:
-            logging.info(f"[HẾT HẠN] Không thể thông báo cho {receiver} (offline)")
+    if partner_conn and partner_username:
+        send_message(partner_conn, "OK:Đã quay lại phòng chung.")
+        send_room_history(partner_conn, partner_username, "public", None)
+        broadcast_public("MÁY CHỦ", f"{partner_username} đã tham gia phòng chung", True)
     
-    return len(expired)
+    if room_target:
+        notify(room_target, f"{username} đã về phòng chung")
+    
+    send_room_history(conn, username, "public", None)
+    send_message(conn, "OK:Đã quay lại phòng chung.")
+    broadcast_public("MÁY CHỦ", f"{username} đã tham gia phòng chung", True)
+    
+    logging.info(f"[/BACK] {username} và {partner_username if partner_username else 'N/A'} về phòng chung")
 
-def save_msg(username, msg, private_to=None):
-    try:
-        db = sqlite3.connect(DB_FILE)
-        c = db.cursor()
-        ts = time.strftime('%Y-%m-%d %H:%M:%S')
-        if private_to:
-            c.execute("INSERT INTO private_messages (sender, receiver, message, timestamp) VALUES (?, ?, ?, ?)",
-                      (username, private_to, msg, ts))
-        else:
-            c.execute("INSERT INTO public_messages (username, message, timestamp) VALUES (?, ?, ?)",
-                      (username, msg, ts))
-        db.commit()
-        db.close()
-    except Exception as e:
-        logging.error(f"[DB ERROR] save_msg: {e}")
+def move_to_channel(session, channel):
+    """Chuyển session từ kênh hiện tại sang kênh channel (None = phòng chung), báo cả hai kênh"""
+    conn, username = session.conn, session.username
+    old = session.room_target
+    registry.set_room(username, "public", channel)
+    broadcast_public("MÁY CHỦ", f"{username} đã rời {room_name(old)}", True, channel=old)
+    send_room_history(conn, username, "public", channel)
+    send_message(conn, f"OK:Đã vào {room_name(channel)}.")
+    broadcast_public("MÁY CHỦ", f"{username} đã tham gia {room_name(channel)}", True, channel=channel)
+    logging.info(f"[KÊNH] {username}: {room_name(old)} -> {room_name(channel)}")
 
-def get_history(user1=None, user2=None, limit=50):
-    try:
-        db = sqlite3.connect(DB_FILE)
-        c = db.cursor()
-        if user1 and user2:
-            c.execute("SELECT sender, receiver, message, timestamp FROM private_messages WHERE (sender=? AND receiver=?) OR (sender=? AND receiver=?) ORDER BY id DESC LIMIT ?",
-                      (user1, user2, user2, user1, limit))
-        else:
-            c.execute("SELECT username, message, timestamp FROM public_messages ORDER BY id DESC LIMIT ?", (limit,))
-        msgs = c.fetchall()
-        db.close()
-        return list(reversed(msgs))
-    except Exception as e:
-        logging.error(f"[DB ERROR] get_history: {e}")
-        return []
+def cmd_join(session, args):
+    conn, username = session.conn, session.username
+    if not args:
+        send_message(conn, "Cách dùng: /join <kênh>")
+        return
+    channel = args.removeprefix("#")
+    valid, error_msg = validate_channel(channel)
+    if not valid:
+        send_message(conn, f"Lỗi: {error_msg}")
+        return
+    room_type, room_target = get_current_state(username)
+    if room_type != "public":
+        send_message(conn, "Lỗi: Đang chat riêng, gõ /back trước khi vào kênh")
+        return
+    if room_target == channel:
+        send_message(conn, f"Bạn đang ở kênh #{channel}")
+        return
+    rooms = registry.rooms()
+    if channel not in rooms and len(rooms) - 1 >= MAX_CHANNELS:
+        send_message(conn, f"Lỗi: Server đã có tối đa {MAX_CHANNELS} kênh")
+        return
+    move_to_channel(session, channel)
 
-def send_history(conn, username, room_type, target):
-    try:
-        msgs = get_history(username, target) if room_type == "private" else get_history()
-        if msgs:
-            send_message(conn, f"LỊCH SỬ:=== {'CHAT với ' + target if target else 'PHÒNG CHUNG'} ===")
-            time.sleep(0.05)
-            for msg_data in msgs:
-                if room_type == "private":
-                    sender, _, txt, ts = msg_data
-                    prefix = "Bạn" if sender == username else sender
-                    send_message(conn, f"LỊCH SỬ:[{ts}] {prefix}: {txt}")
-                else:
-                    uname, txt, ts = msg_data
-                    send_message(conn, f"LỊCH SỬ:[{ts}] {uname}: {txt}")
-                time.sleep(0.02)
-            send_message(conn, "LỊCH SỬ:=== HẾT ===")
-            time.sleep(0.05)
-    except Exception as e:
-        logging.error(f"[ERROR] send_history: {e}")
+def cmd_leave(session, args):
+    room_type, room_target = get_current_state(session.username)
+    if room_type != "public":
+        send_message(session.conn, "Đang chat riêng, gõ /back về phòng chung")
+    elif room_target is None:
+        send_message(session.conn, "Bạn đang ở phòng chung")
+    else:
+        move_to_channel(session, None)
 
-def notify(username, msg):
-    target_conn = None
-    with lock:
-        for c, _, u, _, _ in Client_list:
-            if u == username:
-                target_conn = c
-                break
-    
-    if target_conn:
-        return send_message(target_conn, f"[THÔNG BÁO] {msg}")
-    return False
+def cmd_rooms(session, args):
+    rooms = registry.rooms()
+    channels = sorted((c for c in rooms if c), key=lambda c: (-rooms[c], c))
+    listing = [f"phòng chung ({rooms[None]})"] + [f"#{c} ({rooms[c]})" for c in channels]
+    send_message(session.conn, f"Kênh ({len(channels)}/{MAX_CHANNELS}): {', '.join(listing)}")
 
-def broadcast_public(sender, msg, exclude_sender=True):
-    targets = []
-    with lock:
-        for c, _, u, rt, _ in Client_list:
-            if rt == "public" and (not exclude_sender or u != sender):
-                targets.append((c, u))
-    
-    for c, u in targets:
-        if sender == "MÁY CHỦ":
-            send_message(c, f"[MÁY CHỦ] {msg}")
+def cmd_history(session, args):
+    conn, username = session.conn, session.username
+    room_type, room_target = get_current_state(username)
+    args = args.split()
+    if not args:
+        send_history(conn, username, room_type, room_target, HISTORY_LIMIT)
+    elif args == ['more']:
+        if session.history_cursor:
+            send_history(conn, username, room_type, room_target, HISTORY_LIMIT, session.history_cursor)
         else:
-            send_message(c, f"[{sender}] {msg}")
+            send_message(conn, "Không còn tin nhắn cũ hơn")
+    elif len(args) == 2 and args[0] == 'before' and args[1].isascii() and args[1].isdigit():
+        # Id vượt kiểu INTEGER của SQLite coi như "trước tin mới nhất"; xét độ dài trước int() cho chuỗi số rất dài
+        before = MAX_MESSAGE_ID if len(args[1]) > len(str(MAX_MESSAGE_ID)) else min(int(args[1]), MAX_MESSAGE_ID)
+        send_history(conn, username, room_type, room_target, HISTORY_LIMIT, before)
+    else:
+        send_message(conn, "Cách dùng: /history [more | before <id>]")
 
-def cleanup_user(username, room_type, room_target):
-    if room_type == "public":
-        broadcast_public("MÁY CHỦ", f"{username} đã rời phòng chung", False)
-    elif room_type == "private" and room_target:
-        notify(room_target, f"{username} đã ngắt kết nối")
-        partner_conn = None
-        partner_username = None
-        with lock:
-            for i, (c, a, u, rt, tg) in enumerate(Client_list):
-                if u == room_target and rt == "private" and tg == username:
-                    partner_conn = c
-                    partner_username = u
-                    Client_list[i] = (c, a, u, "public", None)
-                    break
-        if partner_conn and partner_username:
-            try:
-                send_message(partner_conn, "OK:Đã quay lại phòng chung (người kia ngắt kết nối).")
-                time.sleep(0.1)
-                send_history(partner_conn, partner_username, "public", None)
-                time.sleep(0.1)
-                broadcast_public("MÁY CHỦ", f"{partner_username} đã tham gia phòng chung", False)
-            except Exception as e:
-                logging.error(f"[ERROR] cleanup_user notify: {e}")
+def cmd_changepass(session, args):
+    conn, username = session.conn, session.username
+    parts = args.split(' ')
+    if len(parts) != 2:
+        send_message(conn, "Cách dùng: /changepass <cũ> <mới>")
+        return
     
-    with lock:
-        Client_list[:] = [(c, a, u, rt, tg) for c, a, u, rt, tg in Client_list if u != username]
-    logging.info(f"[NGẮT KẾT NỐI] {username}")
+    old_pass, new_pass = parts[0], parts[1]
+    
+    valid, error_msg = validate_password(new_pass)
+    if not valid:
+        send_message(conn, f"LỖI: {error_msg}")
+        return
+    
+    wait = auth_guard.blocked(username, session.addr[0])
+    if wait:
+        send_message(conn, f"LỖI: Sai mật khẩu nhiều lần, thử lại sau {math.ceil(wait)}s")
+        return
+    if auth_guard.lookup(username) != hash_pwd(old_pass):
+        auth_guard.failed(username, session.addr[0])
+        send_message(conn, "LỖI: Sai mật khẩu cũ")
+        return
+    auth_guard.succeeded(username)
+    password_hash = hash_pwd(new_pass)
+    with db_pool.connection() as db:
+        db.execute("UPDATE users SET password_hash=? WHERE username=?", (password_hash, username))
+        db.commit()
+    auth_guard.update(username, password_hash)
+    send_message(conn, "Đổi mật khẩu thành công!")
+    logging.info(f"[ĐỔI PASS] {username}")
 
-def get_user_conn(username):
+def cmd_exit(session, args):
+    send_typed(session.conn, OP_BYE, "Tạm biệt!", text="Tạm biệt!")
+    return True
+
+def say(session, msg):
+    """Tin chat thường: lưu rồi gửi tới phòng hiện tại"""
+    conn, username = session.conn, session.username
+    if not msg:
+        return
+    valid, error_msg = validate_message(msg)
+    if not valid:
+        send_message(conn, f"[LỖI] {error_msg}")
+        return
+    
+    room_type, room_target = get_current_state(username)
+    if room_type == "public":
+        msg_id, ts = save_msg(username, msg, channel=room_target)
+        if session.delta and msg_id:
+            session.last_seen[room_key("public", room_target)] = msg_id
+        broadcast_public(username, msg, msg_id=msg_id, ts=ts, channel=room_target)
+        logging.info(f"[{'#' + room_target if room_target else 'CHUNG'}] {username}: {msg[:50]}...")
+    elif room_type == "private":
+        msg_id, ts = save_msg(username, msg, room_target)
+        if session.delta and msg_id:
+            session.last_seen[room_key("private", room_target)] = msg_id
+        partner = registry.get(room_target)
+        if partner:
+            partner_rt, partner_tg = get_current_state(room_target)
+            if partner_rt == "private" and partner_tg == username:
+                send_chat(partner, ChatFrame(username, msg, msg_id, ts, room_key("private", username)))
+        logging.info(f"[RIÊNG] {username} -> {room_target}: {msg[:50]}...")
+
+# === GỬI FILE TRONG PHÒNG CHAT RIÊNG (chỉ client v2) ===
+# Mỗi opcode file là một hàm (session, trường) trong bảng FILE_OPS.
+
+def send_file_cancel(username, transfer, reason):
+    session = registry.get(username)
+    if session and session.detached_at is None:
+        send_frame(session.conn, encode_v2(OP_FILE_CANCEL, transfer.transfer_id, transfer.sender, reason))
+
+def cancel_transfer(transfer, reason, notify_sender=True, notify_receiver=True):
+    if file_transfers.pop(transfer.sender, transfer.transfer_id) is None:
+        return  # Đã hủy hoặc đã xong
+    if notify_sender:
+        send_file_cancel(transfer.sender, transfer, reason)
+    if notify_receiver:
+        send_file_cancel(transfer.receiver, transfer, reason)
+    logging.info(f"[FILE] Hủy {transfer.sender} -> {transfer.receiver}: {transfer.name} ({reason})")
+
+def cancel_transfers(username, reason):
+    """Hủy mọi lượt gửi file của username (đã rời phòng chat riêng hoặc ngắt kết nối), báo cả hai bên còn kết nối"""
+    for transfer in file_transfers.drop_user(username):
+        send_file_cancel(transfer.sender, transfer, reason)
+        send_file_cancel(transfer.receiver, transfer, reason)
+        logging.info(f"[FILE] Hủy {transfer.sender} -> {transfer.receiver}: {transfer.name} ({reason})")
+
+def private_partner(username):
+    """Session người đang chat riêng với username, nếu cả hai vẫn ở cùng phòng riêng và đang kết nối"""
     with lock:
-        for c, _, u, _, _ in Client_list:
-            if u == username:
-                return c
+        session = registry.get(username)
+        if not session or session.room_type != "private":
+            return None
+        partner = registry.get(session.room_target)
+        if (partner and partner.detached_at is None and partner.room_type == "private"
+                and partner.room_target == username):
+            return partner
     return None
 
-def get_current_state(username):
-    with lock:
-        for _, _, u, rt, tg in Client_list:
-            if u == username:
-                return rt, tg
-    return None, None
+def file_offer(session, fields):
+    transfer_id, _, name, size = fields
+    username = session.username
+    name = os.path.basename(name.replace("\\", "/")).strip()
+    transfer = FileTransfer(username, None, transfer_id, name, size)
+    partner = private_partner(username)
+    if partner is None:
+        reason = "Chỉ gửi file được trong phòng chat riêng"
+    elif partner.conn.protocol != 2:
+        reason = f"{partner.username} dùng client cũ, không nhận được file"
+    elif not name or len(name) > 255:
+        reason = "Tên file không hợp lệ"
+    elif size > FILE_MAX_BYTES:
+        reason = f"File quá lớn (tối đa {FILE_MAX_BYTES // (1024 * 1024)}MB)"
+    else:
+        transfer.receiver = partner.username
+        if file_transfers.add(transfer):
+            send_frame(partner.conn, encode_v2(OP_FILE_OFFER, transfer_id, username, name, size))
+            logging.info(f"[FILE] {username} -> {partner.username}: {name} ({size} bytes)")
+            return
+        reason = "Mã lượt gửi đang được dùng"
+    send_frame(session.conn, encode_v2(OP_FILE_CANCEL, transfer_id, username, reason))
+
+def file_chunk(session, fields):
+    transfer_id, seq, data = fields
+    transfer = file_transfers.get(session.username, transfer_id)
+    if transfer is None:
+        return  # Lượt gửi đã bị hủy, các chunk còn trên đường tới bỏ qua
+    partner = private_partner(session.username)
+    if partner is None or partner.username != transfer.receiver:
+        cancel_transfer(transfer, "Người nhận đã rời phòng chat riêng")
+    elif not file_transfers.take_chunk(transfer, seq, len(data)):
+        cancel_transfer(transfer, "Chunk sai thứ tự, vượt cửa sổ hoặc vượt kích thước đã báo")
+    elif is_remote(partner.username):
+        bus.to_user(partner.username, "file_chunk", partner.username, session.username, transfer_id,
+                    encode_v2(OP_FILE_CHUNK, transfer_id, seq, data))
+    elif not send_frame(partner.conn, encode_v2(OP_FILE_CHUNK, transfer_id, seq, data)):
+        cancel_transfer(transfer, "Người nhận không theo kịp")
+
+def forward_file_op(session, opcode, fields, sender):
+    """Cluster: lượt gửi nằm ở worker của người gửi file; chuyển frame của người nhận sang đó.
+    Trả về False nếu người gửi ở chính worker này."""
+    if not is_remote(sender):
+        return False
+    bus.to_user(sender, "file", session.username, opcode, fields)
+    return True
+
+def file_ack(session, fields):
+    transfer_id, seq = fields
+    _, partner_name = get_current_state(session.username)
+    transfer = file_transfers.get(partner_name, transfer_id) if partner_name else None
+    if transfer is None and partner_name and forward_file_op(session, OP_FILE_ACK, fields, partner_name):
+        return
+    if transfer is None or transfer.receiver != session.username:
+        return
+    file_transfers.ack(transfer)
+    sender = registry.get(transfer.sender)
+    if sender and sender.detached_at is None:
+        send_frame(sender.conn, encode_v2(OP_FILE_ACK, transfer_id, seq))
+
+def file_end(session, fields):
+    transfer_id, = fields
+    transfer = file_transfers.get(session.username, transfer_id)
+    if transfer is None:
+        return
+    if transfer.sent != transfer.size:
+        cancel_transfer(transfer, f"Thiếu dữ liệu ({transfer.sent}/{transfer.size} bytes)")
+        return
+    file_transfers.pop(session.username, transfer_id)
+    partner = registry.get(transfer.receiver)
+    if partner and partner.detached_at is None:
+        send_frame(partner.conn, encode_v2(OP_FILE_END, transfer_id))
+    logging.info(f"[FILE] Xong {transfer.sender} -> {transfer.receiver}: {transfer.name}")
+
+def file_cancel(session, fields):
+    transfer_id, sender, reason = fields
+    transfer = file_transfers.get(sender or session.username, transfer_id)
+    if transfer is None and sender and forward_file_op(session, OP_FILE_CANCEL, fields, sender):
+        return
+    if transfer is None or session.username not in (transfer.sender, transfer.receiver):
+        return
+    is_sender = session.username == transfer.sender
+    cancel_transfer(transfer, reason or f"{session.username} đã hủy",
+                    notify_sender=not is_sender, notify_receiver=is_sender)
+
+FILE_OPS = {
+    OP_FILE_OFFER: file_offer,
+    OP_FILE_CHUNK: file_chunk,
+    OP_FILE_ACK: file_ack,
+    OP_FILE_END: file_end,
+    OP_FILE_CANCEL: file_cancel,
+}
+
+COMMANDS = {
+    "/help": cmd_help,
+    "/list": cmd_list, "/ls": cmd_list,
+    "/msg": cmd_msg,
+    "/accept": cmd_accept,
+    "/decline": cmd_decline,
+    "/back": cmd_back,
+    "/join": cmd_join,
+    "/leave": cmd_leave,
+    "/rooms": cmd_rooms,
+    "/history": cmd_history, "/his": cmd_history,
+    "/changepass": cmd_changepass,
+    "/exit": cmd_exit,
+}
+
+V1_PING = "/ping"  # Keepalive của client v1 (v2 dùng OP_PING)
+
+def parse_command(msg):
+    """Dòng văn bản v1 -> cùng dạng với frame v2: (OP_PING,), (OP_COMMAND, tên, tham số) hoặc (OP_SAY, tin).
+    Keepalive v1 là /ping (dạng lệnh nên không trùng tin chat). Lệnh không có trong COMMANDS vẫn là tin chat như trước."""
+    text = msg.strip()
+    if text == V1_PING:
+        return (OP_PING,)
+    name, _, args = text.partition(" ")
+    if name in COMMANDS:
+        return (OP_COMMAND, name, args.strip())
+    return (OP_SAY, text)
+
+def text_input(msg):
+    """Bước xác thực chỉ nhận dòng văn bản; frame v2 khác (chat, lệnh) lúc này coi như ngắt kết nối"""
+    return msg if msg is None or isinstance(msg, str) else None
 
-def update_user_state(username, new_room_type, new_room_target):
-    with lock:
-        for i, (c, a, u, rt, tg) in enumerate(Client_list):
-            if u == username:
-                Client_list[i] = (c, a, u, new_room_type, new_room_target)
-                logging.info(f"[CẬP NHẬT] {username}: {rt}/{tg} -> {new_room_type}/{new_room_target}")
-                return True
-    return False
 # Lang nghe
-def handle_client(conn, addr):
-    username = None 
+# === CLUSTER: THÔNG ĐIỆP TỪ WORKER KHÁC ===
+# Mỗi loại thông điệp là một hàm (worker gửi, tham số...) trong bảng CLUSTER_OPS, chạy trên luồng áp dụng
+# của bus theo đúng thứ tự broker chuyển tới. Các hàm này chỉ sửa bản sao cục bộ, không phát lại.
+# Luồng áp dụng không được chờ DB hay gọi bus.call: loại nào cần thì thêm vào CLUSTER_SLOW_OPS để chạy trên pool riêng.
+
+def apply_add(shard, username, protocol):
+    registry.replica_add(shard, username, protocol)
+
+def apply_remove(shard, username):
+    if registry.replica_remove(shard, username):
+        pending_requests.discard_user(username, publish=False)
+        cancel_transfers(username, f"{username} đã ngắt kết nối")
+
+def apply_token(shard, username, token):
+    registry.replica_token(shard, username, token)
+
+def apply_detach(shard, username):
+    registry.replica_detach(shard, username, True)
+    cancel_transfers(username, f"{username} mất kết nối")
+
+def apply_attach(shard, username):
+    registry.replica_detach(shard, username, False)
+
+def apply_moved(shard, username):
+    registry.replica_moved(shard, username)
+
+def apply_room(shard, username, room_type, room_target):
+    registry.replica_room(username, room_type, room_target)
+    if room_type == "public":
+        cancel_transfers(username, "Phòng chat riêng đã kết thúc")
+
+def apply_pending_add(shard, sender, receiver, sent_at):
+    pending_requests.add(sender, receiver, sent_at, publish=False)
+
+def apply_pending_pop(shard, sender, receiver):
+    pending_requests.pop(sender, receiver, publish=False)
+
+def apply_pending_discard(shard, username):
+    pending_requests.discard_user(username, publish=False)
+
+def apply_public(shard, sender, msg, exclude_sender, msg_id, ts, channel):
+    if msg_id:
+        message_log.observe("public", msg_id)
+        history_cache.add_public(msg_id, sender, msg, ts, channel)
+    fan_out_public(sender, msg, exclude_sender, msg_id, ts, channel)
+
+def apply_private_cache(shard, msg_id, sender, receiver, msg, ts):
+    message_log.observe("private", msg_id)
+    history_cache.add_private(msg_id, sender, receiver, msg, ts)
+
+def apply_history_discard(shard, public, private):
+    history_cache.discard(public, private)
+
+def apply_user_changed(shard, username):
+    auth_guard.forget(username)
+
+def local_session(username):
+    """Phiên có kết nối đang mở ở worker này"""
+    session = registry.get(username)
+    if session and session.shard is None and session.detached_at is None:
+        return session
+    return None
+
+def apply_frame(shard, username, frame):
+    session = local_session(username)
+    if session:
+        send_frame(session.conn, frame)
+
+def apply_chat(shard, username, sender, msg, msg_id, ts, room):
+    session = local_session(username)
+    if session:
+        send_chat(session, ChatFrame(sender, msg, msg_id, ts, room))
+
+def apply_history(shard, username, room_type, target):
+    session = local_session(username)
+    if session:
+        send_room_history(session.conn, username, room_type, target)
+
+def apply_file(shard, username, opcode, fields):
+    session = registry.get(username)
+    if session:
+        FILE_OPS[opcode](session, fields)
+
+def apply_file_chunk(shard, username, sender, transfer_id, frame):
+    """Chunk file cho người nhận ở worker này; Outbox từ chối (hoặc người nhận vừa ngắt) thì
+    báo worker của người gửi hủy lượt gửi, như file_chunk làm khi cả hai cùng một worker"""
+    session = local_session(username)
+    if session is None or not send_frame(session.conn, frame):
+        reason = "Người nhận không theo kịp"
+        bus.to_user(sender, "file", username, OP_FILE_CANCEL, (transfer_id, sender, reason))
+        if session:
+            send_frame(session.conn, encode_v2(OP_FILE_CANCEL, transfer_id, sender, reason))
+
+CLUSTER_OPS = {
+    "add": apply_add,
+    "remove": apply_remove,
+    "token": apply_token,
+    "detach": apply_detach,
+    "attach": apply_attach,
+    "moved": apply_moved,
+    "room": apply_room,
+    "pending_add": apply_pending_add,
+    "pending_pop": apply_pending_pop,
+    "pending_discard": apply_pending_discard,
+    "public": apply_public,
+    "private_cache": apply_private_cache,
+    "frame": apply_frame,
+    "chat": apply_chat,
+    "history": apply_history,
+    "file": apply_file,
+    "file_chunk": apply_file_chunk,
+    "user_changed": apply_user_changed,
+    "history_discard": apply_history_discard,
+}
+
+CLUSTER_SLOW_OPS = {"history"}  # Đọc DB / gọi flush worker khác khi cache chưa có phòng
+
+def apply_cluster_message(shard, kind, *args):
+    CLUSTER_OPS[kind](shard, *args)
+
+# Lời gọi từ worker khác tới worker giữ phiên, broker chuyển kết quả về
+CLUSTER_CALLS = {
+    "end_detached": lambda shard, username: end_detached(username),
+    "handoff": lambda shard, username, token: registry.hand_off(username, token, shard),
+    "flush": lambda shard: message_log.flush(),
+}
+
+def rate_kind(session, opcode, fields):
+    """Loại budget (RATE_LIMITS) mà frame trong phòng chat tiêu tốn; None = không giới hạn (PING, file)"""
+    if opcode == OP_COMMAND and fields[0] in COMMANDS:
+        return "command"
+    if opcode in (OP_SAY, OP_COMMAND):
+        return "private" if session.room_type == "private" else "public"
+    return None
+
+def client_session(conn, addr):
+    """Logic phiên làm việc (xác thực, phòng, lệnh) dùng chung cho cả chế độ thread và async.
+    Là generator: mỗi `yield` trả về tin nhắn tiếp theo của client (None = mất kết nối)."""
+    username = None
+    session = None
+    sync = None  # last_seen client gửi kèm (ĐỒNG BỘ:...), None = client cũ không đồng bộ delta
+    graceful = False  # True khi client /exit: dọn phiên ngay, không giữ để khôi phục
     try:
         conn.settimeout(AUTH_TIMEOUT)
-        
-        if get_client_count() >= MAX_CLIENTS:
-            send_message(conn, "LỖI:Server đã đầy. Vui lòng thử lại sau.")
-            logging.warning(f"[TỪ CHỐI] {addr} - Server đầy ({MAX_CLIENTS} clients)")
-            return
     
         while True:
             send_message(conn, "XÁC THỰC:DANGNHAP hoặc DANGKY?")
-            auth_type = recv_message(conn)
+            auth_type = text_input((yield))
+            while auth_type and (auth_type.startswith(("ĐỒNG BỘ:", "GIAO THỨC:", "NÉN:")) or auth_type == TAG_HELLO):
+                # Frame điều khiển client gửi trước khi trả lời, không cần hỏi lại
+                if auth_type.startswith("ĐỒNG BỘ:"):
+                    sync = parse_sync(auth_type)
+                elif auth_type.startswith("NÉN:"):
+                    # Client đã sẵn sàng giải nén từ lúc xin; frame nén có bit riêng nên không cần xác nhận
+                    mode = auth_type.split(":", 1)[1].strip()
+                    if COMPRESSION and mode in COMPRESSION_MODES and conn.deflater is None:
+                        conn.deflater = Deflater(mode, COMPRESS_THRESHOLD)
+                elif auth_type == TAG_HELLO:
+                    conn.tagging = True  # Không trả lời: client gửi liền các frame gắn mã sau đó
+                elif auth_type == PROTOCOL_HELLO and conn.protocol == 1:
+                    send_message(conn, PROTOCOL_HELLO)  # Frame văn bản cuối cùng, từ đây dùng v2
+                    conn.protocol = 2
+                    send_message(conn, "XÁC THỰC:DANGNHAP hoặc DANGKY?")
+                auth_type = text_input((yield))
             if not auth_type:
                 return
+            if auth_type.startswith("TIẾP TỤC:"):
+                if rate_limited(conn, conn.rate, "auth"):
+                    continue
+                session = registry.resume(auth_type.split(":", 1)[1].strip(), conn, addr)
+                if not session:
+                    send_message(conn, "LỖI:Phiên đã hết hạn, vui lòng đăng nhập lại")
+                    continue
+                username = session.username
+                logging.info(f"[KHÔI PHỤC] {username} từ {addr[0]}")
+                break
             auth_type = auth_type.strip().upper()
             if auth_type == "THOAT":
                 return
             if auth_type in ["DANGNHAP", "DANGKY"]:
                 send_message(conn, f"{auth_type}:Nhập tên tài khoản")
-                username_input = recv_message(conn)
+                username_input = text_input((yield))
                 if not username_input:
                     return
                 username_input = username_input.strip()
@@ -321,7 +2558,7 @@ def handle_client(conn, addr):
                     continue
                 
                 send_message(conn, f"{auth_type}:Nhập mật khẩu")
-                password = recv_message(conn)
+                password = text_input((yield))
                 if not password:
                     return
                 password = password.strip()
@@ -333,340 +2570,219 @@ def handle_client(conn, addr):
                     send_message(conn, f"LỖI:{error_msg}")
                     continue
                 
-                db = sqlite3.connect(DB_FILE)
-                c = db.cursor()
+                if rate_limited(conn, conn.rate, "auth"):
+                    continue
+                
                 if auth_type == "DANGKY":
+                    if auth_guard.exists(username_input):
+                        send_message(conn, "LỖI:Tên tài khoản đã tồn tại")
+                        continue
                     try:
-                        c.execute("INSERT INTO users VALUES (NULL, ?, ?, ?)", 
-                                  (username_input, hash_pwd(password), time.strftime('%Y-%m-%d %H:%M:%S')))
-                        db.commit()
+                        password_hash = hash_pwd(password)
+                        with db_pool.connection() as db:
+                            db.execute("INSERT INTO users VALUES (NULL, ?, ?, ?)", 
+                                       (username_input, password_hash, time.strftime('%Y-%m-%d %H:%M:%S')))
+                            db.commit()
+                        auth_guard.update(username_input, password_hash)
                         send_message(conn, f"OK:Tài khoản '{username_input}' đã tạo!")
                         logging.info(f"[ĐĂNG KÝ] {username_input}")
                     except sqlite3.IntegrityError:
+                        auth_guard.forget(username_input)  # Có thể đang nhớ nhầm là không tồn tại
                         send_message(conn, "LỖI:Tên tài khoản đã tồn tại")
                     except Exception as e:
                         send_message(conn, "LỖI:Lỗi tạo tài khoản")
                         logging.error(f"[DB ERROR] Register: {e}")
-                    db.close()
                     continue
                 else:
-                    c.execute("SELECT password_hash FROM users WHERE username=?", (username_input,))
-                    result = c.fetchone()
-                    db.close()
-                    if not result:
-                        send_message(conn, "LỖI:Tài khoản không tồn tại")
+                    wait = auth_guard.blocked(username_input, addr[0])
+                    if wait:
+                        throttle(conn, conn.rate, "auth", wait)
                         continue
-                    if result[0] != hash_pwd(password):
-                        send_message(conn, "LỖI:Sai mật khẩu")
+                    password_hash = auth_guard.lookup(username_input)
+                    if password_hash is None or password_hash != hash_pwd(password):
+                        locked = auth_guard.failed(username_input, addr[0])
+                        if locked:
+                            logging.warning(f"[KHÓA] {username_input} từ {addr[0]} - Sai nhiều lần, khóa {locked:.0f}s")
+                        send_message(conn, "LỖI:Tài khoản không tồn tại" if password_hash is None else "LỖI:Sai mật khẩu")
+                        continue
+                    auth_guard.succeeded(username_input)
+                    if registry.get(username_input) and not end_detached(username_input):
+                        send_message(conn, "LỖI:Tài khoản đã đăng nhập")
                         continue
-                    with lock:
-                        if any(u == username_input for _, _, u, _, _ in Client_list):
-                            send_message(conn, "LỖI:Tài khoản đã đăng nhập")
-                            continue 
                     username = username_input
                     send_message(conn, f"OK:Chào mừng {username}!")
                     logging.info(f"[ĐĂNG NHẬP] {username} từ {addr[0]}")
                     break
         
         conn.settimeout(CHAT_TIMEOUT)
-        with lock:
-            Client_list.append((conn, addr, username, "public", None))
-        time.sleep(0.1)
-        send_history(conn, username, "public", None)
-        time.sleep(0.2)
-        send_message(conn, "OK:Đã vào phòng chung. Gõ /help để xem lệnh.")
-        time.sleep(0.1)
-        broadcast_public("MÁY CHỦ", f"{username} đã tham gia phòng chung", True)
+        resumed = session is not None
+        if not resumed:
+            session = registry.add(conn, addr, username)
+            if not session:
+                send_message(conn, "LỖI:Tài khoản đã đăng nhập")
+                username = None
+                return
+        admission.login(conn)
+        if sync is not None:
+            session.delta = True
+            session.last_seen = sync  # Client biết chính xác tin nào đã hiện
+        token = registry.issue_token(session)
+        send_typed(conn, OP_SESSION, token, username, text=f"PHIÊN:{token}")
+        if resumed:
+            # Giữ nguyên phòng, chỉ gửi bù tin đã lỡ; không báo tham gia lại vì chưa báo rời
+            room_type, room_target = get_current_state(username)
+            send_message(conn, f"OK:Chào mừng trở lại {username}!")
+            send_room_history(conn, username, room_type, room_target)
+            if room_type == "private":
+                send_message(conn, f"OK:Đã khôi phục chat riêng với {room_target}. Gõ /back về phòng chung.")
+            else:
+                send_message(conn, f"OK:Đã khôi phục {room_name(room_target)}. Gõ /help để xem lệnh.")
+        else:
+            send_room_history(conn, username, "public", None)
+            send_message(conn, "OK:Đã vào phòng chung. Gõ /help để xem lệnh.")
+            broadcast_public("MÁY CHỦ", f"{username} đã tham gia phòng chung", True)
         
         while True:
-            msg = recv_message(conn)
+            msg = yield
             if not msg:
-                logging.warning(f"[NGẮT ĐỘT NGỘT] {username} - connection closed")
+                if not conn.timed_out:
+                    logging.warning(f"[NGẮT ĐỘT NGỘT] {username} - connection closed")
                 break
-            msg = msg.strip()
-            if not msg:
+            opcode, *fields = parse_command(msg) if isinstance(msg, str) else msg
+            if opcode == OP_PING:
+                send_typed(conn, OP_PONG, text="PONG")  # Keepalive: client rảnh nhưng vẫn kết nối
                 continue
             
-            room_type, room_target = get_current_state(username)
-            if room_type is None:
+            if get_current_state(username)[0] is None:
                 break
             
-            if msg == '/help':
-                help_lines = [
-                    "=== LỆNH ===",
-                    "/list, /ls - Danh sách online",
-                    f"/msg <tên> <tin> - Yêu cầu chat riêng (hết hạn sau {REQUEST_TIMEOUT}s)",
-                    "/accept <tên> - Chấp nhận",
-                    "/decline <tên> - Từ chối",
-                    "/back - Về phòng chung",
-                    "/history, /his - Xem lịch sử",
-                    "/changepass <cũ> <mới> - Đổi pass",
-                    "/exit - Thoát",
-                    "",
-                    "=== GIỚI HẠN ===",
-                    f"- Tin nhắn: tối đa {MAX_MESSAGE_LENGTH} ký tự",
-                    f"- Username: {MIN_USERNAME_LENGTH}-{MAX_USERNAME_LENGTH} ký tự (chữ, số, _)",
-                    f"- Password: {MIN_PASSWORD_LENGTH}-{MAX_PASSWORD_LENGTH} ký tự",
-                    f"- Yêu cầu chat: tự động hủy sau {REQUEST_TIMEOUT} giây"
-                ]
-                for line in help_lines:
-                    send_message(conn, line)
-                    time.sleep(0.01)
-            
-            elif msg in ['/list', '/ls']:
-                with lock:
-                    users = [f"{u} ({'chung' if rt=='public' else f'riêng-{tg}'})" 
-                             for _, _, u, rt, tg in Client_list if u != username]
-                send_message(conn, f"Online ({len(users)}/{MAX_CLIENTS}): {', '.join(users) if users else 'Không có'}")
-            
-            elif msg.startswith('/msg '):
-                parts = msg.split(' ', 2)
-                if len(parts) < 3:
-                    send_message(conn, "Cách dùng: /msg <tên> <tin>")
-                    continue
-                target, message = parts[1], parts[2]
-                
-                valid, error_msg = validate_message(message)
-                if not valid:
-                    send_message(conn, f"Lỗi: {error_msg}")
-                    continue
-                
-                valid, error_msg = validate_username(target)
-                if not valid:
-                    send_message(conn, f"Lỗi: Tên người nhận không hợp lệ")
-                    continue
-                
-                with lock:
-                    target_exists = False
-                    target_in_private = False
-                    for _, _, u, rt, _ in Client_list:
-                        if u == target:
-                            target_exists = True
-                            if rt == "private":
-                                target_in_private = True
-                            break
-                    if target == username:
-                        send_message(conn, "Không thể gửi yêu cầu chat riêng cho chính mình")
-                        continue
-                    if not target_exists:
-                        send_message(conn, f"Lỗi: {target} không online")
-                        continue
-                    if target_in_private:
-                        send_message(conn, f"Lỗi: {target} đang chat riêng")
-                        continue
-                    pending_requests[(username, target)] = time.time()
-                
-                notify(target, f"{username} muốn chat riêng: '{message[:50]}...'\nGõ /accept {username} hoặc /decline {username} (hết hạn sau {REQUEST_TIMEOUT}s)")
-                send_message(conn, f"Đã gửi yêu cầu tới {target} (hết hạn sau {REQUEST_TIMEOUT}s)")
-                logging.info(f"[YÊU CẦU] {username} -> {target}")
-            
-            elif msg.startswith('/accept '):
-                requester = msg.split(' ', 1)[1]
-                
-                valid, _ = validate_username(requester)
-                if not valid:
-                    send_message(conn, f"Tên không hợp lệ")
-                    continue
-                
-                cleanup_expired_requests()
-                
-                requester_conn = None
-                requester_room_type = None
-                accepter_room_type = None
-                
-                with lock:
-                    if (requester, username) not in pending_requests:
-                        send_message(conn, f"Không có yêu cầu từ {requester} (có thể đã hết hạn)")
-                        continue
-                    
-                    requester_found = False
-                    for i, (c, a, u, rt, tg) in enumerate(Client_list):
-                        if u == requester:
-                            requester_conn = c
-                            requester_room_type = rt
-                            requester_found = True
-                            break
-                    
-                    if not requester_found:
-                        send_message(conn, f"Lỗi: {requester} đã offline")
-                        del pending_requests[(requester, username)]
-                        continue
-                    
-                    for i, (c, a, u, rt, tg) in enumerate(Client_list):
-                        if u == username:
-                            accepter_room_type = rt
-                            break
-                    
-                    del pending_requests[(requester, username)]
-                    
-                    for i, (c, a, u, rt, tg) in enumerate(Client_list):
-                        if u == username:
-                            Client_list[i] = (c, a, u, "private", requester)
-                        elif u == requester:
-                            Client_list[i] = (c, a, u, "private", username)
-                
-                logging.info(f"[ACCEPT] {username} chấp nhận {requester}")
-                
-                if accepter_room_type == "public":
-                    broadcast_public("MÁY CHỦ", f"{username} đã rời phòng chung", True)
-                
-                if requester_room_type == "public":
-                    broadcast_public("MÁY CHỦ", f"{requester} đã rời phòng chung", True)
-                
-                if requester_conn:
-                    send_message(requester_conn, f"OK:Đã vào chat riêng với {username}. Gõ /back về phòng chung.")
-                    time.sleep(0.1)
-                    send_history(requester_conn, requester, "private", username)
-                
-                time.sleep(0.1)
-                send_message(conn, f"OK:Đã vào chat riêng với {requester}. Gõ /back về phòng chung.")
-                time.sleep(0.1)
-                send_history(conn, username, "private", requester)
-                
-                logging.info(f"[CHAT RIÊNG] {username} <-> {requester}")
-            
-            elif msg.startswith('/decline '):
-                requester = msg.split(' ', 1)[1]
-                
-                valid, _ = validate_username(requester)
-                if not valid:
-                    send_message(conn, f"Tên không hợp lệ")
-                    continue
-                
-                cleanup_expired_requests()
-                
-                with lock:
-                    if (requester, username) not in pending_requests:
-                        send_message(conn, f"Không có yêu cầu từ {requester} (có thể đã hết hạn)")
-                        continue
-                    del pending_requests[(requester, username)]
-                send_message(conn, f"Đã từ chối {requester}")
-                notify(requester, f"{username} đã từ chối")
-                logging.info(f"[TỪ CHỐI] {username} từ chối {requester}")
-            
-            elif msg == '/back':
-                if room_type == "public":
-                    send_message(conn, "Bạn đang ở phòng chung")
-                    continue
-                
-                partner_conn = None
-                partner_username = None
-                
-                with lock:
-                    for i, (c, a, u, rt, tg) in enumerate(Client_list):
-                        if u == room_target and rt == "private" and tg == username:
-                            partner_conn = c
-                            partner_username = u
-                            Client_list[i] = (c, a, u, "public", None)
-                        elif u == username:
-                            Client_list[i] = (c, a, u, "public", None)
-                
-                if partner_conn and partner_username:
-                    send_message(partner_conn, "OK:Đã quay lại phòng chung.")
-                    time.sleep(0.1)
-                    send_history(partner_conn, partner_username, "public", None)
-                    time.sleep(0.1)
-                    broadcast_public("MÁY CHỦ", f"{partner_username} đã tham gia phòng chung", True)
-                
-                if room_target:
-                    notify(room_target, f"{username} đã về phòng chung")
-                
-                time.sleep(0.1)
-                send_history(conn, username, "public", None)
-                time.sleep(0.2)
-                send_message(conn, "OK:Đã quay lại phòng chung.")
-                
-                time.sleep(0.1)
-                broadcast_public("MÁY CHỦ", f"{username} đã tham gia phòng chung", True)
-                
-                logging.info(f"[/BACK] {username} và {partner_username if partner_username else 'N/A'} về phòng chung")
-            
-            elif msg in ['/history', '/his']:
-                send_history(conn, username, room_type, room_target)
-            
-            elif msg.startswith('/changepass '):
-                parts = msg.split(' ')
-                if len(parts) != 3:
-                    send_message(conn, "Cách dùng: /changepass <cũ> <mới>")
-                    continue
-                
-                old_pass, new_pass = parts[1], parts[2]
-                
-                valid, error_msg = validate_password(new_pass)
-                if not valid:
-                    send_message(conn, f"LỖI: {error_msg}")
-                    continue
-                
-                db = sqlite3.connect(DB_FILE)
-                c = db.cursor()
-                c.execute("SELECT password_hash FROM users WHERE username=?", (username,))
-                if c.fetchone()[0] == hash_pwd(old_pass):
-                    c.execute("UPDATE users SET password_hash=? WHERE username=?", (hash_pwd(new_pass), username))
-                    db.commit()
-                    send_message(conn, "Đổi mật khẩu thành công!")
-                    logging.info(f"[ĐỔI PASS] {username}")
-                else:
-                    send_message(conn, "LỖI: Sai mật khẩu cũ")
-                db.close()
-            
-            elif msg == '/exit':
-                send_message(conn, "Tạm biệt!")
-                break
+            if rate_limited(conn, session.rate, rate_kind(session, opcode, fields)):
+                continue
             
+            if opcode == OP_COMMAND and fields[0] in COMMANDS:
+                if COMMANDS[fields[0]](session, fields[1].strip()):
+                    graceful = True
+                    break
+            elif opcode == OP_COMMAND:
+                say(session, f"{fields[0]} {fields[1]}".strip())  # Lệnh lạ: giữ cách cũ, coi như tin chat
+            elif opcode == OP_SAY:
+                say(session, fields[0].strip())
+            elif opcode in FILE_OPS:
+                FILE_OPS[opcode](session, fields)
             else:
-                valid, error_msg = validate_message(msg)
-                if not valid:
-                    send_message(conn, f"[LỖI] {error_msg}")
-                    continue
-                
-                if room_type == "public":
-                    save_msg(username, msg)
-                    broadcast_public(username, msg)
-                    logging.info(f"[CHUNG] {username}: {msg[:50]}...")
-                elif room_type == "private":
-                    save_msg(username, msg, room_target)
-                    partner_conn = get_user_conn(room_target)
-                    if partner_conn:
-                        partner_rt, partner_tg = get_current_state(room_target)
-                        if partner_rt == "private" and partner_tg == username:
-                            send_message(partner_conn, f"[{username}] {msg}")
-                    logging.info(f"[RIÊNG] {username} -> {room_target}: {msg[:50]}...")
+                logging.warning(f"[GIAO THỨC] {username} gửi opcode không hợp lệ: {opcode:#04x}")
                     
-    except socket.timeout:
-        if username:
-            logging.warning(f"[TIMEOUT] {username} - Không hoạt động trong {AUTH_TIMEOUT if not username else CHAT_TIMEOUT}s")
-        else:
-            logging.warning(f"[TIMEOUT] {addr} - Timeout khi xác thực")
     except ConnectionResetError:
         logging.warning(f"[NGẮT ĐỘT NGỘT] {username} - ConnectionResetError")
     except BrokenPipeError:
         logging.warning(f"[NGẮT ĐỘT NGỘT] {username} - BrokenPipeError")
     except UnicodeDecodeError:
         logging.error(f"[LỖI] {username or addr} - Lỗi decode UTF-8")
+    except RateLimitExceeded as e:
+        graceful = True  # Không giữ phiên cho client đang gửi dồn
+        send_message(conn, "LỖI:Gửi quá nhanh, kết nối bị ngắt")
+        logging.warning(f"[CHẶN] {username or addr} - Vượt giới hạn {e} quá {RATE_STRIKES} lần trong {RATE_STRIKE_WINDOW}s")
     except Exception as e:
         logging.error(f"[LỖI] {username or addr}: {e}")
     finally:
-        if username:
+        if conn.timed_out:
+            if username:
+                logging.warning(f"[TIMEOUT] {username} - Không hoạt động trong {CHAT_TIMEOUT}s")
+            else:
+                logging.warning(f"[TIMEOUT] {addr} - Timeout khi xác thực")
+        if username and not graceful and registry.detach(username, conn):
+            logging.info(f"[TẠM NGẮT] {username} - giữ phiên {RESUME_GRACE}s chờ khôi phục")
+            cancel_transfers(username, f"{username} mất kết nối")  # Chunk đang gửi dở không khôi phục được
+        elif username:
             final_room_type, final_room_target = get_current_state(username)
             if final_room_type is not None:
                 cleanup_user(username, final_room_type, final_room_target)
+        admission.leave(conn)
         try:
             conn.close()
         except (OSError, AttributeError):
             pass
 
-count = db_init()
-ServerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-ServerSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-ServerSocket.bind((Local_IP, Local_Port))
-ServerSocket.listen(SOCKET_BACKLOG)
+def request_admission(conn, wake):
+    """Xin chỗ cho kết nối mới (xem Admission.enter); hàng đợi đầy thì báo client và đóng kết nối"""
+    position = admission.enter(conn, wake)
+    if position is None:
+        send_message(conn, "LỖI:Server đã đầy. Vui lòng thử lại sau.")
+        logging.warning(f"[TỪ CHỐI] {conn.addr} - Server đầy ({MAX_CLIENTS} clients, {ADMISSION_QUEUE} đang chờ)")
+        conn.close()
+    return position
+
+def admission_expired(conn):
+    """Chờ quá ADMISSION_TIMEOUT mà chưa tới lượt"""
+    admission.leave(conn)  # Rời hàng đợi, hoặc trả lại chỗ nếu vừa được cấp
+    send_message(conn, "LỖI:Chờ quá lâu, vui lòng thử lại sau.")
+    logging.warning(f"[TỪ CHỐI] {conn.addr} - Chờ quá {ADMISSION_TIMEOUT}s trong hàng đợi")
+    conn.close()
+
+def handle_client(sock, addr):
+    """Chế độ thread: mỗi kết nối một luồng đọc (recv chặn) và một luồng ghi"""
+    conn = SocketConn(sock, addr)
+    admitted = threading.Event()
+    position = request_admission(conn, admitted.set)
+    if position is None:
+        return
+    if position and not admitted.wait(ADMISSION_TIMEOUT):
+        admission_expired(conn)
+        return
+    frames = FrameReader(MAX_FRAME_BYTES, RECV_BUFFER_SIZE)
+    session = client_session(conn, addr)
+    try:
+        next(session)
+        while True:
+            request_id, msg = recv_message(conn, frames, sock)
+            conn.touch()
+            with request_scope(conn, request_id):
+                session.send(msg)
+    except StopIteration:
+        pass
+    finally:
+        session.close()
+
+def step_session(session, conn, request_id, msg):
+    """Chạy client_session tới yield kế tiếp; False khi phiên đã kết thúc.
+    StopIteration không đặt được vào Future của asyncio nên đổi thành cờ."""
+    try:
+        with request_scope(conn, request_id):
+            session.send(msg)
+        return True
+    except StopIteration:
+        return False
+
+session_executor = None  # ThreadPoolExecutor của chế độ async, tạo trong run_async_server
+
+async def handle_client_async(reader, writer):
+    """Chế độ async: event loop chỉ đọc/ghi socket; mỗi bước client_session (có thể chờ SQLite,
+    hàng đợi ghi DB hay broker) chạy trên session_executor, nên một truy vấn chậm không làm đứng mọi kết nối"""
+    addr = writer.get_extra_info('peername')
+    loop = asyncio.get_running_loop()
+    conn = AsyncConn(writer, loop)
+    admitted = asyncio.Event()
+    position = request_admission(conn, lambda: loop.call_soon_threadsafe(admitted.set))
+    if position is None:
+        return
+    if position:
+        try:
+            await asyncio.wait_for(admitted.wait(), ADMISSION_TIMEOUT)
+        except asyncio.TimeoutError:
+            admission_expired(conn)
+            return
+    frames = FrameReader(MAX_FRAME_BYTES, RECV_BUFFER_SIZE)
+    session = client_session(conn, addr)
+    try:
+        running = await loop.run_in_executor(session_executor, step_session, session, conn, None, None)
+        while running:
+            request_id, msg = await recv_message_async(conn, reader, frames)
+            conn.touch()
+            running = await loop.run_in_executor(session_executor, step_session, session, conn, request_id, msg)
+    finally:
+        await loop.run_in_executor(session_executor, session.close)
 
-logging.info("=" * 50)
-logging.info(f"SERVER BẬT - {Local_IP}:{Local_Port}")
-logging.info(f"Giới hạn: {MAX_CLIENTS} clients, tin nhắn {MAX_MESSAGE_LENGTH} ký tự")
-logging.info(f"Timeout: Xác thực {AUTH_TIMEOUT}s, Chat {CHAT_TIMEOUT}s")
-logging.info(f"Database: {count} tài khoản")
-logging.info("=" * 50)
+ServerSocket = None
 
 def accept_clients():
     while True:
@@ -679,72 +2795,325 @@ def accept_clients():
             logging.error(f"[ACCEPT ERROR] {e}")
             break
 
-threading.Thread(target=accept_clients, daemon=True).start()
+def run_async_server():
+    """Chạy event loop asyncio (trong luồng riêng, console admin vẫn ở luồng chính)"""
+    global session_executor
+    session_executor = concurrent.futures.ThreadPoolExecutor(ASYNC_SESSION_THREADS, thread_name_prefix="session")
+    async def serve():
+        server = await asyncio.start_server(handle_client_async, sock=ServerSocket, backlog=SOCKET_BACKLOG)
+        async with server:
+            await server.serve_forever()
+    try:
+        asyncio.run(serve())
+    except Exception as e:
+        logging.error(f"[ASYNC ERROR] {e}")
 
-def cleanup_requests_periodically():
+def cleanup_sessions_periodically():
     while True:
         time.sleep(10)
-        expired_count = cleanup_expired_requests()
+        expired_count = expire_detached_sessions()
         if expired_count > 0:
-            logging.info(f"[DỌN DẸP] Xóa {expired_count} yêu cầu hết hạn")
+            logging.info(f"[DỌN DẸP] Hết hạn {expired_count} phiên tạm ngắt")
 
-threading.Thread(target=cleanup_requests_periodically, daemon=True).start()
+def shutdown(reason):
+    """Ghi nốt các tin nhắn còn trong hàng đợi rồi tắt server"""
+    logging.info(reason)
+    message_log.stop()
+    ServerSocket.close()
+    os._exit(0)
 
-print("\nLệnh: users | rooms | requests | limits | exit")
-while True:
-    try:
-        cmd = input().strip().lower()
+def admin_console():
+    print("\nLệnh: users | rooms | requests | queues | db | limits | throttle | exit")
+    while True:
+        try:
+            cmd = input().strip().lower()
         
-        if cmd == 'users':
-            with lock:
-                if not Client_list:
+            if cmd == 'users':
+                sessions = registry.all()
+                if not sessions:
                     print("Không có client nào")
                 else:
-                    print(f"\n--- CLIENT ({len(Client_list)}/{MAX_CLIENTS}) ---")
-                    for _, addr, u, rt, tg in Client_list:
-                        status = "Chung" if rt == "public" else f"Riêng với {tg}"
-                        print(f"  {u} | {addr[0]}:{addr[1]} | {status}")
+                    print(f"\n--- CLIENT ({get_client_count()}/{MAX_CLIENTS} đang kết nối, {len(sessions)} phiên) ---")
+                    for session in sessions:
+                        status = "Riêng với " + session.room_target if session.room_type == "private" else room_name(session.room_target).capitalize()
+                        if session.detached_at is not None:
+                            status += f" | tạm ngắt {time.time() - session.detached_at:.0f}s"
+                        print(f"  {session.username} | {session.addr[0]}:{session.addr[1]} | {status}")
                     print()
         
-        elif cmd == 'rooms':
-            with lock:
-                public = [u for _, _, u, rt, _ in Client_list if rt == "public"]
-                private_pairs = {tuple(sorted((u, tg))) for _, _, u, rt, tg in Client_list if rt == "private"}
+            elif cmd == 'rooms':
+                with lock:
+                    rooms = registry.rooms()
+                    channels = {c: list(members) for c, members in registry.channels.items()}
+                    private_pairs = registry.pairs()
                 print(f"\n--- PHÒNG ---")
-                print(f"Chung ({len(public)}): {', '.join(public) or 'Trống'}")
+                for channel in sorted(rooms, key=lambda c: (c is not None, -rooms[c], c or "")):
+                    print(f"{room_name(channel).capitalize()} ({rooms[channel]}): {', '.join(channels.get(channel, [])) or 'Trống'}")
                 print(f"Riêng ({len(private_pairs)} cặp): {', '.join([f'{a}<->{b}' for a, b in private_pairs]) or 'Không'}\n")
         
-        elif cmd == 'requests':
-            with lock:
-                if not pending_requests:
+            elif cmd == 'requests':
+                requests = pending_requests.items()
+                if not requests:
                     print("Không có yêu cầu\n")
                 else:
-                    print(f"\n--- YÊU CẦU ({len(pending_requests)}) ---")
-                    for (s, r), ts in pending_requests.items():
+                    print(f"\n--- YÊU CẦU ({len(requests)}) ---")
+                    for (s, r), ts in requests:
                         print(f"  {s} -> {r} ({int(time.time()-ts)}s trước)")
                     print()
         
-        elif cmd == 'limits':
-            print(f"\n--- GIỚI HẠN SERVER ---")
-            print(f"Max clients: {MAX_CLIENTS}")
-            print(f"Max message length: {MAX_MESSAGE_LENGTH} ký tự")
-            print(f"Username: {MIN_USERNAME_LENGTH}-{MAX_USERNAME_LENGTH} ký tự (a-z, A-Z, 0-9, _)")
-            print(f"Password: {MIN_PASSWORD_LENGTH}-{MAX_PASSWORD_LENGTH} ký tự")
-            print(f"Request timeout: {REQUEST_TIMEOUT} giây")
-            print(f"Auth timeout: {AUTH_TIMEOUT} giây")
-            print(f"Chat timeout: {CHAT_TIMEOUT} giây")
-            print(f"Current clients: {get_client_count()}/{MAX_CLIENTS}")
-            print()
+            elif cmd == 'queues':
+                sessions = registry.all()
+                print(f"\n--- HÀNG ĐỢI GỬI (policy: {OUTBOX_POLICY}, tối đa {OUTBOX_MAX_FRAMES} frame / {OUTBOX_HIGH_WATER} bytes) ---")
+                print(f"Frame bị bỏ: {outbox_stats['dropped']} | Client chậm bị ngắt: {outbox_stats['disconnects']}")
+                for session in sessions:
+                    frames, queued = session.conn.depth()
+                    deflater = session.conn.deflater
+                    compression = (f" | nén {deflater.mode} {deflater.wire_bytes}/{deflater.raw_bytes} bytes"
+                                   if deflater else "")
+                    print(f"  {session.username} | đang chờ {frames} frame ({queued} bytes) | "
+                          f"cao nhất {session.conn.peak_frames} | bỏ {session.conn.dropped}{compression}")
+                print()
         
-        elif cmd == 'exit':
-            logging.info("SERVER TẮT")
-            ServerSocket.close()
-            os._exit(0)
+            elif cmd == 'limits':
+                print(f"\n--- GIỚI HẠN SERVER ---")
+                print(f"Max clients: {MAX_CLIENTS}")
+                print(f"Max message length: {MAX_MESSAGE_LENGTH} ký tự")
+                print(f"Username: {MIN_USERNAME_LENGTH}-{MAX_USERNAME_LENGTH} ký tự (a-z, A-Z, 0-9, _)")
+                print(f"Password: {MIN_PASSWORD_LENGTH}-{MAX_PASSWORD_LENGTH} ký tự")
+                print(f"Request timeout: {REQUEST_TIMEOUT} giây")
+                print(f"Auth timeout: {AUTH_TIMEOUT} giây")
+                print(f"Chat timeout: {CHAT_TIMEOUT} giây (đang theo dõi {len(idle_tracker)} kết nối, đã ngắt {idle_tracker.expired})")
+                print(f"DB pool: {DB_POOL_SIZE} kết nối (WAL, synchronous={DB_SYNCHRONOUS}, busy_timeout={DB_BUSY_TIMEOUT}ms)")
+                print(f"Outbox: {OUTBOX_MAX_FRAMES} frame / {OUTBOX_HIGH_WATER} bytes, policy {OUTBOX_POLICY}")
+                threshold = "mặc định theo chế độ" if COMPRESS_THRESHOLD is None else f"frame từ {COMPRESS_THRESHOLD} bytes"
+                print(f"Nén: {'bật' if COMPRESSION else 'tắt'} ({threshold})")
+                print(f"File: tối đa {FILE_MAX_BYTES // (1024 * 1024)}MB, cửa sổ {FILE_WINDOW} chunk (đang gửi {len(file_transfers)} lượt)")
+                print(f"Current clients: {get_client_count()}/{MAX_CLIENTS}")
+                stats = admission.stats
+                print(f"Tiếp nhận: {admission.sessions} phiên + {admission.handshakes}/{MAX_HANDSHAKES} đang xác thực, "
+                      f"{len(admission.waiting)}/{ADMISSION_QUEUE} đang chờ (tối đa {ADMISSION_TIMEOUT}s)")
+                print(f"  Đã cấp chỗ {stats['admitted']} | đã xếp hàng {stats['queued']} | "
+                      f"từ chối {stats['rejected']} | bỏ hàng {stats['abandoned']}")
+                print()
         
-        else:
-            print("Lệnh: users | rooms | requests | limits | exit")
+            elif cmd == 'throttle':
+                with rate_limiter.lock:
+                    blocked = dict(rate_limiter.stats)
+                    tracked = len(rate_limiter.ips)
+                print(f"\n--- GIỚI HẠN TỐC ĐỘ (mỗi IP x{RATE_IP_FACTOR}{'' if RATE_LIMIT_LOOPBACK else ', trừ loopback'}) ---")
+                for kind, limit in RATE_LIMITS.items():
+                    budget = f"{limit[0]} lần, hồi {limit[1]:g}/s" if limit else "không giới hạn"
+                    print(f"  {kind}: {budget} | bị chặn {blocked.get(kind, 0)}")
+                print(f"Đang theo dõi {tracked}/{RATE_IP_TABLE} (IP, loại)")
+                print(f"Ngắt kết nối: {rate_limiter.disconnects} (quá {RATE_STRIKES} lần bị chặn trong {RATE_STRIKE_WINDOW}s)")
+                locked_users, locked_ips = auth_guard.locked()
+                print(f"Đăng nhập: khóa {locked_users} tài khoản, {locked_ips} IP (từ lần sai thứ {AUTH_ACCOUNT_FREE}/{AUTH_IP_FREE}, "
+                      f"tối đa {AUTH_BACKOFF_MAX}s) | từ chối khi đang khóa {auth_guard.blocked_attempts}")
+                print(f"Cache tài khoản: {len(auth_guard.users)}/{USER_CACHE_SIZE} có, {len(auth_guard.missing)}/{USER_CACHE_MISSING} không tồn tại | "
+                      f"hit {auth_guard.hits} / miss {auth_guard.misses}")
+                for session in registry.all():
+                    strikes = len(session.rate.strikes)
+                    if strikes:
+                        print(f"  {session.username} | {session.addr[0]} | {strikes} lần bị chặn gần đây")
+                print()
+        
+            elif cmd == 'db':
+                stats = message_log.stats
+                avg_batch = stats["messages"] / stats["batches"] if stats["batches"] else 0
+                avg_ms = stats["total_ms"] / stats["batches"] if stats["batches"] else 0
+                print(f"\n--- GHI TIN NHẮN (lô {DB_BATCH_SIZE} tin / {DB_FLUSH_INTERVAL}s) ---")
+                print(f"Đang chờ ghi: {len(message_log.pending)} tin")
+                print(f"Đã ghi: {stats['messages']} tin trong {stats['batches']} lô (lỗi: {stats['errors']})")
+                print(f"Kích thước lô: trung bình {avg_batch:.1f}, lớn nhất {stats['max_batch']}")
+                print(f"Thời gian ghi: gần nhất {stats['last_ms']:.2f}ms, trung bình {avg_ms:.2f}ms, lâu nhất {stats['max_ms']:.2f}ms")
+                print(f"Cache lịch sử: {len(history_cache.public)} tin chung, {len(history_cache.channels)}/{HISTORY_CACHE_CHANNELS} kênh, "
+                      f"{len(history_cache.private)}/{HISTORY_CACHE_PAIRS} chat riêng, "
+                      f"{history_cache.size / 1024:.1f}/{HISTORY_CACHE_BYTES // 1024} KB, hit {history_cache.hits} / miss {history_cache.misses}\n")
+        
+            elif cmd == 'exit':
+                shutdown("SERVER TẮT")
+        
+            else:
+                print("Lệnh: users | rooms | requests | queues | db | limits | throttle | exit")
+            
+        except (KeyboardInterrupt, EOFError):
+            shutdown("\nSERVER TẮT (Ctrl+C)")
+
+def format_rate_limits():
+    limits = ", ".join(f"{kind} {limit[0]} (+{limit[1]:g}/s)" if limit else f"{kind} tắt"
+                       for kind, limit in RATE_LIMITS.items())
+    return limits if RATE_LIMIT_LOOPBACK else f"{limits} (trừ loopback)"
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Chat server")
+    parser.add_argument("--mode", choices=["thread", "async"], default=SERVER_MODE,
+                        help="thread: mỗi kết nối 1 luồng | async: 1 event loop asyncio")
+    parser.add_argument("--max-clients", type=int, default=None,
+                        help=f"Số client tối đa (mặc định {MAX_CLIENTS} cho thread, {MAX_CLIENTS_ASYNC} cho async)")
+    parser.add_argument("--max-handshakes", type=int, default=MAX_HANDSHAKES,
+                        help="Số kết nối đang xác thực cùng lúc")
+    parser.add_argument("--admission-queue", type=int, default=ADMISSION_QUEUE,
+                        help="Số kết nối được xếp hàng chờ khi server đầy (0 = từ chối ngay)")
+    parser.add_argument("--rate-limit", action="append", default=[], metavar="LOẠI=SỐ/GIÂY",
+                        help=f"Budget mỗi phiên cho một loại ({', '.join(RATE_LIMITS)}), vd public=10/2: "
+                             "10 lần liên tiếp, hồi 2 lần mỗi giây; LOẠI=off để bỏ giới hạn. Lặp lại cho nhiều loại")
+    parser.add_argument("--no-rate-limit", action="store_true",
+                        help="Tắt mọi giới hạn tốc độ (benchmark nhiều client từ một IP)")
+    parser.add_argument("--rate-limit-loopback", action="store_true",
+                        help="Giới hạn tốc độ cả client từ 127.0.0.1/::1 (mặc định bỏ qua để test.py, bench.py chạy được)")
+    parser.add_argument("--outbox-policy", choices=["drop", "disconnect"], default=OUTBOX_POLICY,
+                        help="Xử lý client nhận chậm khi hàng đợi gửi đầy")
+    parser.add_argument("--outbox-high-water", type=int, default=OUTBOX_HIGH_WATER,
+                        help="Số byte chờ gửi tối đa mỗi kết nối")
+    parser.add_argument("--no-compression", action="store_true",
+                        help="Không nén frame kể cả khi client xin")
+    parser.add_argument("--compress-threshold", type=int, default=COMPRESS_THRESHOLD,
+                        help="Chỉ nén frame từ số byte này trở lên (mặc định theo chế độ nén)")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="Số process worker cùng nghe cổng (SO_REUSEPORT), nối với nhau qua broker Unix socket")
+    parser.add_argument("--worker-id", type=int, default=None, help=argparse.SUPPRESS)  # Do tiến trình cha truyền
+    parser.add_argument("--broker", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        parser.error("--workers cần SO_REUSEPORT (Linux/BSD)")
+    args.rate_limits = dict.fromkeys(RATE_LIMITS) if args.no_rate_limit else dict(RATE_LIMITS)
+    for spec in args.rate_limit:
+        kind, _, value = spec.partition("=")
+        if kind not in RATE_LIMITS:
+            parser.error(f"--rate-limit: loại '{kind}' không hợp lệ (chọn {', '.join(RATE_LIMITS)})")
+        if value == "off":
+            args.rate_limits[kind] = None
+            continue
+        try:
+            burst, rate = value.split("/")
+            burst, rate = int(burst), float(rate)
+        except ValueError:
+            parser.error(f"--rate-limit: '{spec}' phải có dạng LOẠI=SỐ/GIÂY, vd public=10/2")
+        if burst < 1 or rate <= 0:
+            parser.error(f"--rate-limit: '{spec}' cần SỐ >= 1 và GIÂY > 0")
+        args.rate_limits[kind] = (burst, rate)
+    return args
+
+def run_cluster(args):
+    """Tiến trình cha của cluster: chuẩn bị DB, chạy broker, sinh các worker rồi giữ console admin.
+    Worker là chính Server.py với cùng tham số, thêm --worker-id/--broker."""
+    db_init()  # Nâng cấp schema một lần trước khi các worker cùng mở DB
+    path = socket_path()
+    broker = Broker(path)
+    threading.Thread(target=broker.serve, daemon=True).start()
+    script = os.path.abspath(__file__)
+    workers = [subprocess.Popen([sys.executable, script, *sys.argv[1:], "--worker-id", str(shard), "--broker", path],
+                                stdin=subprocess.DEVNULL)
+               for shard in range(args.workers)]
+    logging.info(f"[CLUSTER] {args.workers} worker trên {Local_IP}:{Local_Port}, broker {path}")
+    cluster_console(broker, workers)
+
+def stop_cluster(broker, workers, reason):
+    logging.info(reason)
+    for worker in workers:
+        if worker.poll() is None:
+            worker.terminate()  # Worker ghi nốt hàng đợi tin nhắn rồi thoát
+    for worker in workers:
+        try:
+            worker.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            worker.kill()
+    broker.close()
+    os._exit(0)
+
+def cluster_console(broker, workers):
+    print("\nLệnh: workers | users | exit")
+    while True:
+        try:
+            cmd = input().strip().lower()
             
-    except (KeyboardInterrupt, EOFError):
-        logging.info("\nSERVER TẮT (Ctrl+C)")
-        ServerSocket.close()
-        os._exit(0)
\ No newline at end of file
+            if cmd == 'workers':
+                owners, detached = broker.users()
+                print(f"\n--- WORKER ({len(workers)}) | broker đã chuyển {broker.messages} thông điệp ---")
+                for shard, worker in enumerate(workers):
+                    status = "đang chạy" if worker.poll() is None else f"đã dừng (mã {worker.returncode})"
+                    users = [u for u, s in owners.items() if s == shard]
+                    print(f"  Worker {shard} | pid {worker.pid} | {status} | {len(users)} user "
+                          f"({sum(1 for u in users if u in detached)} tạm ngắt)")
+                print()
+            
+            elif cmd == 'users':
+                owners, detached = broker.users()
+                print(f"\n--- CLIENT ({len(owners) - len(detached)}/{MAX_CLIENTS * WORKERS} đang kết nối, {len(owners)} phiên) ---")
+                for username, shard in sorted(owners.items()):
+                    print(f"  {username} | worker {shard}{' | tạm ngắt' if username in detached else ''}")
+                print()
+            
+            elif cmd == 'exit':
+                stop_cluster(broker, workers, "CLUSTER TẮT")
+            
+            else:
+                print("Lệnh: workers | users | exit")
+        
+        except (KeyboardInterrupt, EOFError):
+            stop_cluster(broker, workers, "\nCLUSTER TẮT (Ctrl+C)")
+
+def start_worker(args):
+    """Worker của cluster: log có tiền tố worker, nối broker, tắt khi tiến trình cha yêu cầu hoặc mất broker"""
+    global bus
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(logging.Formatter(f'%(asctime)s - [W{args.worker_id}] %(message)s'))
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C do tiến trình cha xử lý
+    signal.signal(signal.SIGTERM, lambda signum, frame: shutdown("WORKER TẮT"))
+    bus = Bus(args.broker, args.worker_id, apply_cluster_message, CLUSTER_CALLS,
+              slow=CLUSTER_SLOW_OPS, on_lost=lambda: shutdown("[CLUSTER] Mất kết nối broker, worker tắt"))
+
+def main():
+    global ServerSocket, WORKERS, MAX_CLIENTS, MAX_HANDSHAKES, ADMISSION_QUEUE, RATE_LIMITS, RATE_LIMIT_LOOPBACK, OUTBOX_POLICY, OUTBOX_HIGH_WATER, COMPRESSION, COMPRESS_THRESHOLD
+    args = parse_args()
+    WORKERS = args.workers
+    RATE_LIMITS = args.rate_limits
+    RATE_LIMIT_LOOPBACK = args.rate_limit_loopback
+    MAX_HANDSHAKES = args.max_handshakes
+    ADMISSION_QUEUE = args.admission_queue
+    OUTBOX_POLICY = args.outbox_policy
+    OUTBOX_HIGH_WATER = args.outbox_high_water
+    COMPRESSION = not args.no_compression
+    COMPRESS_THRESHOLD = args.compress_threshold
+    if args.max_clients is not None:
+        MAX_CLIENTS = args.max_clients
+    elif args.mode == "async":
+        MAX_CLIENTS = MAX_CLIENTS_ASYNC
+    if args.workers > 1 and args.worker_id is None:
+        run_cluster(args)
+        return
+
+    count = db_init()
+    if args.worker_id is not None:
+        start_worker(args)
+    ServerSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    ServerSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if args.worker_id is not None:
+        ServerSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # Kernel chia kết nối mới giữa các worker
+    ServerSocket.bind((Local_IP, Local_Port))
+    ServerSocket.listen(SOCKET_BACKLOG)
+
+    logging.info("=" * 50)
+    logging.info(f"SERVER BẬT - {Local_IP}:{Local_Port} (chế độ {args.mode})")
+    logging.info(f"Giới hạn: {MAX_CLIENTS} clients ({MAX_HANDSHAKES} đang xác thực, {ADMISSION_QUEUE} chờ), tin nhắn {MAX_MESSAGE_LENGTH} ký tự")
+    logging.info(f"Timeout: Xác thực {AUTH_TIMEOUT}s, Chat {CHAT_TIMEOUT}s")
+    logging.info(f"Giới hạn tốc độ: {format_rate_limits()}")
+    logging.info(f"Database: {count} tài khoản")
+    public_rows, private_pairs = history_cache.warm_up()
+    logging.info(f"Cache lịch sử: {public_rows} tin phòng chung, {private_pairs} cuộc chat riêng")
+    logging.info("=" * 50)
+
+    if args.mode == "async":
+        threading.Thread(target=run_async_server, daemon=True).start()
+    else:
+        threading.Thread(target=accept_clients, daemon=True).start()
+    threading.Thread(target=cleanup_sessions_periodically, daemon=True).start()
+    threading.Thread(target=pending_requests.run, daemon=True).start()
+    threading.Thread(target=idle_tracker.run, daemon=True).start()
+    if args.worker_id is not None:
+        while True:
+            signal.pause()  # Console admin ở tiến trình cha
+    admin_console()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+import socket
+import struct
+import time
+import sys
+import argparse
+import statistics
+import os
+import random
+import sqlite3
+import tempfile
+import shutil
+import selectors
+import threading
+import queue
+from collections import deque
+from framing import FrameReader, Deflater, Inflater, encode_frame, COMPRESSION_MODES, TAG_HELLO
+
+# === CẤU HÌNH BENCHMARK ===
+SERVER_IP = "127.0.0.1"
+SERVER_PORT = 20000
+BASE_USERNAME = "benchuser"
+BASE_PASSWORD = "password123"
+HISTORY_ROWS = 50  # Số tin nhắn chung tạo sẵn để lịch sử đầy
+DB_ROWS = 2_000_000  # Số tin nhắn riêng trong DB giả lập (kịch bản history_db)
+DB_USERS = 1000
+FANOUT_CLIENTS = 1000  # Số người nhận trong kịch bản fanout (server cần --max-clients lớn hơn)
+COMPRESS_THRESHOLDS = [0, 64, 128, 256, 512]  # Các ngưỡng so sánh trong kịch bản compression
+# Mọi client bench (và test.py) cùng IP 127.0.0.1: server mặc định không giới hạn tốc độ loopback,
+# đừng chạy server với --rate-limit-loopback khi bench (sẽ nhận CHẬM LẠI và bị ngắt vì vượt budget mỗi IP)
+
+# === CÁC HÀM HELPER GIAO THỨC MẠNG ===
+
+def send_message(conn, msg):
+    data = msg.encode('utf-8')
+    conn.sendall(struct.pack('!I', len(data)) + data)
+
+def recv_message(conn, timeout=10.0):
+    try:
+        conn.settimeout(timeout)
+        header = b''
+        while len(header) < 4:
+            chunk = conn.recv(4 - len(header))
+            if not chunk: return None
+            header += chunk
+        length = struct.unpack('!I', header)[0]
+        data = b''
+        while len(data) < length:
+            chunk = conn.recv(length - len(data))
+            if not chunk: return None
+            data += chunk
+        return data.decode('utf-8')
+    except socket.timeout:
+        return None
+
+def wait_for(conn, prefix, timeout=15.0):
+    """Đọc bỏ các frame cho tới frame bắt đầu bằng prefix"""
+    while True:
+        msg = recv_message(conn, timeout)
+        if msg is None:
+            raise Exception(f"Không nhận được '{prefix}'")
+        if msg.startswith(prefix):
+            return msg
+
+def logout(conn, timeout=15.0):
+    """/exit rồi chờ server đóng kết nối: đăng nhập lại ngay cùng tài khoản
+    khi server chưa dọn xong phiên cũ sẽ bị từ chối "Tài khoản đã đăng nhập"."""
+    send_message(conn, "/exit")
+    deadline = time.perf_counter() + timeout
+    while recv_message(conn, max(0.0, deadline - time.perf_counter())) is not None:
+        pass
+    conn.close()
+
+def drain(conn, quiet=0.3):
+    """Đọc bỏ mọi frame tới khi server im lặng quiet giây"""
+    while recv_message(conn, quiet) is not None:
+        pass
+
+def register_and_login(username, password=BASE_PASSWORD):
+    """Đăng ký (nếu chưa có) rồi đăng nhập.
+    Trả về (socket, thời gian từ lúc gửi mật khẩu tới khi vào phòng chung)"""
+    s = socket.create_connection((SERVER_IP, SERVER_PORT))
+    wait_for(s, "XÁC THỰC:")
+    send_message(s, "DANGKY")
+    wait_for(s, "DANGKY:")
+    send_message(s, username)
+    wait_for(s, "DANGKY:")
+    send_message(s, password)
+    wait_for(s, "XÁC THỰC:")
+
+    send_message(s, "DANGNHAP")
+    wait_for(s, "DANGNHAP:")
+    send_message(s, username)
+    wait_for(s, "DANGNHAP:")
+    start = time.perf_counter()
+    send_message(s, password)
+    wait_for(s, "OK:Đã vào phòng chung")
+    return s, time.perf_counter() - start
+
+def report(name, samples):
+    samples = sorted(samples)
+    p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+    print(f"{name}: n={len(samples)} trung bình={statistics.mean(samples) * 1000:.1f}ms "
+          f"trung vị={statistics.median(samples) * 1000:.1f}ms p95={p95 * 1000:.1f}ms")
+
+# === CÁC KỊCH BẢN ===
+
+def bench_login(rounds):
+    """Độ trễ đăng nhập -> sẵn sàng chat (gồm phát lại lịch sử phòng chung)"""
+    seeder, _ = register_and_login(f"{BASE_USERNAME}0")
+    for i in range(HISTORY_ROWS):
+        send_message(seeder, f"Tin nhắn lịch sử số {i}")
+    drain(seeder)
+
+    samples = []
+    for i in range(rounds):
+        s, elapsed = register_and_login(f"{BASE_USERNAME}{i + 1}")
+        samples.append(elapsed)
+        send_message(s, "/exit")
+        s.close()
+    seeder.close()
+    report("login -> sẵn sàng", samples)
+
+def bench_transition(rounds):
+    """Độ trễ /accept (vào chat riêng) và /back (về phòng chung), tính tới khi cả 2 bên nhận OK"""
+    a, _ = register_and_login(f"{BASE_USERNAME}a")
+    b, _ = register_and_login(f"{BASE_USERNAME}b")
+    drain(a)
+    drain(b)
+
+    accept_samples, back_samples = [], []
+    for i in range(rounds):
+        send_message(a, f"/msg {BASE_USERNAME}b chat riêng lần {i}")
+        wait_for(b, "[THÔNG BÁO]")
+        drain(a)
+
+        start = time.perf_counter()
+        send_message(b, f"/accept {BASE_USERNAME}a")
+        wait_for(a, "OK:Đã vào chat riêng")
+        wait_for(b, "OK:Đã vào chat riêng")
+        accept_samples.append(time.perf_counter() - start)
+        drain(a)
+        drain(b)
+
+        start = time.perf_counter()
+        send_message(b, "/back")
+        wait_for(a, "OK:Đã quay lại phòng chung")
+        wait_for(b, "OK:Đã quay lại phòng chung")
+        back_samples.append(time.perf_counter() - start)
+        drain(a)
+        drain(b)
+    a.close()
+    b.close()
+    report("/accept", accept_samples)
+    report("/back", back_samples)
+
+def bench_history_db(rounds):
+    """get_history chat riêng trên DB lớn: truy vấn OR cũ (quét bảng) so với index hội thoại.
+    Không cần server đang chạy; dùng chính migrate_schema/get_history của Server.py trên DB tạm."""
+    workdir = tempfile.mkdtemp(prefix="chatbench_")
+    os.chdir(workdir)  # Server.py ghi log vào thư mục hiện tại
+    path = os.path.join(workdir, "bench.db")
+    users = [f"user{i}" for i in range(DB_USERS)]
+
+    print(f"Tạo {DB_ROWS:,} tin nhắn riêng giữa {DB_USERS} user (schema cũ) tại {path} ...")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE private_messages (id INTEGER PRIMARY KEY, sender TEXT, receiver TEXT, message TEXT, timestamp TEXT)")
+    rng = random.Random(1)
+    batch = []
+    for i in range(DB_ROWS):
+        a, b = rng.sample(users, 2)
+        batch.append((a, b, f"Tin nhắn riêng số {i}", "2025-01-01 00:00:00"))
+        if len(batch) == 100_000:
+            db.executemany("INSERT INTO private_messages (sender, receiver, message, timestamp) VALUES (?, ?, ?, ?)", batch)
+            batch = []
+    if batch:
+        db.executemany("INSERT INTO private_messages (sender, receiver, message, timestamp) VALUES (?, ?, ?, ?)", batch)
+    db.commit()
+
+    pairs = [tuple(rng.sample(users, 2)) for _ in range(rounds)]
+    samples = []
+    for a, b in pairs:
+        start = time.perf_counter()
+        db.execute("SELECT sender, receiver, message, timestamp FROM private_messages WHERE (sender=? AND receiver=?) OR (sender=? AND receiver=?) ORDER BY id DESC LIMIT ?",
+                   (a, b, b, a, HISTORY_ROWS)).fetchall()
+        samples.append(time.perf_counter() - start)
+    db.close()
+    report("trước (OR, không index)", samples)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import Server
+    Server.DB_FILE = path
+    start = time.perf_counter()
+    Server.db_init()
+    print(f"Migration + mở pool: {time.perf_counter() - start:.1f}s")
+
+    samples = []
+    for a, b in pairs:
+        start = time.perf_counter()
+        Server.get_history(a, b, HISTORY_ROWS)
+        samples.append(time.perf_counter() - start)
+    report("sau (conversation, id)", samples)
+    shutil.rmtree(workdir, ignore_errors=True)
+
+class Drainer(threading.Thread):
+    """Một luồng đọc mọi socket người nhận (non-blocking + selector), đếm frame có chứa marker"""
+    def __init__(self, marker):
+        super().__init__(daemon=True)
+        self.marker = marker.encode('utf-8')
+        self.selector = selectors.DefaultSelector()
+        self.incoming = queue.Queue()
+        self.received = 0
+        self.done = threading.Event()
+
+    def add(self, sock):
+        sock.setblocking(False)
+        self.incoming.put(sock)
+
+    def run(self):
+        while True:
+            while not self.incoming.empty():
+                sock = self.incoming.get()
+                self.selector.register(sock, selectors.EVENT_READ, FrameReader(1024 * 1024))
+            for key, _ in self.selector.select(0.05):
+                try:
+                    if not key.data.fill(key.fileobj):
+                        self.selector.unregister(key.fileobj)
+                        continue
+                except BlockingIOError:
+                    continue
+                while (frame := key.data.pop()) is not None:
+                    if self.marker in frame:
+                        self.received += 1
+
+def bench_fanout(rounds):
+    """Thông lượng broadcast phòng chung tới FANOUT_CLIENTS người nhận: thời gian từ tin đầu tiên
+    tới khi mọi người nhận đủ rounds tin (server cần chạy với --max-clients > FANOUT_CLIENTS)"""
+    drainer = Drainer("FANOUT")
+    drainer.start()
+    print(f"Đăng nhập {FANOUT_CLIENTS} người nhận ...")
+    for i in range(FANOUT_CLIENTS):
+        s, _ = register_and_login(f"{BASE_USERNAME}f{i}")
+        drainer.add(s)
+    sender, _ = register_and_login(f"{BASE_USERNAME}fsender")
+    time.sleep(2)  # Chờ các broadcast "đã tham gia" được gửi hết
+    drain(sender)
+
+    expected = rounds * FANOUT_CLIENTS
+    start = time.perf_counter()
+    for i in range(rounds):
+        send_message(sender, f"FANOUT {i}")
+    while drainer.received < expected and time.perf_counter() - start < 120:
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - start
+    print(f"fanout: {rounds} tin x {FANOUT_CLIENTS} người nhận, nhận {drainer.received}/{expected} frame "
+          f"trong {elapsed * 1000:.0f}ms ({drainer.received / elapsed:,.0f} frame/s, "
+          f"{elapsed * 1000 / rounds:.1f}ms mỗi broadcast)")
+
+def bench_pipeline(rounds):
+    """Thời gian từ lúc kết nối tới khi có kết quả lệnh đầu tiên (/list):
+    từng bước chờ server trả lời (mỗi bước một lượt đi-về) so với gửi liền xác thực + lệnh
+    kèm mã yêu cầu (MÃ:BẬT rồi MÃ:<mã>:...) rồi ghép trả lời theo mã, chờ XONG của mã cuối"""
+    username = f"{BASE_USERNAME}p"
+    s, _ = register_and_login(username)
+    logout(s)
+    steps = ["DANGNHAP", username, BASE_PASSWORD, "/list"]
+
+    lockstep, pipelined = [], []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        s = socket.create_connection((SERVER_IP, SERVER_PORT))
+        wait_for(s, "XÁC THỰC:")
+        send_message(s, "DANGNHAP")
+        wait_for(s, "DANGNHAP:")
+        send_message(s, username)
+        wait_for(s, "DANGNHAP:")
+        send_message(s, BASE_PASSWORD)
+        wait_for(s, "OK:Đã vào phòng chung")
+        send_message(s, "/list")
+        wait_for(s, "Online")
+        lockstep.append(time.perf_counter() - start)
+        logout(s)
+
+        start = time.perf_counter()
+        s = socket.create_connection((SERVER_IP, SERVER_PORT))
+        s.sendall(encode_frame(TAG_HELLO) +
+                  b"".join(encode_frame(f"MÃ:{i}:{step}") for i, step in enumerate(steps, 1)))
+        replies = {}
+        while (msg := recv_message(s)) != f"XONG:{len(steps)}":
+            if msg is None:
+                raise Exception("Mất kết nối khi chờ trả lời")
+            if msg.startswith("MÃ:"):
+                request_id, _, reply = msg[3:].partition(":")
+                replies.setdefault(int(request_id), []).append(reply)
+        if not any(reply.startswith("Online") for reply in replies.get(len(steps), [])):
+            raise Exception(f"Không có kết quả /list: {replies}")
+        pipelined.append(time.perf_counter() - start)
+        logout(s)
+    report(f"từng bước ({len(steps)} lượt đi-về sau lời chào)", lockstep)
+    report("gửi liền kèm mã yêu cầu (1 lượt)", pipelined)
+
+def compression_corpus(rounds):
+    """Luồng frame giống một phòng chung đông người: tin chat kèm id, thông báo vào/ra phòng
+    và cứ 50 tin lại một lần phát lại lịch sử HISTORY_ROWS dòng"""
+    rng = random.Random(1)
+    users = [f"user_{i:03d}" for i in range(40)]
+    words = ("xin chào mọi người hôm nay trời đẹp quá ai đi ăn trưa không mình đang code server chat "
+             "lỗi timeout rồi thử lại đi ok cảm ơn nhé").split()
+    history = deque(maxlen=HISTORY_ROWS)
+    frames = []
+    for i in range(1, rounds + 1):
+        ts = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1_700_000_000 + i * 7))
+        user = rng.choice(users)
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(2, 25)))
+        history.append(f"[{ts}] {user}: {text}")
+        frames.append(encode_frame(f"#{i} [{user}] {text}"))
+        if i % 20 == 0:
+            frames.append(encode_frame(f"[MÁY CHỦ] {rng.choice(users)} đã tham gia phòng chung"))
+        if i % 50 == 0:
+            frames.append(encode_frame("LỊCH SỬ:=== PHÒNG CHUNG ===\n" + "\n".join(history) + "\n=== HẾT ==="))
+            frames.append(encode_frame(f"CON TRỎ:public:{i - len(history) + 1}:{i}"))
+    return frames
+
+def bench_compression(rounds):
+    """Byte trên đường truyền và CPU mỗi frame (nén + giải nén) theo chế độ nén và ngưỡng.
+    Không cần server: dùng chính Deflater/Inflater/FrameReader của framing.py trên luồng frame giả lập."""
+    rounds = max(rounds, 1000)
+    frames = compression_corpus(rounds)
+    raw = sum(len(f) for f in frames)
+    print(f"{len(frames)} frame, {raw:,} bytes chưa nén (trung bình {raw / len(frames):.0f} bytes/frame)")
+    for mode in COMPRESSION_MODES:
+        for threshold in COMPRESS_THRESHOLDS:
+            deflater = Deflater(mode, threshold)
+            reader = FrameReader(1024 * 1024)
+            reader.inflater = Inflater(mode)
+            start = time.perf_counter()
+            packed = [deflater.pack(f) for f in frames]
+            pack_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for f in packed:
+                reader.feed(f)
+                reader.pop()
+            unpack_time = time.perf_counter() - start
+            wire = sum(len(f) for f in packed)
+            print(f"{mode:>6} ngưỡng {threshold:>3}: {wire:>10,} bytes ({wire * 100 / raw:5.1f}%) | "
+                  f"nén {pack_time * 1e6 / len(frames):5.1f}µs giải nén {unpack_time * 1e6 / len(frames):5.1f}µs mỗi frame")
+
+SCENARIOS = {
+    "login": bench_login,
+    "transition": bench_transition,
+    "history_db": bench_history_db,
+    "fanout": bench_fanout,
+    "compression": bench_compression,
+    "pipeline": bench_pipeline,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark chat server (server phải đang chạy, không có --rate-limit-loopback vì mọi client bench cùng một IP)")
+    parser.add_argument("scenario", choices=sorted(SCENARIOS))
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--rows", type=int, default=DB_ROWS, help="Số dòng cho kịch bản history_db")
+    parser.add_argument("--clients", type=int, default=FANOUT_CLIENTS, help="Số người nhận cho kịch bản fanout")
+    args = parser.parse_args()
+    SERVER_PORT = args.port
+    DB_ROWS = args.rows
+    FANOUT_CLIENTS = args.clients
+    print(f"Benchmark '{args.scenario}' - Server: {SERVER_IP}:{SERVER_PORT}")
+    try:
+        SCENARIOS[args.scenario](args.rounds)
+    except ConnectionRefusedError:
+        print("Không thể kết nối! Server có thể chưa bật.")
+        sys.exit(1)
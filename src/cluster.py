@@ -0,0 +1,310 @@
+"""Chế độ cluster của Server.py: N worker cùng nghe một cổng (SO_REUSEPORT), nối với nhau
+qua một broker chạy trong tiến trình cha bằng Unix socket.
+
+Broker chỉ định tuyến và giữ trạng thái cần một nơi quyết định duy nhất: user nào đang
+đăng nhập ở worker nào (chống đăng nhập trùng giữa các worker). Còn lại (phòng, yêu cầu
+chat riêng, broadcast) là các thông điệp worker phát cho nhau qua broker, mỗi worker tự áp
+dụng lên bản sao của mình. Id tin nhắn mỗi worker tự cấp trong dải riêng (xem Server.MessageLog).
+
+Thông điệp là tuple pickle trong frame framing.encode_frame. Unpickle dữ liệu của một tiến trình
+là cho tiến trình đó chạy code tùy ý, nên bus chỉ dành cho các worker do Server.py sinh ra:
+socket nằm trong thư mục tạm quyền 0700, bản thân socket quyền 0600, và broker từ chối
+kết nối từ uid khác (SO_PEERCRED, nơi hệ điều hành hỗ trợ) trước khi đọc thông điệp nào."""
+import concurrent.futures
+import itertools
+import logging
+import os
+import pickle
+import queue
+import socket
+import struct
+import tempfile
+import threading
+
+from framing import FrameReader, encode_frame
+
+BUS_MAX_FRAME = 1024 * 1024  # Frame lớn nhất trên bus (chunk file chuyển tiếp cũng đi qua đây)
+CALL_TIMEOUT = 5  # Giây chờ broker / worker khác trả lời một lời gọi
+CALL_THREADS = 4  # Luồng xử lý lời gọi và thông điệp chậm (blocking) từ worker khác
+
+
+def encode(msg):
+    return encode_frame(pickle.dumps(msg, pickle.HIGHEST_PROTOCOL))
+
+
+def socket_path():
+    """Đường dẫn Unix socket mới trong thư mục tạm riêng (quyền 0700)"""
+    return os.path.join(tempfile.mkdtemp(prefix="chat-cluster-"), "broker.sock")
+
+
+def same_user(sock):
+    """Tiến trình ở đầu kia Unix socket cùng uid với tiến trình này (không kiểm được thì tin quyền file)"""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return True
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    _, uid, _ = struct.unpack("3i", creds)
+    return uid == os.getuid()
+
+
+def read_messages(sock):
+    """Các thông điệp nhận được trên sock cho tới khi kết nối đóng"""
+    frames = FrameReader(BUS_MAX_FRAME)
+    while True:
+        frame = frames.pop()
+        if frame is not None:
+            yield pickle.loads(frame)
+        elif not frames.fill(sock):
+            return
+
+
+class Broker:
+    """Định tuyến thông điệp giữa các worker (chạy trong tiến trình cha).
+    Worker -> broker:
+      ("hello", shard)                          kết nối đầu tiên của worker
+      ("all", msg)                              phát cho mọi worker khác
+      ("user", username, msg)                   gửi cho worker đang giữ username
+      ("call", id, username|None, name, args)   gọi broker (None) hoặc worker giữ username
+      ("reply", id, caller, result)             trả lời lời gọi chuyển tiếp
+    Broker -> worker: (shard gửi, *msg), hoặc (None, "reply", id, result).
+    Khóa chỉ bao quyết định định tuyến (owners, forwarded) và việc xếp frame vào hàng đợi gửi của
+    từng worker, nên thứ tự tới các worker vẫn đúng thứ tự xử lý; ghi socket do luồng ghi riêng
+    của mỗi worker làm ngoài khóa, một worker chậm không chặn broker."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.outboxes = {}  # shard -> hàng đợi frame gửi tới worker đó (None = dừng luồng ghi)
+        self.owners = {}    # username -> shard đang giữ phiên
+        self.detached = set()  # username có phiên tạm ngắt (chờ khôi phục, chưa tính là đang kết nối)
+        self.forwarded = {}  # (shard gọi, id) -> (tên lời gọi, username)
+        self.messages = 0
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        os.chmod(path, 0o600)
+        self.listener.listen()
+
+    def serve(self):
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                break
+            if not same_user(sock):
+                logging.warning("[CLUSTER] Từ chối kết nối broker từ uid khác")
+                sock.close()
+                continue
+            threading.Thread(target=self._serve_worker, args=(sock,), daemon=True).start()
+
+    def close(self):
+        self.listener.close()
+        try:
+            os.unlink(self.path)
+            os.rmdir(os.path.dirname(self.path))
+        except OSError:
+            pass
+
+    def users(self):
+        """(username -> shard, các username đang tạm ngắt)"""
+        with self.lock:
+            return dict(self.owners), set(self.detached)
+
+    def _send(self, shard, msg):
+        outbox = self.outboxes.get(shard)
+        if outbox is None:
+            return False
+        outbox.put(encode(msg))
+        return True
+
+    def _broadcast(self, origin, msg):
+        frame = None
+        for shard, outbox in self.outboxes.items():
+            if shard != origin:
+                frame = frame or encode((origin, *msg))
+                outbox.put(frame)
+
+    @staticmethod
+    def _write(sock, outbox):
+        """Luồng ghi của một worker: gửi lần lượt các frame đã xếp hàng"""
+        while (frame := outbox.get()) is not None:
+            try:
+                sock.sendall(frame)
+            except OSError:
+                return
+
+    def _serve_worker(self, sock):
+        shard = None
+        try:
+            for msg in read_messages(sock):
+                with self.lock:
+                    if shard is None:
+                        if msg[0] != "hello":
+                            return
+                        shard = msg[1]
+                        self.outboxes[shard] = outbox = queue.SimpleQueue()
+                        threading.Thread(target=self._write, args=(sock, outbox), daemon=True).start()
+                        logging.info(f"[CLUSTER] Worker {shard} đã kết nối broker")
+                        continue
+                    self.messages += 1
+                    self._handle(shard, msg)
+        except OSError:
+            pass
+        finally:
+            sock.close()
+            if shard is not None:
+                self._lost(shard)
+
+    def _handle(self, shard, msg):
+        kind = msg[0]
+        if kind == "all":
+            inner = msg[1]
+            if inner[0] == "remove" and self.owners.get(inner[1]) == shard:
+                del self.owners[inner[1]]
+                self.detached.discard(inner[1])
+            elif inner[0] == "detach" and self.owners.get(inner[1]) == shard:
+                self.detached.add(inner[1])
+            elif inner[0] == "attach":
+                self.detached.discard(inner[1])
+            self._broadcast(shard, inner)
+        elif kind == "user":
+            owner = self.owners.get(msg[1])
+            if owner is not None:
+                self._send(owner, (shard, *msg[2]))
+        elif kind == "call":
+            _, call_id, username, name, args = msg
+            if username is None:
+                self._send(shard, (None, "reply", call_id, self._call(shard, name, args)))
+                return
+            owner = self.owners.get(username)
+            if owner is None or owner == shard:
+                self._send(shard, (None, "reply", call_id, None))
+                return
+            self.forwarded[(shard, call_id)] = (name, username)
+            self._send(owner, (shard, "call", call_id, name, args))
+        elif kind == "reply":
+            _, call_id, caller, result = msg
+            name, username = self.forwarded.pop((caller, call_id), (None, None))
+            if name == "handoff" and result and self.owners.get(username) == shard:
+                # Phiên tạm ngắt chuyển sang worker nhận kết nối khôi phục
+                self.owners[username] = caller
+                self.detached.discard(username)
+                self._broadcast(caller, ("moved", username))
+            self._send(caller, (None, "reply", call_id, result))
+
+    def _call(self, shard, name, args):
+        if name == "claim":
+            username, protocol = args
+            if username in self.owners:
+                return False
+            self.owners[username] = shard
+            self._broadcast(shard, ("add", username, protocol))
+            return True
+        return None
+
+    def _lost(self, shard):
+        """Worker mất kết nối (crash hoặc tắt): các user của nó coi như đã rời server"""
+        with self.lock:
+            outbox = self.outboxes.pop(shard, None)
+            if outbox is not None:
+                outbox.put(None)
+            for username in [u for u, s in self.owners.items() if s == shard]:
+                del self.owners[username]
+                self.detached.discard(username)
+                self._broadcast(shard, ("remove", username))
+            for key in [k for k in self.forwarded if k[0] == shard]:
+                del self.forwarded[key]
+        logging.warning(f"[CLUSTER] Worker {shard} ngắt kết nối broker")
+
+
+class Bus:
+    """Đầu nối của một worker tới broker.
+    Luồng đọc chỉ chuyển trả lời cho lời gọi đang chờ và xếp các thông điệp còn lại vào hàng đợi;
+    luồng áp dụng xử lý lần lượt bằng handler. Nhờ vậy một luồng đang giữ khóa và chờ trả lời
+    không bao giờ chặn chính trả lời đó.
+    handler(origin, kind, *args) xử lý thông điệp; calls[name](origin, *args) xử lý lời gọi từ worker khác.
+    Lời gọi và các loại thông điệp trong slow (đọc DB, gọi worker khác) chạy trên pool luồng riêng:
+    luồng áp dụng không bao giờ chờ, nên hai worker gọi nhau không khóa chết tới CALL_TIMEOUT."""
+    def __init__(self, path, shard, handler, calls, on_lost, slow=()):
+        self.shard = shard
+        self.handler = handler
+        self.calls = calls
+        self.slow = frozenset(slow)
+        self.on_lost = on_lost
+        self.executor = concurrent.futures.ThreadPoolExecutor(CALL_THREADS, thread_name_prefix="bus-call")
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.send_lock = threading.Lock()
+        self.waiting = {}  # id lời gọi -> [Event, kết quả]
+        self.call_ids = itertools.count(1)
+        self.inbox = queue.SimpleQueue()
+        self._send(("hello", shard))
+        threading.Thread(target=self._read, daemon=True).start()
+        self.apply_thread = threading.Thread(target=self._apply, daemon=True)
+        self.apply_thread.start()
+
+    def _send(self, msg):
+        with self.send_lock:
+            self.sock.sendall(encode(msg))
+
+    def publish(self, *msg):
+        """Phát cho mọi worker khác"""
+        self._send(("all", msg))
+
+    def to_user(self, username, *msg):
+        """Gửi cho worker đang giữ phiên của username"""
+        self._send(("user", username, msg))
+
+    def call(self, name, *args, user=None):
+        """Gọi broker (user=None) hoặc worker giữ phiên user rồi chờ kết quả; None nếu quá CALL_TIMEOUT"""
+        if threading.current_thread() is self.apply_thread:
+            raise RuntimeError(f"Lời gọi {name} từ luồng áp dụng của bus")
+        call_id = next(self.call_ids)
+        waiter = [threading.Event(), None]
+        self.waiting[call_id] = waiter
+        try:
+            self._send(("call", call_id, user, name, args))
+            if not waiter[0].wait(CALL_TIMEOUT):
+                logging.error(f"[CLUSTER] Lời gọi {name} quá {CALL_TIMEOUT}s không có trả lời")
+            return waiter[1]
+        finally:
+            self.waiting.pop(call_id, None)
+
+    def _read(self):
+        try:
+            for origin, kind, *args in read_messages(self.sock):
+                if kind == "reply":
+                    waiter = self.waiting.get(args[0])
+                    if waiter:
+                        waiter[1] = args[1]
+                        waiter[0].set()
+                else:
+                    self.inbox.put((origin, kind, args))
+        except OSError:
+            pass
+        self.on_lost()
+
+    def _apply(self):
+        while True:
+            origin, kind, args = self.inbox.get()
+            if kind == "call":
+                self.executor.submit(self._call, origin, *args)
+            elif kind in self.slow:
+                self.executor.submit(self._handle, origin, kind, args)
+            else:
+                self._handle(origin, kind, args)
+
+    def _handle(self, origin, kind, args):
+        try:
+            self.handler(origin, kind, *args)
+        except Exception as e:
+            logging.error(f"[CLUSTER] Lỗi xử lý {kind}: {e}")
+
+    def _call(self, origin, call_id, name, args):
+        result = None
+        try:
+            result = self.calls[name](origin, *args)
+        except Exception as e:
+            logging.error(f"[CLUSTER] Lỗi xử lý lời gọi {name}: {e}")
+        finally:
+            try:
+                self._send(("reply", call_id, origin, result))
+            except OSError:
+                pass  # Mất broker: luồng đọc sẽ báo on_lost
@@ -0,0 +1,322 @@
+"""Đóng/mở frame của giao thức chat: header 4 byte (độ dài, big-endian) + nội dung UTF-8.
+Dùng chung cho Server.py, Client.py và test.py."""
+import struct
+import zlib
+
+HEADER = struct.Struct('!I')
+READ_BUFFER_SIZE = 64 * 1024
+COMPRESSED = 0x80000000  # Bit cao của header: nội dung đã nén deflate (độ dài là số byte sau nén)
+LENGTH_MASK = COMPRESSED - 1
+COMPRESSION_MODES = ("frame", "stream")
+# Frame ngắn hơn ngưỡng gửi nguyên (số liệu: python bench.py compression).
+# Nén từng frame riêng lẻ gần như không lợi gì với tin chat ngắn, chỉ đáng với lịch sử;
+# chế độ stream nén được cả tin ngắn nhờ dictionary chung (~26% số byte ở ngưỡng 64).
+COMPRESS_MIN_BYTES = {"frame": 256, "stream": 64}
+COMPRESS_LEVEL = 6
+SYNC_TAIL = b"\x00\x00\xff\xff"  # Đuôi cố định của Z_SYNC_FLUSH, bỏ khi gửi và thêm lại khi giải nén
+
+
+class FrameTooLarge(ValueError):
+    """Header báo độ dài vượt giới hạn cho phép"""
+    def __init__(self, length):
+        super().__init__(f"Tin nhắn quá lớn: {length} bytes")
+        self.length = length
+
+
+def encode_frame(msg):
+    """str hoặc bytes -> header + nội dung"""
+    data = msg.encode('utf-8') if isinstance(msg, str) else msg
+    return HEADER.pack(len(data)) + data
+
+
+class Deflater:
+    """Nén frame phía gửi của một kết nối.
+    'frame': mỗi frame từ threshold byte trở lên nén độc lập, chỉ dùng bản nén nếu nhỏ hơn.
+    'stream': một luồng deflate cho cả kết nối, mỗi frame kết thúc bằng Z_SYNC_FLUSH (như permessage-deflate)
+    nên dictionary 32KB dùng chung giữa các frame: tên, thời gian, tiền tố lặp lại chỉ tốn vài byte.
+    Phải gọi pack đúng thứ tự gửi và không được bỏ frame đã pack."""
+    def __init__(self, mode, threshold=None, level=COMPRESS_LEVEL):
+        if mode not in COMPRESSION_MODES:
+            raise ValueError(f"Chế độ nén không hợp lệ: {mode}")
+        self.mode = mode
+        self.threshold = COMPRESS_MIN_BYTES[mode] if threshold is None else threshold
+        self.level = level
+        self.stream = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS) if mode == "stream" else None
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+
+    def pack(self, frame):
+        """Frame đã đóng (header + nội dung) -> frame gửi đi (nén hoặc giữ nguyên)"""
+        payload = memoryview(frame)[HEADER.size:]
+        self.raw_bytes += len(frame)
+        if len(payload) < self.threshold:
+            self.wire_bytes += len(frame)
+            return frame
+        if self.stream:
+            data = self.stream.compress(payload) + self.stream.flush(zlib.Z_SYNC_FLUSH)
+            data = data[:-len(SYNC_TAIL)]
+        else:
+            # Cửa sổ và bộ nhớ vừa với frame: khởi tạo trạng thái 32KB mới là phần tốn CPU nhất khi frame nhỏ
+            wbits = max(9, min(zlib.MAX_WBITS, (len(payload) - 1).bit_length()))
+            deflate = zlib.compressobj(self.level, zlib.DEFLATED, -wbits, min(8, wbits - 6))
+            data = deflate.compress(payload) + deflate.flush()
+            if len(data) >= len(payload):
+                self.wire_bytes += len(frame)
+                return frame
+        self.wire_bytes += HEADER.size + len(data)
+        return HEADER.pack(len(data) | COMPRESSED) + data
+
+
+class Inflater:
+    """Giải nén phía nhận, cùng chế độ với Deflater của bên gửi"""
+    def __init__(self, mode):
+        if mode not in COMPRESSION_MODES:
+            raise ValueError(f"Chế độ nén không hợp lệ: {mode}")
+        self.mode = mode
+        self.stream = zlib.decompressobj(-zlib.MAX_WBITS) if mode == "stream" else None
+
+    def unpack(self, data, max_length):
+        """Nội dung nén -> nội dung gốc; vượt max_length byte thì báo FrameTooLarge (chống zip bomb)"""
+        try:
+            if self.stream:
+                inflate = self.stream
+                data = data + SYNC_TAIL
+            else:
+                inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+            frame = inflate.decompress(data, max_length)
+        except zlib.error as e:
+            raise ProtocolError(f"Lỗi giải nén: {e}")
+        if inflate.unconsumed_tail:
+            raise FrameTooLarge(max_length + len(inflate.unconsumed_tail))
+        return frame
+
+
+class FrameReader:
+    """Bộ giải frame dạng luồng trên một bytearray cấp phát sẵn.
+    recv_into ghi thẳng vào phần trống của buffer và lấy hết số byte đang có trong một lần gọi,
+    mọi frame đã đủ trong buffer được trả ra mà không phải gọi recv thêm.
+    Buffer chỉ nới rộng khi một frame lớn hơn kích thước hiện tại.
+    Gán inflater (sau khi đã xin nén) để giải nén các frame có bit COMPRESSED."""
+    def __init__(self, max_frame, size=READ_BUFFER_SIZE):
+        self.max_frame = max_frame
+        self.inflater = None
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0  # Đầu dữ liệu chưa xử lý
+        self.end = 0    # Cuối dữ liệu đã nhận
+
+    def pop(self):
+        """Frame đầy đủ tiếp theo trong buffer (bytes), None nếu chưa đủ"""
+        available = self.end - self.start
+        if available < HEADER.size:
+            return None
+        header = HEADER.unpack_from(self.buf, self.start)[0]
+        length = header & LENGTH_MASK
+        if length > self.max_frame:
+            raise FrameTooLarge(length)
+        if available < HEADER.size + length:
+            return None
+        begin = self.start + HEADER.size
+        frame = bytes(self.view[begin:begin + length])
+        self.start = begin + length
+        if self.start == self.end:
+            self.start = self.end = 0
+        if header & COMPRESSED:
+            if self.inflater is None:
+                raise ProtocolError("Nhận frame nén khi chưa bật nén")
+            frame = self.inflater.unpack(frame, self.max_frame)
+        return frame
+
+    def _reserve(self, extra):
+        """Bảo đảm phần trống cuối buffer đủ cho extra byte và cho phần còn thiếu của frame đang đọc dở:
+        dồn dữ liệu về đầu buffer, chỉ cấp phát lại khi frame lớn hơn cả buffer"""
+        pending = self.end - self.start
+        needed = pending + extra
+        if pending >= HEADER.size:
+            length = min(HEADER.unpack_from(self.buf, self.start)[0] & LENGTH_MASK, self.max_frame)
+            needed = max(needed, HEADER.size + length)
+        if needed > len(self.buf):
+            buf = bytearray(needed)
+            buf[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.buf, self.view = buf, memoryview(buf)
+            self.start, self.end = 0, pending
+        elif len(self.buf) - self.end < needed - pending:
+            self.buf[:pending] = self.buf[self.start:self.end]
+            self.start, self.end = 0, pending
+
+    def fill(self, sock):
+        """Một lần recv_into; trả về số byte nhận được (0 = kết nối đã đóng)"""
+        self._reserve(1)
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def feed(self, data):
+        """Nạp dữ liệu đã đọc sẵn (chế độ asyncio: StreamReader.read)"""
+        self._reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def next_frame(self, sock):
+        """Chặn tới khi có một frame đầy đủ; None nếu kết nối đóng"""
+        while True:
+            frame = self.pop()
+            if frame is not None:
+                return frame
+            if not self.fill(sock):
+                return None
+
+
+# === GIAO THỨC V2 ===
+# Client gửi frame văn bản GIAO THỨC:2 ngay sau khi kết nối. Server hỗ trợ v2 trả lại đúng frame đó
+# (frame văn bản cuối cùng), từ đó cả hai chiều dùng frame nhị phân: 1 byte opcode + các trường.
+# Trường 'Q' là số nguyên 8 byte, 's' là chuỗi UTF-8 kèm độ dài 4 byte, 'b' là bytes kèm độ dài 4 byte;
+# phần sau '*' là nhóm trường lặp lại tới hết frame (các dòng lịch sử).
+PROTOCOL_HELLO = "GIAO THỨC:2"
+
+# Server -> client
+OP_PROMPT = 0x01   # loại (XÁC THỰC/DANGNHAP/DANGKY), nội dung
+OP_OK = 0x02
+OP_ERROR = 0x03
+OP_NOTICE = 0x04   # [THÔNG BÁO]
+OP_SERVER = 0x05   # [MÁY CHỦ]
+OP_CHAT = 0x06     # id, thời gian, phòng, người gửi, nội dung
+OP_HISTORY = 0x07  # phòng, tiêu đề, các dòng (id, thời gian, người gửi, nội dung)
+OP_CURSOR = 0x08   # phòng, id cũ nhất đã gửi (0 = hết), id mới nhất của phòng
+OP_SESSION = 0x09  # resume token, username
+OP_PONG = 0x0A
+OP_BYE = 0x0B
+OP_TEXT = 0x0C     # Văn bản khác (kết quả /list, /help, ...)
+OP_DONE = 0x0D     # Mã yêu cầu đã xử lý xong, không còn trả lời nào cho mã đó
+OP_THROTTLE = 0x0E # loại giới hạn (public/private/command/auth), số ms nên chờ; yêu cầu vừa gửi bị bỏ qua
+# Client -> server
+OP_INPUT = 0x40    # Dòng nhập ở bước xác thực và các frame điều khiển (ĐỒNG BỘ, TIẾP TỤC)
+OP_SAY = 0x41      # Tin chat, không bao giờ bị hiểu là lệnh
+OP_COMMAND = 0x42  # tên lệnh, tham số
+OP_PING = 0x43
+# Hai chiều
+OP_FILE_OFFER = 0x70   # mã lượt gửi, người gửi (client gửi lên để trống), tên file, kích thước
+OP_FILE_CHUNK = 0x71   # mã lượt gửi, số thứ tự, dữ liệu
+OP_FILE_ACK = 0x72     # mã lượt gửi, số thứ tự chunk người nhận đã ghi xong
+OP_FILE_END = 0x73     # mã lượt gửi
+OP_FILE_CANCEL = 0x74  # mã lượt gửi, người gửi file (để phân biệt chiều gửi/nhận), lý do
+OP_TAGGED = 0x7E   # Mã yêu cầu (8 byte) + một frame v2 nguyên vẹn (opcode + trường)
+
+V2_FIELDS = {
+    OP_PROMPT: "ss", OP_OK: "s", OP_ERROR: "s", OP_NOTICE: "s", OP_SERVER: "s",
+    OP_CHAT: "Qssss", OP_HISTORY: "ss*Qsss", OP_CURSOR: "sQQ", OP_SESSION: "ss",
+    OP_PONG: "", OP_BYE: "s", OP_TEXT: "s", OP_DONE: "Q", OP_THROTTLE: "sQ",
+    OP_INPUT: "s", OP_SAY: "s", OP_COMMAND: "ss", OP_PING: "",
+    OP_FILE_OFFER: "QssQ", OP_FILE_CHUNK: "QQb", OP_FILE_ACK: "QQ", OP_FILE_END: "Q", OP_FILE_CANCEL: "Qss",
+}
+
+# Gửi file trong phòng chat riêng: người gửi chỉ được có tối đa FILE_WINDOW chunk chưa được xác nhận,
+# nên mỗi lượt gửi chiếm tối đa FILE_WINDOW * FILE_CHUNK_SIZE byte trong hàng đợi gửi của người nhận
+# và tin chat trên cùng kết nối không phải xếp sau cả file.
+FILE_CHUNK_SIZE = 16 * 1024
+FILE_WINDOW = 4
+FILE_FRAME_BYTES = FILE_CHUNK_SIZE + 64  # Frame chunk lớn nhất (dữ liệu + opcode + các trường)
+
+U64 = struct.Struct('!Q')
+
+
+class ProtocolError(ValueError):
+    """Frame v2 sai opcode hoặc sai độ dài trường"""
+
+
+def _pack(fmt, values):
+    parts = []
+    for code, value in zip(fmt, values):
+        if code == 'Q':
+            parts.append(U64.pack(value))
+        else:
+            data = value if code == 'b' else value.encode('utf-8')
+            parts.append(HEADER.pack(len(data)))
+            parts.append(data)
+    return b''.join(parts)
+
+
+def pack_row(*values):
+    """Một dòng lịch sử v2 (id, thời gian, người gửi, nội dung), nối thẳng vào frame OP_HISTORY"""
+    return _pack("Qsss", values)
+
+
+def encode_v2(opcode, *values, rows=()):
+    """Frame v2 hoàn chỉnh (kèm header độ dài); rows là các dòng đã pack_row sẵn"""
+    fields = V2_FIELDS[opcode].partition('*')[0]
+    return encode_frame(bytes((opcode,)) + _pack(fields, values) + b''.join(rows))
+
+
+def _unpack(fmt, frame, pos):
+    values = []
+    for code in fmt:
+        if code == 'Q':
+            values.append(U64.unpack_from(frame, pos)[0])
+            pos += U64.size
+        else:
+            length = HEADER.unpack_from(frame, pos)[0]
+            pos += HEADER.size
+            if pos + length > len(frame):
+                raise ProtocolError("Trường vượt quá độ dài frame")
+            value = frame[pos:pos + length]
+            values.append(value if code == 'b' else value.decode('utf-8'))
+            pos += length
+    return values, pos
+
+
+def decode_v2(frame):
+    """frame (không gồm header độ dài) -> (opcode, [trường], [dòng])"""
+    if not frame or frame[0] not in V2_FIELDS:
+        raise ProtocolError(f"Opcode không hợp lệ: {frame[:1].hex()}")
+    fields, _, row_fmt = V2_FIELDS[frame[0]].partition('*')
+    try:
+        values, pos = _unpack(fields, frame, 1)
+        rows = []
+        while row_fmt and pos < len(frame):
+            row, pos = _unpack(row_fmt, frame, pos)
+            rows.append(row)
+    except struct.error as e:
+        raise ProtocolError(str(e))
+    return frame[0], values, rows
+
+
+# === MÃ YÊU CẦU ===
+# Client có thể gắn mã vào frame gửi lên; mọi frame server trả về cho chính kết nối đó trong lúc xử lý
+# frame ấy mang lại mã, cuối cùng là XONG:<mã> (v2: OP_DONE). Nhờ vậy client gửi liền một loạt
+# (xác thực + các lệnh đầu tiên) rồi ghép trả lời theo mã, không phải chờ từng lượt.
+# v1: MÃ:<mã>:<frame văn bản>   v2: OP_TAGGED + mã + frame v2
+# Client v1 phải gửi TAG_HELLO trước khi xác thực thì server mới coi MÃ:<mã>:... là frame gắn mã,
+# nếu không tin chat tình cờ bắt đầu bằng "MÃ:123:" sẽ bị cắt mất phần đầu. v2 dùng opcode riêng nên không cần.
+TAG_PREFIX = "MÃ:".encode('utf-8')
+TAG_HELLO = "MÃ:BẬT"
+MAX_REQUEST_ID = (1 << 64) - 1  # Mã yêu cầu là số nguyên 8 byte không dấu
+
+
+def tag_frame(protocol, request_id, frame):
+    """Frame đã đóng (header + nội dung) -> frame gắn mã yêu cầu"""
+    payload = memoryview(frame)[HEADER.size:]
+    if protocol == 2:
+        prefix = bytes((OP_TAGGED,)) + U64.pack(request_id)
+    else:
+        prefix = TAG_PREFIX + f"{request_id}:".encode('utf-8')
+    return HEADER.pack(len(prefix) + len(payload)) + prefix + payload
+
+
+def split_tag(protocol, frame, v1_tags=False):
+    """frame (không gồm header) -> (mã yêu cầu hoặc None, frame bên trong).
+    v1 chỉ tách mã khi v1_tags (đã thỏa thuận bằng TAG_HELLO); mã ngoài 0..MAX_REQUEST_ID là ProtocolError."""
+    if protocol == 2:
+        if frame[:1] != bytes((OP_TAGGED,)):
+            return None, frame
+        if len(frame) < 1 + U64.size:
+            raise ProtocolError("Frame gắn mã thiếu mã yêu cầu")
+        return U64.unpack_from(frame, 1)[0], frame[1 + U64.size:]
+    if not v1_tags or not frame.startswith(TAG_PREFIX):
+        return None, frame
+    request_id, sep, inner = frame[len(TAG_PREFIX):].partition(b":")
+    if not sep or not request_id.isdigit():
+        return None, frame  # Không đúng dạng: coi như văn bản thường
+    if len(request_id) > len(str(MAX_REQUEST_ID)) or int(request_id) > MAX_REQUEST_ID:
+        raise ProtocolError("Mã yêu cầu vượt quá 8 byte")
+    return int(request_id), inner
@@ -1,9 +1,9 @@
 import socket
 import threading
 import time
-import struct
 import sys
 import random
+from framing import FrameReader, encode_frame
 
 # === CẤU HÌNH TEST ===
 SERVER_IP = "127.0.0.1"
@@ -12,45 +12,32 @@ NUM_CLIENTS_TO_TEST = 6
 TEST_DURATION_SECONDS = 60 # Chạy test trong 60 giây
 BASE_USERNAME = "chaostester"
 BASE_PASSWORD = "password123"
+# Server mặc định không giới hạn tốc độ client loopback; chạy với --rate-limit-loopback
+# thì mọi client test (cùng 127.0.0.1) sẽ nhận CHẬM LẠI và bị ngắt vì vượt budget mỗi IP.
 
 # Biến toàn cục (đơn giản) để các client biết tên nhau mà /msg
 # Sẽ được cập nhật bởi các client khi chúng đăng nhập thành công
 active_usernames = []
 lock = threading.Lock()
+throttled = 0  # Số frame CHẬM LẠI nhận được (server đang giới hạn tốc độ)
 
 # === CÁC HÀM HELPER GIAO THỨC MẠNG ===
-# (Copy y hệt từ server/client)
+# (Đóng/mở frame dùng chung framing.py với server/client)
 
 def send_message(conn, msg):
     try:
-        data = msg.encode('utf-8')
-        length = len(data)
-        conn.sendall(struct.pack('!I', length) + data)
+        conn.sendall(encode_frame(msg))
         return True
     except (BrokenPipeError, ConnectionResetError, OSError):
         return False
     except Exception:
         return False
 
-def recv_message(conn, timeout=10.0):
+def recv_message(conn, reader, timeout=10.0):
     try:
         conn.settimeout(timeout)
-        header = b''
-        while len(header) < 4:
-            chunk = conn.recv(4 - len(header))
-            if not chunk: return None
-            header += chunk
-        
-        length = struct.unpack('!I', header)[0]
-        if length > 4096: return None 
-
-        data = b''
-        while len(data) < length:
-            chunk = conn.recv(min(4096, length - len(data)))
-            if not chunk: return None
-            data += chunk
-        
-        return data.decode('utf-8')
+        frame = reader.next_frame(conn)  # Timeout giữa chừng không mất dữ liệu: phần đã nhận còn trong buffer
+        return frame.decode('utf-8') if frame is not None else None
     except socket.timeout:
         return None # Server không nói gì -> timeout
     except Exception:
@@ -58,19 +45,28 @@ def recv_message(conn, timeout=10.0):
 
 # === LUỒNG NHẬN TIN (ĐỂ TỰ ĐỘNG /ACCEPT) ===
 
-def receive_worker(sock, username, ident):
+def receive_worker(sock, reader, username, ident):
     """
     Đây là luồng "nghe" của mỗi client.
     Nó sẽ tự động chấp nhận hoặc từ chối các yêu cầu chat riêng.
     """
+    global throttled
     while True:
         try:
-            msg = recv_message(sock, timeout=TEST_DURATION_SECONDS + 10)
+            msg = recv_message(sock, reader, timeout=TEST_DURATION_SECONDS + 10)
             if msg is None:
                 # Bị timeout (do test đã xong) hoặc server ngắt kết nối
                 # print(f"{ident} Luồng nhận: Bị timeout/ngắt kết nối.")
                 break
             
+            if msg.startswith("CHẬM LẠI:"):
+                with lock:
+                    throttled += 1
+                continue
+            if msg.startswith("LỖI:Gửi quá nhanh"):
+                print(f"{ident} BỊ NGẮT VÌ GỬI QUÁ NHANH: server đang giới hạn cả loopback (--rate-limit-loopback)")
+                break
+
             # --- TỰ ĐỘNG HÓA CHAT RIÊNG ---
             if "[THÔNG BÁO]" in msg and "muốn chat riêng" in msg:
                 try:
@@ -108,43 +104,50 @@ def client_worker(client_id):
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.connect((SERVER_IP, SERVER_PORT))
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = FrameReader(1024 * 1024) # Lịch sử gửi cả khối trong 1 frame
     except Exception as e:
         print(f"{ident} KẾT NỐI THẤT BẠI: {e}")
         return
 
     # --- Giai đoạn 1: Xác thực ---
     try:
-        response = recv_message(s, timeout=5) # Chờ server chào
+        response = recv_message(s, reader, timeout=5) # Chờ server chào
+        while response and response.startswith("HÀNG CHỜ:"):
+            print(f"{ident} XẾP HÀNG: vị trí {response.split(':', 1)[1]}")
+            response = recv_message(s, reader, timeout=TEST_DURATION_SECONDS)
         if not response or "XÁC THỰC:" not in response:
             raise Exception("Không nhận được lời chào XÁC THỰC")
 
         # 1. Thử ĐĂNG KÝ
         send_message(s, "DANGKY")
-        recv_message(s) # "DANGKY:Nhập tên tài khoản"
+        recv_message(s, reader) # "DANGKY:Nhập tên tài khoản"
         send_message(s, username)
-        recv_message(s) # "DANGKY:Nhập mật khẩu"
+        recv_message(s, reader) # "DANGKY:Nhập mật khẩu"
         send_message(s, password)
         
         while "XÁC THỰC:" not in response:
-            response = recv_message(s)
+            response = recv_message(s, reader)
             if response is None: raise Exception("Mất kết nối khi đăng ký")
 
         # 2. Thử ĐĂNG NHẬP
         send_message(s, "DANGNHAP")
-        recv_message(s) # "DANGNHAP:Nhập tên tài khoản"
+        recv_message(s, reader) # "DANGNHAP:Nhập tên tài khoản"
         send_message(s, username)
-        recv_message(s) # "DANGNHAP:Nhập mật khẩu"
+        recv_message(s, reader) # "DANGNHAP:Nhập mật khẩu"
         send_message(s, password)
 
         # 3. Chờ vào phòng
         while "OK:Đã vào phòng chung" not in response:
-            response = recv_message(s, timeout=15)
+            response = recv_message(s, reader, timeout=15)
             if response is None: raise Exception("Mất kết nối khi chờ vào phòng")
             
             if "LỖI:Server đã đầy" in response:
                 print(f"{ident} BỊ TỪ CHỐI: Server đầy. (OK)")
                 s.close()
                 return
+            if response.startswith("CHẬM LẠI:"):
+                raise Exception("Bị giới hạn tốc độ khi đăng nhập, server đang giới hạn cả loopback (--rate-limit-loopback)")
             if "LỖI:" in response:
                 print(f"{ident} LỖI ĐĂNG NHẬP: {response}")
 
@@ -158,7 +161,7 @@ def client_worker(client_id):
         return
 
     # --- Giai đoạn 2: Khởi động luồng nhận (cho chat riêng) ---
-    threading.Thread(target=receive_worker, args=(s, username, ident), daemon=True).start()
+    threading.Thread(target=receive_worker, args=(s, reader, username, ident), daemon=True).start()
 
     # --- Giai đoạn 3: Stress Test Hỗn Hợp (Luồng gửi) ---
     start_time = time.time()
@@ -206,6 +209,37 @@ def client_worker(client_id):
         print(f"{ident} Đã ngắt kết nối.")
 
 
+# === KIỂM TRA TRƯỚC KHI STRESS ===
+
+def check_history_before_overflow():
+    """/history before <id lớn hơn INTEGER của SQLite> phải nhận trang lịch sử mới nhất (có tin vừa gửi), không làm server lỗi DB.
+    Trả về True nếu đúng."""
+    username = f"{BASE_USERNAME}h"
+    s = socket.create_connection((SERVER_IP, SERVER_PORT))
+    reader = FrameReader(1024 * 1024)
+    try:
+        recv_message(s, reader, timeout=5)  # XÁC THỰC
+        for step in ("DANGKY", username, BASE_PASSWORD, "DANGNHAP", username, BASE_PASSWORD):
+            send_message(s, step)
+        response = ""
+        while response is not None and "OK:Đã vào phòng chung" not in response:
+            response = recv_message(s, reader, timeout=5)
+        if response is None:
+            print("[KIỂM TRA] /history before: không đăng nhập được")
+            return False
+        marker = f"kiểm tra history {random.randrange(10 ** 9)}"
+        send_message(s, marker)  # DB mới chưa có tin nào thì không có trang lịch sử để so
+        while recv_message(s, reader, timeout=0.5) is not None:
+            pass  # Bỏ lịch sử, thông báo vào phòng và tin vừa gửi
+        send_message(s, "/history before 99999999999999999999")
+        response = recv_message(s, reader, timeout=5)
+        passed = response is not None and response.startswith("LỊCH SỬ:") and marker in response
+        print(f"[KIỂM TRA] /history before <id quá lớn>: {'ĐẠT' if passed else 'LỖI'} ({response!r:.80})")
+        send_message(s, "/exit")
+        return passed
+    finally:
+        s.close()
+
 # === HÀM MAIN ĐỂ CHẠY TEST ===
 if __name__ == "__main__":
     print(f"Bắt đầu stress test HỖN HỢP với {NUM_CLIENTS_TO_TEST} client...")
@@ -220,6 +254,8 @@ if __name__ == "__main__":
     print("="*40)
     time.sleep(3)
 
+    if not check_history_before_overflow():
+        sys.exit(1)
 
     threads = []
     for i in range(NUM_CLIENTS_TO_TEST):
@@ -232,4 +268,7 @@ if __name__ == "__main__":
         t.join()
 
     print("="*40)
+    if throttled:
+        print(f"CẢNH BÁO: {throttled} lần bị server giới hạn tốc độ, kết quả không phản ánh tải thật. "
+              "Chạy lại server không có --rate-limit-loopback")
     print("Stress test HỖN HỢP hoàn tất.")
\ No newline at end of file